@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 from twisted.internet import protocol
-import threading
 import logging
 
 class Canopen(protocol.ProcessProtocol):
@@ -42,11 +41,8 @@ class Canopen(protocol.ProcessProtocol):
 
         logging.info("ConnectionMade with CANOpen!")
         
-        # Avvio il thread per la lettura delle posizioni
-        self.tripod.isReading = True
-        self.tripod.receiver_thread = threading.Thread(target=self.tripod.stream_reader)
-        self.tripod.receiver_thread.setDaemon(True)
-        self.tripod.receiver_thread.start()
+        # Avvio la lettura delle posizioni
+        self.tripod.start_stream_reader()
         
     def outReceived(self, data):
         """Sono stati ricevuti bytes su STDOUT dal sotto-processo
@@ -115,6 +111,7 @@ class Canopen(protocol.ProcessProtocol):
         # Se la simulazione è terminata chiudo il file di log
         if data[:6] == "OK CT4":
             self.tripod.last_sim_file.close()
+            self.tripod.sim_streamer.stop()
 
         # Se il comando proviene dall'utente restituisce la risposta
         logging.info("From Canopen '%s'" % data.replace("\n", "\\n"))
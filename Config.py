@@ -14,11 +14,50 @@ class Config():
         #self.SIM_PATH = "/mnt/nas/media/"
         self.DEF_MOVE = "/opt/spinitalia/default_position/"
         self.MOT_DATA = "/tmp/spinitalia/motor_data/"
+        self.CACHE_PATH = "/tmp/spinitalia/cache/"
+        self.CONVERSION_CACHE_PATH = "/tmp/spinitalia/conversion_cache/"
+        self.CONVERSION_CACHE_SIZE = 1024 * 1024 * 1024
         self.MD5SUM_EXEC = '/usr/bin/md5sum'
         if self.isFake:
             self.MOT_EXT = ".mot.fake"
         else:
             self.MOT_EXT = ".mot"
+        # Se attivo l'importazione produce le traiettorie binarie, convertite in testo solo all'avvio (CT4)
+        self.MOT_BINARY = False
+        self.TRJ_EXT = ".trj"
+        # Importazione a blocchi: byte letti per volta, righe per scrittura, modo di scrittura e blocchi in coda.
+        # Con piu' core conviene il modo "process", che formatta e scrive i file in parallelo alla cinematica
+        self.SIM_BLOCK_BYTES = 65536
+        self.SIM_WRITE_ROWS = 16384
+        self.SIM_WRITER_MODE = "inline"
+        self.SIM_WRITER_QUEUE = 4
+        # Processi che calcolano in parallelo la cinematica dei blocchi della simulazione, 1 per non usare il pool
+        self.SIM_WORKERS = 1
+        # Pre-conversione in background nella cache delle simulazioni copiate in SIM_PATH
+        self.SIM_PRECONVERT = False
+        self.SIM_WATCH_INTERVAL = 2.0
+        self.SIM_PRECONVERT_NICE = 19
+        # Importazione (CT3) nel thread del reattore ("thread") o in un processo separato ("process"), che non
+        # contende il GIL allo stream delle posizioni
+        self.SIM_IMPORT_MODE = "thread"
+        self.SIM_IMPORT_NICE = 5
+        # Secondi tra due statistiche sul jitter dello stream delle posizioni nel log, 0 per disattivarle
+        self.STREAM_STATS_INTERVAL = 60.0
+        # Righe tra due punti di ripresa dell'importazione, 0 per non salvarli
+        self.SIM_CHECKPOINT_ROWS = 100000
+        # Riproduzione durante la conversione: CT3 controlla solo il file, CT4 lo converte mentre i motori si muovono,
+        # scrivendo nelle FIFO in MOT_DATA fino a SIM_STREAM_FILL righe nell'interpolatore, con SIM_STREAM_QUEUE
+        # blocchi convertiti in anticipo
+        self.SIM_STREAMING = False
+        self.SIM_STREAM_FILL = 25
+        self.SIM_STREAM_QUEUE = 8
+        self.SIM_STREAM_INTERVAL = 0.05
+        # Lettura delle posizioni del canopen_server nel reattore ("reactor") o in un thread dedicato ("thread")
+        self.POS_READER = "reactor"
+        # Consegna al reattore ogni posizione letta (per il log della simulazione), invece della sola piu' recente
+        self.POS_FORWARD_ALL = False
+        # Byte in attesa di invio oltre i quali un client delle posizioni viene sospeso, ricevendo poi la piu' recente
+        self.POS_SEND_BUFFER = 4096
         if self.isFake:
             self.POS_PIPE = "/tmp/fake_alma_3d_spinitalia_pos_stream_pipe"
         else:
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from twisted.protocols.basic import LineReceiver
-from twisted.internet import task
+from twisted.internet import task, threads
+import json
 import logging
 import re
 import time
@@ -208,13 +209,26 @@ class ControlProtocol(LineReceiver):
             elif line.rstrip().upper()[:3] == 'CT3':
 
                 if all([self.tripod.canStatus == '6', self.tripod.isImporting is False]):
-                    self.tripod.kinematic.start_parsing(line.rstrip(), self)
+                    if self.tripod.config.SIM_IMPORT_MODE == 'process':
+                        self.tripod.sim_importer.start(line.rstrip(), self)
+                    else:
+                        self.tripod.kinematic.start_parsing(line.rstrip(), self)
                     self.last_command = line.rstrip().upper()
                     return
                 else:
                     self.sendLine("ERR CT3 0: Already busy")
                     return
 
+            # Se viene richiesta l'interruzione dell'importazione in corso
+            elif line.rstrip().upper()[:3] == 'CT7':
+
+                if self.tripod.isImporting:
+                    self.tripod.kinematic.abort_import()
+                    self.sendLine("OK CT7")
+                else:
+                    self.sendLine("CERR CT7 0: No import in progress")
+                return
+
             # Se viene richiesta l'apertura del joystick
             elif line.rstrip().upper()[:3] == 'CB3':
                 if (self.tripod.canStatus == '4') or (self.tripod.canStatus == '6') or (self.tripod.canStatus == '9'):
@@ -257,6 +271,24 @@ class ControlProtocol(LineReceiver):
                 self.tripod.last_sim_time = 0.0
                 self.tripod.mex_counter = 0
 
+                # In riproduzione durante la conversione il canopen_server legge le FIFO riempite dallo streamer
+                if self.tripod.config.SIM_STREAMING:
+                    if self.tripod.kinematic.stream_file is None:
+                        self.sendLine("CERR CT4 0: No simulation loaded")
+                        return
+                    self.tripod.sim_streamer.start(self.tripod.kinematic.stream_file, self)
+                    self.tripod.canopen.sendCommand(line, "remote")
+                    self.last_command = line.rstrip().upper()
+                    return
+
+                # Con le traiettorie binarie il canopen_server ha bisogno prima dei file di testo
+                if self.tripod.config.MOT_BINARY:
+                    self.last_command = line.rstrip().upper()
+                    d = threads.deferToThread(self.tripod.kinematic.trajectories_to_text)
+                    d.addCallback(lambda result: self.tripod.canopen.sendCommand(line, "remote"))
+                    d.addErrback(self.trajectories_to_text_failed)
+                    return
+
             elif line.rstrip().upper()[:3] == 'CT5' or line.rstrip().upper()[:3] == 'CB5':
                 if self.tripod.joy_call is not None:
                     logging.info('Virtual joystick stopped')
@@ -290,6 +322,34 @@ class ControlProtocol(LineReceiver):
                     self.transport.write("OK PR7 {}\n".format(self.tripod.last_sim))
                 return
 
+            # Se era PR8, invio le statistiche della cache della cinematica diretta
+            elif line.rstrip().upper()[:3] == 'PR8':
+
+                self.transport.write("OK PR8 H{} M{} S{}\n".format(
+                    self.tripod.kinematic.dk_cache_hits,
+                    self.tripod.kinematic.dk_cache_misses,
+                    len(self.tripod.kinematic.dk_cache)
+                ))
+                return
+
+            # Se era PR9, invio l'indice delle simulazioni, tutto o la sola simulazione richiesta per nome o md5
+            elif line.rstrip().upper()[:3] == 'PR9':
+
+                sim_library = self.tripod.kinematic.sim_library
+                key = line.strip()[4:]
+                if key:
+                    # Se il file e' cambiato la ricerca lo rilegge, quindi non avviene nel reattore
+                    d = threads.deferToThread(sim_library.find, key)
+                    d.addCallbacks(self.send_sim_entry, self.sim_library_find_failed)
+                else:
+                    with sim_library.lock:
+                        entries = sim_library.list_entries()
+                    self.transport.write("OK PR9 {}\n".format(json.dumps({'simulations': entries}, sort_keys=True)))
+
+                    # La risposta viene dall'indice, che poi viene riallineato al disco in background
+                    threads.deferToThread(sim_library.refresh).addErrback(self.sim_library_refresh_failed)
+                return
+
             # Se era PR7, invio la simulazione memorizzata
             elif line.rstrip().upper()[:3] == 'PR4':
 
@@ -342,6 +402,27 @@ class ControlProtocol(LineReceiver):
             self.tripod.canopen.sendCommand(line, "remote")
             self.last_command = line.rstrip().upper()
 
+    def trajectories_to_text_failed(self, failure):
+
+        logging.error("Impossibile generare i file motore: {}".format(failure.getErrorMessage()))
+        self.sendLine("CERR CT4 0: Impossibile generare i file motore")
+
+    def send_sim_entry(self, entry):
+
+        if entry is None:
+            self.transport.write("CERR PR9 0: Simulation not found\n")
+        else:
+            self.transport.write("OK PR9 {}\n".format(json.dumps(entry, sort_keys=True)))
+
+    def sim_library_find_failed(self, failure):
+
+        logging.error("Impossibile cercare nell'indice delle simulazioni: {}".format(failure.getErrorMessage()))
+        self.transport.write("CERR PR9 1: {}\n".format(failure.getErrorMessage()))
+
+    def sim_library_refresh_failed(self, failure):
+
+        logging.error("Impossibile aggiornare l'indice delle simulazioni: {}".format(failure.getErrorMessage()))
+
     def is_number(self, s):
         try:
             float(s)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+
+class ConversionCache():
+    """Cache su disco delle simulazioni gia' convertite
+
+    Ogni conversione e' una directory in cache_path, il cui nome e' l'md5 del file di simulazione unito
+    all'impronta dei parametri di conversione: se cambia il file o la configurazione la chiave cambia, e non serve
+    invalidare nulla. La directory contiene i file motore ed il log di conversione; i file sono passati come
+    dizionario dal nome nella cache al percorso finale.
+
+    La data di modifica della directory viene aggiornata ad ogni uso, e quando la dimensione totale supera
+    max_bytes vengono rimosse le conversioni usate meno di recente. Con max_bytes nullo la cache e' disattivata.
+    """
+
+    def __init__(self, cache_path, max_bytes):
+
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+
+    def is_enabled(self):
+
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(sim_filename, params_hash):
+        """Chiave di una conversione, dall'md5 del contenuto del file e dall'impronta dei parametri"""
+
+        md5 = hashlib.md5()
+        with open(sim_filename, 'rb') as sim_file:
+            while True:
+                data = sim_file.read(1 << 20)
+                if not data:
+                    break
+                md5.update(data)
+
+        return ConversionCache.key_from_md5(md5.hexdigest(), params_hash)
+
+    @staticmethod
+    def key_from_md5(sim_md5, params_hash):
+        """Chiave di una conversione, quando l'md5 del file e' gia' noto"""
+
+        return "{}_{}".format(sim_md5, params_hash)
+
+    def contains(self, key, names):
+        """Indica se la conversione e' nella cache con tutti i file names"""
+
+        entry = os.path.join(self.cache_path, key)
+        return all(os.path.exists(os.path.join(entry, name)) for name in names)
+
+    def install(self, key, files):
+        """Copia i file della conversione nelle loro posizioni, restituisce False se la conversione non c'e'"""
+
+        entry = os.path.join(self.cache_path, key)
+        if not self.contains(key, files):
+            return False
+
+        for name, filename in files.items():
+            shutil.copyfile(os.path.join(entry, name), filename)
+            os.chmod(filename, 0666)
+        os.utime(entry, None)
+
+        logging.info("Conversione {} presa dalla cache".format(key))
+        return True
+
+    def store(self, key, files):
+        """Salva i file di una conversione appena terminata, ed elimina le piu' vecchie se serve spazio"""
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path, 0777)
+
+        # Copio in una directory temporanea, per non lasciare conversioni a meta' se vengo interrotto
+        entry = os.path.join(self.cache_path, key)
+        temp_entry = "{}.{}.tmp".format(entry, os.getpid())
+        if os.path.exists(temp_entry):
+            shutil.rmtree(temp_entry)
+        os.makedirs(temp_entry)
+        for name, filename in files.items():
+            shutil.copyfile(filename, os.path.join(temp_entry, name))
+
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(temp_entry, entry)
+
+        logging.info("Conversione {} salvata nella cache".format(key))
+        self.evict()
+
+    def evict(self):
+        """Elimina le conversioni usate meno di recente fino a rientrare in max_bytes"""
+
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.cache_path):
+            entry = os.path.join(self.cache_path, name)
+            if not os.path.isdir(entry) or name.endswith('.tmp'):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total_bytes += size
+
+        for mtime, size, entry in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            logging.info("Rimuovo dalla cache la conversione {} del {}".format(
+                os.path.basename(entry), time.ctime(mtime)))
+            shutil.rmtree(entry)
+            total_bytes -= size
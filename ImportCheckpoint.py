@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+
+
+class ImportAborted(Exception):
+    """Importazione interrotta su richiesta (CT7)"""
+
+    pass
+
+
+class ImportCheckpoint():
+    """Punto di ripresa dell'importazione di una simulazione
+
+    Durante la conversione, ogni SIM_CHECKPOINT_ROWS righe, il writer salva in filename lo stato raggiunto dopo aver
+    scritto su disco tutte le righe precedenti:
+
+        - identity: la simulazione (md5), i parametri della conversione, il formato ed i file di output
+        - la posizione nel file di simulazione, riga e byte
+        - lo stato della soppressione degli zeri e gli ultimi step, per il controllo della velocita'
+        - la dimensione raggiunta da ogni file di output
+
+    Una nuova importazione con la stessa identity riprende da li', troncando i file di output alla dimensione salvata.
+    Un solo punto di ripresa alla volta, quello dell'ultima importazione.
+    """
+
+    def __init__(self, filename, identity):
+
+        self.filename = filename
+        self.identity = identity
+
+    def load(self):
+        """Restituisce lo stato salvato se appartiene alla stessa importazione, altrimenti None"""
+
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except (IOError, ValueError) as e:
+            logging.error("Punto di ripresa {} non valido: {}".format(self.filename, e))
+            return None
+
+        # json restituisce stringhe unicode, le confronto con l'identita' passata da json
+        if state.get('identity') != json.loads(json.dumps(self.identity)):
+            return None
+
+        return state
+
+    def save(self, state):
+        """Salva lo stato in modo atomico, va chiamata solo dopo aver scritto su disco i file di output"""
+
+        state = dict(state)
+        state['identity'] = self.identity
+
+        checkpoint_path = os.path.dirname(self.filename)
+        if checkpoint_path and not os.path.exists(checkpoint_path):
+            os.makedirs(checkpoint_path, 0777)
+        temp_file = "{}.{}.tmp".format(self.filename, os.getpid())
+        with open(temp_file, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file, sort_keys=True)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temp_file, self.filename)
+
+    def remove(self):
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -5,12 +5,24 @@ import logging
 import time
 import subprocess
 import threading
-import csv
 import os
 import math
 import kinematic_cy
 import shutil
+import tempfile
 import ConfigParser
+import hashlib
+import multiprocessing
+import numpy as np
+import Config
+from SimLoader import SimLoader, SimFormatError
+from LimitReport import LimitReport
+from ConversionCache import ConversionCache
+from MotorTrajectory import MotorTrajectory
+from SimWriter import SimWriter
+from SimLibrary import SimLibrary
+from ImportCheckpoint import ImportCheckpoint, ImportAborted
+from collections import OrderedDict, deque
 
 
 class Kinematic():
@@ -67,6 +79,13 @@ class Kinematic():
     M_PI = 3.14159265358979323846
     M_TO_RAD = 0.0174532925199432957692
 
+    # Risolutore vettoriale: errore sulle distanze e numero massimo di iterazioni di Newton
+    NEWTON_ERR_LIMIT = 1e-10
+    NEWTON_CYCLE_LIMIT = 20
+
+    # Versione del formato dei file motore, entra nella chiave della cache delle conversioni
+    SIM_FORMAT_VERSION = 1
+
     def __init__(self, tripod=None):
 
         if tripod is None:
@@ -86,12 +105,47 @@ class Kinematic():
         self.ke = ini.getint('Kinematic', 'ke')
         self.err_limit = ini.getfloat('Kinematic', 'err_limit')
         self.cycle_limit = ini.getint('Kinematic', 'cycle_limit')
+        if ini.has_option('Kinematic', 'dk_method'):
+            self.dk_method = ini.get('Kinematic', 'dk_method')
+        else:
+            self.dk_method = 'search'
+        if ini.has_option('Kinematic', 'ik_method'):
+            self.ik_method = ini.get('Kinematic', 'ik_method')
+        else:
+            self.ik_method = 'fixed_point'
+        if ini.has_option('Kinematic', 'ik_table'):
+            self.use_ik_table = ini.getboolean('Kinematic', 'ik_table')
+        else:
+            self.use_ik_table = False
+        if ini.has_option('Kinematic', 'ik_table_step'):
+            self.ik_table_step = ini.getfloat('Kinematic', 'ik_table_step')
+        else:
+            self.ik_table_step = 0.1
+        if ini.has_option('Kinematic', 'ik_table_range'):
+            self.ik_table_range = ini.getfloat('Kinematic', 'ik_table_range')
+        else:
+            self.ik_table_range = 30.0
+        if ini.has_option('Kinematic', 'dk_cache_size'):
+            self.dk_cache_size = ini.getint('Kinematic', 'dk_cache_size')
+        else:
+            self.dk_cache_size = 1024
+        # Compattazione delle traiettorie, disattivata se manca compact_tolerance (in step)
+        if ini.has_option('Kinematic', 'compact_tolerance'):
+            self.compact_tolerance = ini.getfloat('Kinematic', 'compact_tolerance')
+        else:
+            self.compact_tolerance = None
+        if ini.has_option('Kinematic', 'compact_max_time'):
+            self.compact_max_time = ini.getint('Kinematic', 'compact_max_time')
+        else:
+            self.compact_max_time = 1000
         self.step_per_turn = ini.getint('Motors', 'step_per_turn')
         self.mt_per_turn = ini.getfloat('Motors', 'mt_per_turn')
         self.rot_reduction = ini.getint('Motors', 'rot_reduction')
 
-        # Inizializza la cinematica citonica
-        kinematic_cy.init()
+        # Inizializza la cinematica citonica, un risolutore per lo stream delle posizioni ed uno per calc_ik, in
+        # modo che non si rovinino a vicenda il punto di partenza della ricerca
+        self.solver = self.new_solver()
+        self.ik_solver = self.new_solver()
 
         # Copia il riferimento al padre
         self.tripod = tripod
@@ -166,6 +220,54 @@ class Kinematic():
         self.last_conversion_steps = [0, 0, 0, 0]
         self.last_conversion_positions = [0, 0, 0, 0]
 
+        # Cache LRU della cinematica diretta dello stream delle posizioni, indicizzata dagli step dei motori
+        self.dk_cache = OrderedDict()
+        self.dk_cache_hits = 0
+        self.dk_cache_misses = 0
+
+        if tripod is None:
+            config = Config.Config()
+        else:
+            config = tripod.config
+
+        # Tabella precalcolata della cinematica inversa, legata alla geometria del file di configurazione
+        self.geometry_md5 = Kinematic.geometry_hash(ini)
+        self.ik_table = None
+        self.ik_table_path = config.CACHE_PATH
+        self.ik_table_thread = None
+        if self.use_ik_table:
+            # La verifica dei punti della tabella richiede la precisione del metodo di Newton: la ricerca a passi si
+            # ferma ad err_limit, troppo lontano dalla tolleranza di calc_ik
+            self.ik_table_solver = self.new_solver('newton')
+
+            # Una tabella gia' costruita viene solo mappata in memoria; la costruzione richiede invece secondi (la
+            # griglia di default e' 601x601), e avviene in un thread: nel frattempo calc_ik usa il metodo iterativo
+            if os.path.exists(self.ik_table_filename()):
+                self.ik_table = self.load_ik_table(self.ik_table_path)
+            else:
+                self.ik_table_thread = threading.Thread(target=self.build_ik_table_background, name='IkTable')
+                self.ik_table_thread.daemon = True
+                self.ik_table_thread.start()
+
+        # Cache delle simulazioni convertite, legata a tutti i parametri che cambiano i file motore
+        self.conversion_md5 = Kinematic.geometry_hash(
+            ini, ('Dimensions', 'Kinematic', 'Motors', 'Speed'), Kinematic.SIM_FORMAT_VERSION
+        )
+        self.conversion_cache = ConversionCache(config.CONVERSION_CACHE_PATH, config.CONVERSION_CACHE_SIZE)
+
+        # Indice delle simulazioni, per nome e per md5
+        self.sim_library = SimLibrary(config.SIM_PATH, config.CACHE_PATH + 'sim_library.json',
+                                      config.SIM_BLOCK_BYTES)
+
+        # Richiesta di interruzione dell'importazione in corso (CT7), condivisa con il processo di importazione
+        self.import_abort = multiprocessing.Event()
+
+        # Nel processo di importazione gli eventi per il tripode passano da questa pipe invece che dal reattore
+        self.import_pipe = None
+
+        # Simulazione controllata dall'ultimo CT3, da convertire durante la riproduzione (SIM_STREAMING)
+        self.stream_file = None
+
     def distance_12(self, alphas, motor_positions):
         """Calcolo della distanta tra i centri sfera dei pistoni 1 e 2
 
@@ -410,6 +512,90 @@ class Kinematic():
                     # Next i!!!
                     break
 
+    def search_base_angles_newton(self, motor_positions):
+        """Calcola la cinematica diretta del tripode con il metodo di Newton-Raphson
+
+        Alternativa a search_base_angles: invece di incrementare gli angoli a passi fissi, risolve le tre equazioni
+        distance_12/23/13 = base_length usando lo jacobiano analitico dei quadrati delle distanze. Il numero di
+        iterazioni eseguite viene salvato in self.cycles.
+
+        motor_positions:
+            - 0: motore 120, posizione in metri di altezza dalla colonna anteriore
+            - 1: motore 121, posizione in metri di altezza dalla colonna posteriore sinistra
+            - 2: motore 122, posizione in metri di altezza dalla colonna posteriore destra
+            - 3: motore 119, posizione in radianti del giunto rotativo
+
+        """
+
+        # Se gia' eseguita una conversione parto dai valori precedenti, altrimenti dal piano orizzontale
+        if self.isLastAnglesValid:
+            alpha = list(self.alpha)
+        else:
+            alpha = [0.0, 0.0, 0.0]
+
+        # Altezze reali degli attuatori
+        height = [self.real_height + motor_positions[0],
+                  self.real_height + motor_positions[1],
+                  self.real_height + motor_positions[2]]
+
+        base_length_2 = self.base_length ** 2
+        self.cycles = 0
+
+        while True:
+
+            # Le funzioni delle distanze aggiornano anche i vertici del tetto
+            e12 = self.distance_12(alpha, height) ** 2 - base_length_2
+            e23 = self.distance_23(alpha, height) ** 2 - base_length_2
+            e13 = self.distance_13(alpha, height) ** 2 - base_length_2
+
+            err = max(abs(e12), abs(e23), abs(e13)) / (2 * self.base_length)
+            if err < Kinematic.NEWTON_ERR_LIMIT or self.cycles == Kinematic.NEWTON_CYCLE_LIMIT:
+                break
+
+            self.cycles += 1
+
+            # Derivate dei vertici rispetto al proprio angolo
+            c = [height[0] * math.cos(alpha[0]), height[1] * math.cos(alpha[1]), height[2] * math.cos(alpha[2])]
+            dx0 = c[0]
+            dz0 = -height[0] * math.sin(alpha[0])
+            dx1 = -c[1] * 0.5
+            dy1 = -c[1] * 0.8660254037844386
+            dz1 = -height[1] * math.sin(alpha[1])
+            dx2 = -c[2] * 0.5
+            dy2 = c[2] * 0.8660254037844386
+            dz2 = -height[2] * math.sin(alpha[2])
+
+            x = self.roof_vertex_x
+            y = self.roof_vertex_y
+            z = self.roof_vertex_z
+
+            # Lo jacobiano ha sempre la forma
+            #   | a  b  0 |
+            #   | 0  c  d |
+            #   | e  0  f |
+            ja = 2 * ((x[0] - x[1]) * dx0 + (z[0] - z[1]) * dz0)
+            jb = 2 * ((x[1] - x[0]) * dx1 + y[1] * dy1 + (z[1] - z[0]) * dz1)
+            jc = 2 * ((x[1] - x[2]) * dx1 + (y[1] - y[2]) * dy1 + (z[1] - z[2]) * dz1)
+            jd = 2 * ((x[2] - x[1]) * dx2 + (y[2] - y[1]) * dy2 + (z[2] - z[1]) * dz2)
+            je = 2 * ((x[0] - x[2]) * dx0 + (z[0] - z[2]) * dz0)
+            jf = 2 * ((x[2] - x[0]) * dx2 + y[2] * dy2 + (z[2] - z[0]) * dz2)
+            det = ja * jc * jf + jb * jd * je
+
+            if abs(det) < 1e-300:
+                break
+
+            # Regola di Cramer per J * delta = -err
+            alpha[0] -= (e12 * jc * jf - jb * e23 * jf + jb * jd * e13) / det
+            alpha[1] -= (ja * e23 * jf - ja * jd * e13 + e12 * jd * je) / det
+            alpha[2] -= (ja * jc * e13 + jb * e23 * je - e12 * jc * je) / det
+
+        if err >= self.err_limit or any([abs(a) > -self.alpha_limit_r for a in alpha]):
+            logging.error("Maximum number of cycles executed, no solution found!")
+            return False
+
+        self.alpha = list(alpha)
+        return True
+
     def find_plane_angles(self, roof_motor_position):
         """Determina gli angoli di un piano passante per tre punti
 
@@ -588,7 +774,12 @@ class Kinematic():
         """Determina gli angoli di zyx3, zyx2 e zyx1 date le altezze dei pistoni relative a 1.685mt"""
 
         # Valuto il tempo necessario alla trasformazione
-        if self.search_base_angles(motor_positions):
+        if self.dk_method == 'newton':
+            is_found = self.search_base_angles_newton(motor_positions)
+        else:
+            is_found = self.search_base_angles(motor_positions)
+
+        if is_found:
             self.find_plane_angles(motor_positions[3])
             # logging.debug("Input: [{:+09.6f}, {:+09.6f}, {:+09.6f}, {:+09.6f}], "
             #              "Position: [{:+06.2f}, {:+06.2f}, {:+06.2f}], "
@@ -614,9 +805,25 @@ class Kinematic():
             self.isLastAnglesValid = False
             return False
 
-    def find_solution_fast(self, motor_positions):
+    def new_solver(self, method=None):
+        """Crea un risolutore citonico della cinematica diretta con la geometria del file di configurazione
+
+        Ogni thread che usa la cinematica diretta deve avere il proprio risolutore. Il metodo e' dk_method se non
+        specificato.
+        """
+
+        if method is None:
+            method = self.dk_method
+
+        return kinematic_cy.Solver(self.base_radius, self.real_height, self.alpha_limit, self.ke, self.err_limit,
+                                   self.cycle_limit, method)
+
+    def find_solution_fast(self, motor_positions, solver=None):
+
+        if solver is None:
+            solver = self.solver
 
-        res = kinematic_cy.search_angles(motor_positions)
+        res = solver.search_angles(motor_positions)
         if res[0] == 0:
             self.zyx3 = res[1]
             self.zyx2 = res[2]
@@ -650,6 +857,60 @@ class Kinematic():
             self.cycles = 0.0
             return False
 
+    def find_solution_cached(self, motor_steps):
+        """Come find_solution_fast, ma partendo dagli step dei motori 120, 121, 122 e 119 e con una cache LRU
+
+        A tavola ferma gli step non cambiano per minuti, e la soluzione viene presa dalla cache senza risolvere di
+        nuovo la cinematica diretta. Le posizioni senza soluzione non vengono memorizzate.
+        """
+
+        motor_steps = tuple(motor_steps)
+        angles = self.dk_cache.pop(motor_steps, None)
+        if angles is not None:
+            self.dk_cache_hits += 1
+            self.dk_cache[motor_steps] = angles
+            (self.zyx3, self.zyx2, self.zyx1, self.zyx3_r, self.zyx2_r, self.zyx1_r,
+             self.xyz1, self.xyz2, self.xyz3, self.xyz1_r, self.xyz2_r, self.xyz3_r) = angles
+            self.cycles = 0
+            return True
+
+        self.dk_cache_misses += 1
+        if not self.find_solution_fast([
+            -float(motor_steps[0]) / self.mt_to_step,
+            -float(motor_steps[1]) / self.mt_to_step,
+            -float(motor_steps[2]) / self.mt_to_step,
+            float(motor_steps[3]) / self.radians_to_step
+        ]):
+            return False
+
+        self.dk_cache[motor_steps] = (self.zyx3, self.zyx2, self.zyx1, self.zyx3_r, self.zyx2_r, self.zyx1_r,
+                                      self.xyz1, self.xyz2, self.xyz3, self.xyz1_r, self.xyz2_r, self.xyz3_r)
+        if len(self.dk_cache) > self.dk_cache_size:
+            self.dk_cache.popitem(last=False)
+        return True
+
+    def find_solution_batch(self, motor_positions, solver=None):
+        """Versione di find_solution_fast per un blocco di posizioni
+
+        motor_positions e' un array (N, 4) con le colonne nello stesso ordine di find_solution_fast. Il calcolo
+        avviene in kinematic_cy senza GIL, quindi puo' essere eseguito in un thread senza bloccare il reattore.
+        Se non viene passato un risolutore ne viene creato uno nuovo, per non disturbare quello dello stream.
+
+        Restituisce un array (N, 4) con zyx3, zyx2, zyx1 in gradi ed i cicli usati; le righe senza soluzione hanno
+        gli angoli a NaN.
+        """
+
+        motor_positions = np.ascontiguousarray(motor_positions, dtype=np.float64)
+        angles = np.empty((motor_positions.shape[0], 4))
+        if solver is None:
+            solver = self.new_solver()
+
+        failed = solver.search_angles_batch(motor_positions, angles)
+        if failed:
+            logging.error("No solution found for {} of {} positions".format(failed, motor_positions.shape[0]))
+
+        return angles
+
     def calc_ik(self, zyx3, zyx2, zyx1):
         """Prende gli angoli in ingresso e restituisce la posizione degli attuatori necessaria a raggiungerli.
 
@@ -660,8 +921,14 @@ class Kinematic():
             - 1: motore 121, posizione in metri di altezza dalla colonna posteriore sinistra
             - 2: motore 122, posizione in metri di altezza dalla colonna posteriore destra
             - 3: motore 119, posizione in radianti del giunto rotativo
+
+        Il punto singolo usa sempre il punto fisso, anche con ik_method 'newton': il metodo di Newton conviene solo
+        su interi vettori (calc_ik_batch_newton), mentre qui il tempo dipende dalla cinematica diretta (dk_method).
         """
 
+        if self.ik_table is not None and self.calc_ik_table(zyx3, zyx2, zyx1):
+            return True
+
         # Conto i cicli spesi
         cycles_used = 0
 
@@ -698,7 +965,7 @@ class Kinematic():
             motor_positions[3] = angles_r_search[2]
 
             # Uso le altezze per calcolarmi, usando la dk, i valori reali che otterrei
-            self.find_solution_fast(motor_positions)
+            self.find_solution_fast(motor_positions, self.ik_solver)
             cycles_used += self.cycles
 
             # Calcolo l'errore tra gli angoli desiderati, e quelli ottenuti dalla dk
@@ -742,6 +1009,617 @@ class Kinematic():
         self.last_conversion_positions = list(motor_positions)
         return True
 
+    def ik_table_position(self, zyx3, zyx2, zyx1):
+        """Versione scalare di ik_table_positions_batch, restituisce None fuori dalla tabella"""
+
+        size = self.ik_table.shape[0]
+        u = (zyx3 + self.ik_table_range) / self.ik_table_step
+        v = (zyx2 + self.ik_table_range) / self.ik_table_step
+        if not (0 <= u <= size - 1 and 0 <= v <= size - 1):
+            return None
+
+        i = min(int(u), size - 2)
+        j = min(int(v), size - 2)
+        fu = u - i
+        fv = v - j
+        cell = self.ik_table[i:i + 2, j:j + 2]
+        positions = ((cell[0, 0] * (1 - fv) + cell[0, 1] * fv) * (1 - fu) +
+                     (cell[1, 0] * (1 - fv) + cell[1, 1] * fv) * fu).tolist()
+        if any(math.isnan(position) for position in positions):
+            return None
+        positions[3] += zyx1 * Kinematic.M_TO_RAD
+
+        return positions
+
+    def calc_ik_table(self, zyx3, zyx2, zyx1):
+        """Come calc_ik_batch_table per un singolo punto, restituisce False se serve il metodo iterativo"""
+
+        angles_r = [zyx3 * Kinematic.M_TO_RAD, zyx2 * Kinematic.M_TO_RAD, zyx1 * Kinematic.M_TO_RAD]
+        angles = [zyx3, zyx2, zyx1]
+        search_limit = 0.0001 / 180.0 * Kinematic.M_PI
+        cycles_used = 0
+
+        for i in range(0, 2):
+
+            motor_positions = self.ik_table_position(angles[0], angles[1], angles[2])
+            if motor_positions is None or not self.find_solution_fast(motor_positions, self.ik_table_solver):
+                return False
+            cycles_used += self.cycles
+
+            err = [angles_r[0] - self.zyx3_r, angles_r[1] - self.zyx2_r, angles_r[2] - self.zyx1_r]
+            if max(math.fabs(err[0]), math.fabs(err[1]), math.fabs(err[2])) < search_limit:
+                self.cycles = cycles_used
+                self.icycles = i
+                self.ierr0 = err[0]
+                self.ierr1 = err[1]
+                self.ierr2 = err[2]
+                self.last_conversion_positions = motor_positions
+                return True
+
+            # Correggo gli angoli di ricerca dell'errore trovato
+            angles = [angles[0] + err[0] / Kinematic.M_TO_RAD,
+                      angles[1] + err[1] / Kinematic.M_TO_RAD,
+                      angles[2] + err[2] / Kinematic.M_TO_RAD]
+
+        return False
+
+    def search_base_angles_batch(self, motor_positions, alphas=None):
+        """Calcola la cinematica diretta su un vettore di posizioni
+
+        E' la versione vettoriale di search_base_angles: invece di incrementare gli angoli a passi fissi, risolve le
+        tre equazioni delle distanze (distance_12/23/13) con il metodo di Newton-Raphson, su tutte le righe insieme.
+
+        motor_positions: array (N, 3) con le posizioni in metri dei motori 120, 121 e 122
+        alphas: array (N, 3) con gli angoli di partenza, se non specificato parte dal piano orizzontale
+
+        Restituisce gli angoli alla base (N, 3), i vertici del tetto [x, y, z] ognuno di dimensione (N, 3) ed un
+        vettore di booleani che indica le righe per cui e' stata trovata una soluzione.
+        """
+
+        height = np.asarray(motor_positions, dtype=float) + self.real_height
+        if alphas is None:
+            alphas = np.zeros_like(height)
+        else:
+            alphas = np.array(alphas, dtype=float)
+
+        cos30 = 0.8660254037844386
+        base_length_2 = self.base_length ** 2
+
+        for i in range(Kinematic.NEWTON_CYCLE_LIMIT + 1):
+
+            sin_a = np.sin(alphas)
+            cos_a = np.cos(alphas)
+            hs = height * sin_a
+            hc = height * cos_a
+
+            # Vertici del tetto, come in distance_12/23/13
+            x0 = hs[:, 0]
+            z0 = hc[:, 0]
+            x1 = self.base_height - hs[:, 1] * 0.5
+            y1 = self.base_length / 2 - hs[:, 1] * cos30
+            z1 = hc[:, 1]
+            x2 = self.base_height - hs[:, 2] * 0.5
+            y2 = -self.base_length / 2 + hs[:, 2] * cos30
+            z2 = hc[:, 2]
+
+            # Errore sui quadrati delle distanze
+            e12 = (x1 - x0) ** 2 + y1 ** 2 + (z1 - z0) ** 2 - base_length_2
+            e23 = (x2 - x1) ** 2 + (y2 - y1) ** 2 + (z2 - z1) ** 2 - base_length_2
+            e13 = (x2 - x0) ** 2 + y2 ** 2 + (z2 - z0) ** 2 - base_length_2
+
+            err = np.maximum(np.maximum(np.abs(e12), np.abs(e23)), np.abs(e13)) / (2 * self.base_length)
+            if i == Kinematic.NEWTON_CYCLE_LIMIT or np.all(err < Kinematic.NEWTON_ERR_LIMIT):
+                break
+
+            # Derivate dei vertici rispetto al proprio angolo
+            dx0 = hc[:, 0]
+            dz0 = -hs[:, 0]
+            dx1 = -hc[:, 1] * 0.5
+            dy1 = -hc[:, 1] * cos30
+            dz1 = -hs[:, 1]
+            dx2 = -hc[:, 2] * 0.5
+            dy2 = hc[:, 2] * cos30
+            dz2 = -hs[:, 2]
+
+            # Lo jacobiano ha sempre la forma
+            #   | a  b  0 |
+            #   | 0  c  d |
+            #   | e  0  f |
+            a = 2 * ((x0 - x1) * dx0 + (z0 - z1) * dz0)
+            b = 2 * ((x1 - x0) * dx1 + y1 * dy1 + (z1 - z0) * dz1)
+            c = 2 * ((x1 - x2) * dx1 + (y1 - y2) * dy1 + (z1 - z2) * dz1)
+            d = 2 * ((x2 - x1) * dx2 + (y2 - y1) * dy2 + (z2 - z1) * dz2)
+            e = 2 * ((x0 - x2) * dx0 + (z0 - z2) * dz0)
+            f = 2 * ((x2 - x0) * dx2 + y2 * dy2 + (z2 - z0) * dz2)
+            det = a * c * f + b * d * e
+
+            # Le righe singolari non vengono aggiornate
+            singular = np.abs(det) < 1e-300
+            det[singular] = 1.0
+            e12[singular] = 0.0
+            e23[singular] = 0.0
+            e13[singular] = 0.0
+
+            # Regola di Cramer per J * delta = -err
+            alphas[:, 0] -= (e12 * c * f - b * e23 * f + b * d * e13) / det
+            alphas[:, 1] -= (a * e23 * f - a * d * e13 + e12 * d * e) / det
+            alphas[:, 2] -= (a * c * e13 + b * e23 * e - e12 * c * e) / det
+
+        is_valid = (err < self.err_limit) & np.all(np.abs(alphas) < -self.alpha_limit_r, axis=1)
+
+        roof = [np.column_stack((x0, x1, x2)),
+                np.column_stack((np.zeros_like(y1), y1, y2)),
+                np.column_stack((z0, z1, z2))]
+
+        return alphas, roof, is_valid
+
+    @staticmethod
+    def find_plane_angles_batch(roof, roof_motor_position):
+        """Versione vettoriale di find_plane_angles
+
+        Restituisce un array (N, 3) con zyx3_r, zyx2_r e zyx1_r.
+        """
+
+        x, y, z = roof
+
+        # Vettori dal punto mediano tra i vertici 2 e 3 ai vertici 1 e 2
+        b0x = x[:, 0] - (x[:, 1] + x[:, 2]) / 2
+        b0y = y[:, 0] - (y[:, 1] + y[:, 2]) / 2
+        b0z = z[:, 0] - (z[:, 1] + z[:, 2]) / 2
+        b1x = (x[:, 1] - x[:, 2]) / 2
+        b1y = (y[:, 1] - y[:, 2]) / 2
+        b1z = (z[:, 1] - z[:, 2]) / 2
+
+        mr0 = np.sqrt(b0x ** 2 + b0y ** 2 + b0z ** 2)
+        mr1 = np.sqrt(b1x ** 2 + b1y ** 2 + b1z ** 2)
+
+        zyx2_r = np.arcsin(b0z / mr0)
+        c2 = np.cos(zyx2_r)
+        zyx1_r = np.arcsin(b0y / mr0 / c2) + roof_motor_position
+        zyx3_r = np.arcsin(b1z / mr1 / c2)
+
+        return np.column_stack((zyx3_r, zyx2_r, zyx1_r))
+
+    def ik_guess_batch(self, angles_r_search):
+        """Funzione chiusa ed approssimata di calc_ik, su un array (N, 3) di angoli in radianti"""
+
+        dd1 = self.base_height * np.sin(angles_r_search[:, 1])
+        d23 = self.base_length * np.sin(angles_r_search[:, 0])
+        positions = np.empty((angles_r_search.shape[0], 4))
+        positions[:, 0] = dd1 / 2
+        positions[:, 2] = -dd1 - 0.5 * d23 + positions[:, 0]
+        positions[:, 1] = positions[:, 2] + d23
+        positions[:, 3] = angles_r_search[:, 2]
+
+        return positions
+
+    def calc_ik_batch(self, zyx3, zyx2, zyx1, use_table=True):
+        """Versione vettoriale di calc_ik per un'intera traiettoria
+
+        Gli angoli in ingresso sono array di uguale lunghezza, in gradi. Restituisce:
+
+            - un array (N, 4) con le posizioni dei motori nello stesso ordine di calc_ik
+            - un array di booleani con le righe per cui la ricerca e' andata a buon fine
+            - un array (N, 3) con l'errore residuo in radianti su zyx3, zyx2 e zyx1
+            - un array con il numero di iterazioni usate da ogni riga
+
+        Ogni riga segue lo stesso procedimento di calc_ik, ma la cinematica diretta viene risolta su tutte le righe
+        ancora da convergere con un'unica chiamata a search_base_angles_batch.
+
+        Se e' caricata la tabella della cinematica inversa, e use_table e' vero, si parte da questa.
+        """
+
+        if use_table and self.ik_table is not None:
+            return self.calc_ik_batch_table(zyx3, zyx2, zyx1)
+        if self.ik_method == 'newton':
+            return self.calc_ik_batch_newton(zyx3, zyx2, zyx1)
+
+        angles_r = np.column_stack((np.asarray(zyx3, dtype=float),
+                                    np.asarray(zyx2, dtype=float),
+                                    np.asarray(zyx1, dtype=float))) * Kinematic.M_TO_RAD
+        rows = angles_r.shape[0]
+
+        angles_r_search = angles_r.copy()
+        motor_positions = np.zeros((rows, 4))
+        alphas = np.zeros((rows, 3))
+        err = np.zeros((rows, 3))
+        is_converged = np.zeros(rows, dtype=bool)
+        cycles = np.zeros(rows, dtype=int)
+
+        search_limit = 0.0001 / 180.0 * Kinematic.M_PI
+        cycle_limit = 100
+
+        # Righe ancora da risolvere
+        todo = np.arange(rows)
+
+        for i in range(0, cycle_limit):
+
+            if todo.size == 0:
+                break
+
+            positions = self.ik_guess_batch(angles_r_search[todo])
+
+            # Cinematica diretta, partendo dagli angoli trovati al giro precedente
+            alphas_found, roof, is_valid = self.search_base_angles_batch(positions[:, :3], alphas[todo])
+            angles_found = Kinematic.find_plane_angles_batch(roof, positions[:, 3])
+
+            motor_positions[todo] = positions
+            alphas[todo] = alphas_found
+            err[todo] = angles_r[todo] - angles_found
+            cycles[todo] = i
+
+            is_done = is_valid & np.all(np.abs(err[todo]) < search_limit, axis=1)
+            is_converged[todo[is_done]] = True
+
+            # Le righe senza soluzione nella cinematica diretta vengono abbandonate
+            todo = todo[is_valid & ~is_done]
+            angles_r_search[todo] += err[todo]
+
+        return motor_positions, is_converged, err, cycles
+
+    def plane_angles_derivative_batch(self, motor_positions, alphas, roof, d_positions):
+        """Derivata direzionale della cinematica diretta
+
+        Dato lo stato trovato da search_base_angles_batch (alphas e roof) per le posizioni motor_positions (N, 3),
+        calcola di quanto variano zyx3_r, zyx2_r e la parte di zyx1_r dovuta al tetto quando le posizioni dei motori
+        variano di d_positions (N, 3).
+
+        Gli angoli alla base sono legati alle altezze dalle equazioni delle distanze F(alpha, h) = 0, per cui
+        dalla loro derivata si ricava d_alpha = -F_alpha^-1 * F_h * d_h, e da questo la variazione dei vertici e
+        degli angoli del piano, senza eseguire altre ricerche.
+
+        Restituisce un array (N, 3).
+        """
+
+        cos30 = 0.8660254037844386
+
+        height = np.asarray(motor_positions, dtype=float) + self.real_height
+        sin_a = np.sin(alphas)
+        cos_a = np.cos(alphas)
+        x, y, z = roof
+
+        # Derivata dei vertici rispetto alla propria altezza, moltiplicata per la variazione di altezza
+        ux = np.column_stack((sin_a[:, 0], -sin_a[:, 1] * 0.5, -sin_a[:, 2] * 0.5)) * d_positions
+        uy = np.column_stack((np.zeros_like(sin_a[:, 0]), -sin_a[:, 1] * cos30, sin_a[:, 2] * cos30)) * d_positions
+        uz = cos_a * d_positions
+
+        # Derivata dei vertici rispetto al proprio angolo
+        tx = np.column_stack((cos_a[:, 0], -cos_a[:, 1] * 0.5, -cos_a[:, 2] * 0.5)) * height
+        ty = np.column_stack((np.zeros_like(cos_a[:, 0]), -cos_a[:, 1] * cos30, cos_a[:, 2] * cos30)) * height
+        tz = -sin_a * height
+
+        def edge(i, j, vx, vy, vz):
+            # Derivata del quadrato della distanza tra i vertici i e j per uno spostamento (vx, vy, vz)
+            return 2 * ((x[:, j] - x[:, i]) * (vx[:, j] - vx[:, i]) +
+                        (y[:, j] - y[:, i]) * (vy[:, j] - vy[:, i]) +
+                        (z[:, j] - z[:, i]) * (vz[:, j] - vz[:, i]))
+
+        def edge_alpha(i, j):
+            # Derivata del quadrato della distanza tra i vertici i e j rispetto all'angolo del vertice j
+            return 2 * ((x[:, j] - x[:, i]) * tx[:, j] + (y[:, j] - y[:, i]) * ty[:, j] + (z[:, j] - z[:, i]) * tz[:, j])
+
+        # Stesso jacobiano di search_base_angles_batch
+        #   | a  b  0 |
+        #   | 0  c  d |
+        #   | e  0  f |
+        a = edge_alpha(1, 0)
+        b = edge_alpha(0, 1)
+        c = edge_alpha(2, 1)
+        d = edge_alpha(1, 2)
+        e = edge_alpha(2, 0)
+        f = edge_alpha(0, 2)
+        det = a * c * f + b * d * e
+
+        r12 = edge(0, 1, ux, uy, uz)
+        r23 = edge(1, 2, ux, uy, uz)
+        r13 = edge(0, 2, ux, uy, uz)
+
+        d_alphas = np.column_stack((-(r12 * c * f - b * r23 * f + b * d * r13) / det,
+                                    -(a * r23 * f - a * d * r13 + r12 * d * e) / det,
+                                    -(a * c * r13 + b * r23 * e - r12 * c * e) / det))
+
+        dx = ux + tx * d_alphas
+        dy = uy + ty * d_alphas
+        dz = uz + tz * d_alphas
+
+        # Vettori usati da find_plane_angles_batch e loro variazione
+        b0 = [x[:, 0] - (x[:, 1] + x[:, 2]) / 2, y[:, 0] - (y[:, 1] + y[:, 2]) / 2, z[:, 0] - (z[:, 1] + z[:, 2]) / 2]
+        db0 = [dx[:, 0] - (dx[:, 1] + dx[:, 2]) / 2, dy[:, 0] - (dy[:, 1] + dy[:, 2]) / 2,
+               dz[:, 0] - (dz[:, 1] + dz[:, 2]) / 2]
+        b1 = [(x[:, 1] - x[:, 2]) / 2, (y[:, 1] - y[:, 2]) / 2, (z[:, 1] - z[:, 2]) / 2]
+        db1 = [(dx[:, 1] - dx[:, 2]) / 2, (dy[:, 1] - dy[:, 2]) / 2, (dz[:, 1] - dz[:, 2]) / 2]
+
+        mr0 = np.sqrt(b0[0] ** 2 + b0[1] ** 2 + b0[2] ** 2)
+        mr1 = np.sqrt(b1[0] ** 2 + b1[1] ** 2 + b1[2] ** 2)
+        dmr0 = (b0[0] * db0[0] + b0[1] * db0[1] + b0[2] * db0[2]) / mr0
+        dmr1 = (b1[0] * db1[0] + b1[1] * db1[1] + b1[2] * db1[2]) / mr1
+
+        # zyx2_r = asin(b0z / mr0)
+        k17 = b0[2] / mr0
+        dk17 = (db0[2] - k17 * dmr0) / mr0
+        c2 = np.sqrt(1 - k17 ** 2)
+        d_zyx2 = dk17 / c2
+        dc2 = -k17 * d_zyx2
+
+        # zyx3_r = asin(b1z / mr1 / c2)
+        l17 = b1[2] / mr1
+        dl17 = (db1[2] - l17 * dmr1) / mr1
+        i25 = l17 / c2
+        d_zyx3 = (dl17 * c2 - l17 * dc2) / c2 ** 2 / np.sqrt(1 - i25 ** 2)
+
+        # zyx1_r = asin(b0y / mr0 / c2) + rotazione del giunto
+        k16 = b0[1] / mr0
+        dk16 = (db0[1] - k16 * dmr0) / mr0
+        i24 = k16 / c2
+        d_zyx1 = (dk16 * c2 - k16 * dc2) / c2 ** 2 / np.sqrt(1 - i24 ** 2)
+
+        return np.column_stack((d_zyx3, d_zyx2, d_zyx1))
+
+    def calc_ik_batch_newton(self, zyx3, zyx2, zyx1):
+        """Cinematica inversa con il metodo di Newton smorzato
+
+        Stessi ingressi ed uscite di calc_ik_batch. Le altezze vengono sempre ricavate dalla funzione chiusa di
+        calc_ik, ma gli angoli di ricerca vengono corretti con lo jacobiano analitico della cinematica diretta
+        (plane_angles_derivative_batch) invece che sommando l'errore: bastano in genere due o tre valutazioni della
+        cinematica diretta per riga. Se un passo peggiora l'errore viene dimezzato.
+        """
+
+        angles_r = np.column_stack((np.asarray(zyx3, dtype=float),
+                                    np.asarray(zyx2, dtype=float),
+                                    np.asarray(zyx1, dtype=float))) * Kinematic.M_TO_RAD
+        rows = angles_r.shape[0]
+
+        angles_r_search = angles_r.copy()
+        motor_positions = np.zeros((rows, 4))
+        alphas = np.zeros((rows, 3))
+        err = np.zeros((rows, 3))
+        is_converged = np.zeros(rows, dtype=bool)
+        cycles = np.zeros(rows, dtype=int)
+
+        # Ultimo passo eseguito ed errore ottenuto prima del passo
+        last_step = np.zeros((rows, 3))
+        last_err = np.full(rows, np.inf)
+
+        search_limit = 0.0001 / 180.0 * Kinematic.M_PI
+        cycle_limit = 20
+
+        # Righe ancora da risolvere
+        todo = np.arange(rows)
+
+        for i in range(0, cycle_limit):
+
+            if todo.size == 0:
+                break
+
+            positions = self.ik_guess_batch(angles_r_search[todo])
+
+            # Cinematica diretta, partendo dagli angoli trovati al giro precedente
+            alphas_found, roof, is_valid = self.search_base_angles_batch(positions[:, :3], alphas[todo])
+            angles_found = Kinematic.find_plane_angles_batch(roof, positions[:, 3])
+            row_err = angles_r[todo] - angles_found
+            row_norm = np.max(np.abs(row_err), axis=1)
+
+            # Se il passo ha peggiorato l'errore, o portato fuori dalle soluzioni, torno indietro di meta' passo
+            has_last = np.isfinite(last_err[todo])
+            is_worse = has_last & (~is_valid | (row_norm > last_err[todo]))
+            if np.any(is_worse):
+                back = todo[is_worse]
+                last_step[back] /= 2
+                angles_r_search[back] -= last_step[back]
+                cycles[back] = i
+
+            is_better = is_valid & ~is_worse
+            better = todo[is_better]
+            motor_positions[better] = positions[is_better]
+            alphas[better] = alphas_found[is_better]
+            err[better] = row_err[is_better]
+            last_err[better] = row_norm[is_better]
+            cycles[better] = i
+
+            is_done = is_better & np.all(np.abs(row_err) < search_limit, axis=1)
+            is_converged[todo[is_done]] = True
+
+            # Passo di Newton sulle righe da correggere
+            is_step = is_better & ~is_done
+            step = todo[is_step]
+            todo = todo[is_worse | is_step]
+            if step.size == 0:
+                continue
+
+            heights = positions[is_step, :3]
+            roof = [v[is_step] for v in roof]
+
+            # Variazione delle posizioni per una variazione unitaria dei due angoli di ricerca
+            cos0 = np.cos(angles_r_search[step, 0]) * self.base_length / 2
+            cos1 = np.cos(angles_r_search[step, 1]) * self.base_height / 2
+            jac_0 = self.plane_angles_derivative_batch(heights, alphas[step], roof,
+                                                       np.column_stack((np.zeros_like(cos0), cos0, -cos0)))
+            jac_1 = self.plane_angles_derivative_batch(heights, alphas[step], roof,
+                                                       np.column_stack((cos1, -cos1, -cos1)))
+
+            # Risolvo il sistema 2x2 su zyx3 e zyx2, lo yaw dipende linearmente dal giunto rotativo
+            det = jac_0[:, 0] * jac_1[:, 1] - jac_1[:, 0] * jac_0[:, 1]
+            delta = np.empty((step.size, 3))
+            delta[:, 0] = (err[step, 0] * jac_1[:, 1] - jac_1[:, 0] * err[step, 1]) / det
+            delta[:, 1] = (jac_0[:, 0] * err[step, 1] - err[step, 0] * jac_0[:, 1]) / det
+            delta[:, 2] = err[step, 2] - jac_0[:, 2] * delta[:, 0] - jac_1[:, 2] * delta[:, 1]
+
+            last_step[step] = delta
+            angles_r_search[step] += delta
+
+        return motor_positions, is_converged, err, cycles
+
+    @staticmethod
+    def geometry_hash(ini, sections=('Dimensions', 'Kinematic'), version=0):
+        """Impronta md5 di alcune sezioni del file di configurazione, di default Dimensions e Kinematic"""
+
+        md5 = hashlib.md5()
+        if version:
+            md5.update("version={};".format(version))
+        for section in sections:
+            for option, value in sorted(ini.items(section)):
+                md5.update("{}.{}={};".format(section, option, value))
+
+        return md5.hexdigest()
+
+    def load_ik_table(self, cache_path):
+        """Carica, o costruisce se manca, la tabella della cinematica inversa
+
+        La tabella e' un array (N, N, 4) sulla griglia di zyx3 (primo indice) e zyx2 (secondo indice) da
+        -ik_table_range a +ik_table_range gradi con passo ik_table_step; contiene le altezze dei motori 120, 121 e 122 e
+        la posizione del motore 119 con zyx1 nullo. Viene salvata in cache_path con l'impronta della geometria nel
+        nome, ed aperta come memory map: se la geometria cambia il nome non corrisponde piu' e la tabella viene
+        ricostruita.
+        """
+
+        filename = self.ik_table_filename(cache_path)
+        if os.path.exists(filename):
+            logging.info("Carico la tabella della cinematica inversa {}".format(filename))
+            return np.load(filename, mmap_mode='r').view(np.ndarray)
+
+        logging.info("Costruisco la tabella della cinematica inversa, passo {} gradi".format(self.ik_table_step))
+        start_time = time.time()
+        table = self.build_ik_table()
+        logging.info("Tabella costruita in {:.1f}s".format(time.time() - start_time))
+
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path, 0777)
+
+        # Scrivo su un file temporaneo per non lasciare una tabella a meta' ad un altro processo
+        temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        with open(temp_filename, "wb") as table_file:
+            np.save(table_file, table)
+        os.rename(temp_filename, filename)
+
+        return np.load(filename, mmap_mode='r').view(np.ndarray)
+
+    def ik_table_filename(self, cache_path=None):
+
+        if cache_path is None:
+            cache_path = self.ik_table_path
+
+        return "{}ik_table_{}.npy".format(cache_path, self.geometry_md5)
+
+    def build_ik_table_background(self):
+        """Thread di costruzione della tabella della cinematica inversa, avviato da __init__"""
+
+        try:
+            self.ik_table = self.load_ik_table(self.ik_table_path)
+        except Exception as e:
+            logging.error("Costruzione della tabella della cinematica inversa non riuscita: {}".format(e))
+
+    def wait_ik_table(self):
+        """Attende la tabella della cinematica inversa, se in costruzione
+
+        Le conversioni delle simulazioni partono dalla tabella, se abilitata, e non devono dipendere da quando la
+        costruzione finisce. Un processo figlio avviato durante la costruzione non ha il thread, e carica o costruisce
+        la tabella da se'.
+        """
+
+        if not self.use_ik_table or self.ik_table is not None:
+            return
+
+        if self.ik_table_thread is not None and self.ik_table_thread.is_alive():
+            self.ik_table_thread.join()
+        if self.ik_table is None:
+            self.build_ik_table_background()
+
+    def build_ik_table(self):
+        """Calcola la tabella della cinematica inversa con calc_ik_batch_newton, NaN dove non c'e' soluzione"""
+
+        size = int(round(2 * self.ik_table_range / self.ik_table_step)) + 1
+        grid = np.linspace(-self.ik_table_range, self.ik_table_range, size)
+        zyx3, zyx2 = np.meshgrid(grid, grid, indexing='ij')
+
+        motor_positions, is_converged, err, cycles = self.calc_ik_batch_newton(
+            zyx3.ravel(), zyx2.ravel(), np.zeros(size * size)
+        )
+        motor_positions[~is_converged] = np.nan
+
+        return motor_positions.reshape((size, size, 4))
+
+    def ik_table_positions_batch(self, zyx3, zyx2, zyx1):
+        """Interpolazione bilineare della tabella della cinematica inversa
+
+        Gli angoli sono array in gradi. Restituisce un array (N, 4) di posizioni dei motori, a NaN per i punti fuori
+        dalla griglia o vicini a nodi senza soluzione.
+        """
+
+        size = self.ik_table.shape[0]
+        u = (np.asarray(zyx3, dtype=float) + self.ik_table_range) / self.ik_table_step
+        v = (np.asarray(zyx2, dtype=float) + self.ik_table_range) / self.ik_table_step
+        is_inside = (u >= 0) & (u <= size - 1) & (v >= 0) & (v <= size - 1)
+
+        i = np.clip(np.floor(u).astype(int), 0, size - 2)
+        j = np.clip(np.floor(v).astype(int), 0, size - 2)
+        fu = (u - i)[:, np.newaxis]
+        fv = (v - j)[:, np.newaxis]
+
+        table = self.ik_table
+        positions = ((table[i, j] * (1 - fv) + table[i, j + 1] * fv) * (1 - fu) +
+                     (table[i + 1, j] * (1 - fv) + table[i + 1, j + 1] * fv) * fu)
+        positions[~is_inside] = np.nan
+        positions[:, 3] += np.asarray(zyx1, dtype=float) * Kinematic.M_TO_RAD
+
+        return positions
+
+    def calc_ik_batch_table(self, zyx3, zyx2, zyx1):
+        """Cinematica inversa tramite la tabella precalcolata
+
+        Stessi ingressi ed uscite di calc_ik_batch. Le posizioni interpolate vengono verificate con una cinematica
+        diretta; se l'errore supera la soglia si interpola di nuovo negli angoli corretti dell'errore trovato, una
+        sola volta. Le righe ancora fuori soglia, o fuori dalla tabella, passano al metodo iterativo.
+        """
+
+        angles = np.column_stack((np.asarray(zyx3, dtype=float),
+                                  np.asarray(zyx2, dtype=float),
+                                  np.asarray(zyx1, dtype=float)))
+        angles_r = angles * Kinematic.M_TO_RAD
+        rows = angles.shape[0]
+
+        motor_positions = self.ik_table_positions_batch(angles[:, 0], angles[:, 1], angles[:, 2])
+        err = np.full((rows, 3), np.nan)
+        is_converged = np.zeros(rows, dtype=bool)
+        cycles = np.zeros(rows, dtype=int)
+
+        search_limit = 0.0001 / 180.0 * Kinematic.M_PI
+
+        todo = np.flatnonzero(np.all(np.isfinite(motor_positions), axis=1))
+        for i in range(0, 2):
+
+            if todo.size == 0:
+                break
+
+            if i > 0:
+                angles_search = angles[todo] + err[todo] / Kinematic.M_TO_RAD
+                positions = self.ik_table_positions_batch(angles_search[:, 0], angles_search[:, 1],
+                                                          angles_search[:, 2])
+                is_inside = np.all(np.isfinite(positions), axis=1)
+                todo = todo[is_inside]
+                motor_positions[todo] = positions[is_inside]
+
+            alphas, roof, is_valid = self.search_base_angles_batch(motor_positions[todo, :3])
+            angles_found = Kinematic.find_plane_angles_batch(roof, motor_positions[todo, 3])
+            err[todo] = angles_r[todo] - angles_found
+            cycles[todo] = i
+
+            is_done = is_valid & np.all(np.abs(err[todo]) < search_limit, axis=1)
+            is_converged[todo[is_done]] = True
+            todo = todo[is_valid & ~is_done]
+
+        # Le righe rimaste vengono risolte senza tabella
+        fallback = np.flatnonzero(~is_converged)
+        if fallback.size:
+            positions, is_fallback_converged, fallback_err, fallback_cycles = self.calc_ik_batch(
+                angles[fallback, 0], angles[fallback, 1], angles[fallback, 2], use_table=False
+            )
+            motor_positions[fallback] = positions
+            is_converged[fallback] = is_fallback_converged
+            err[fallback] = fallback_err
+            cycles[fallback] += fallback_cycles + 1
+
+        return motor_positions, is_converged, err, cycles
+
     def start_parsing(self, filename, tcp_protocol=None):
 
         # Informa il padre se necessario
@@ -755,6 +1633,7 @@ class Kinematic():
         self.tcp_protocol = tcp_protocol
 
         # Avvia il thread di importazione
+        self.import_abort.clear()
         self.parser_thread = threading.Thread(target=self.sim_parser)
         self.parser_thread.setDaemon(True)
         self.parser_thread.start()
@@ -819,6 +1698,122 @@ class Kinematic():
         self.last_conversion_steps = list(motor_steps)
         return True
 
+    def positions_to_steps_batch(self, motor_positions, is_valid):
+        """Converte un array (N, 4) di posizioni in step motore, troncando come int(); righe non valide a zero"""
+
+        motor_positions = np.where(is_valid[:, np.newaxis], motor_positions, 0.0)
+        motor_steps = np.empty(motor_positions.shape, dtype=np.int64)
+        motor_steps[:, :3] = motor_positions[:, :3] * self.mt_to_step
+        motor_steps[:, 3] = motor_positions[:, 3] * self.radians_to_step
+
+        return motor_steps
+
+    def convert_sim_block(self, sim_block):
+        """Cinematica inversa e conversione in step di un blocco della simulazione, (N, 3) angoli in gradi
+
+        Restituisce gli step (N, 4) dei motori 120, 121, 122 e 119, le righe convergenti e l'errore residuo.
+        """
+
+        sim_positions, sim_converged, sim_err, sim_cycles = self.calc_ik_batch(
+            sim_block[:, 0], sim_block[:, 1], sim_block[:, 2])
+
+        return self.positions_to_steps_batch(sim_positions, sim_converged), sim_converged, sim_err
+
+    def convert_sim_blocks(self, loader, pool=None):
+        """Legge e converte i blocchi della simulazione, restituendoli nell'ordine del file
+
+        Per ogni blocco restituisce quanto letto da SimLoader.read_block seguito dal risultato di convert_sim_block.
+        Con un pool di processi i blocchi vengono convertiti in parallelo, con al massimo due blocchi in coda per
+        processo. La cinematica vettoriale non porta nulla da un blocco all'altro e i blocchi sono gli stessi
+        della conversione seriale, per cui il risultato e' identico.
+        """
+
+        if pool is None:
+            while True:
+                block = loader.read_block()
+                if block is None:
+                    return
+                yield block + self.convert_sim_block(block[0])
+
+        pending = deque()
+        max_pending = 2 * self.tripod.config.SIM_WORKERS
+        is_eof = False
+        while True:
+            while not is_eof and len(pending) < max_pending:
+                block = loader.read_block()
+                if block is None:
+                    is_eof = True
+                else:
+                    pending.append((block, pool.apply_async(sim_worker_convert, (block[0],))))
+            if not pending:
+                return
+            block, result = pending.popleft()
+            yield block + result.get()
+
+    @staticmethod
+    def suppress_zeros_batch(motor_steps, motor_steps_old, zero_suppression):
+        """Soppressione degli zeri su un blocco (N, 4) di step, modificato sul posto
+
+        Se due campioni sono uguali, la prima volta aggiunge 1 step, la seconda lo toglie. motor_steps_old sono gli
+        step dell'ultima riga del blocco precedente, gia' modificati, e zero_suppression il segno della prossima
+        correzione di ogni motore: entrambi vengono aggiornati per il blocco successivo.
+
+        Un campione modificato dista al piu' uno step da quello originale, per cui solo le righe che differiscono
+        di non piu' di uno step dalla precedente possono essere uguali alla precedente modificata: solo queste
+        vengono controllate una ad una, in ordine.
+        """
+
+        for i in range(4):
+            steps = motor_steps[:, i]
+            steps_old = np.concatenate(([motor_steps_old[i]], steps[:-1]))
+            candidates = np.flatnonzero(np.abs(steps - steps_old) <= 1).tolist()
+            if candidates:
+                values = steps[candidates].tolist()
+                correction = zero_suppression[i]
+                for row, value in zip(candidates, values):
+                    if row == 0:
+                        value_old = motor_steps_old[i]
+                    else:
+                        value_old = steps[row - 1]
+                    if value == value_old:
+                        steps[row] = value + correction
+                        correction = -correction
+                zero_suppression[i] = correction
+            if steps.size:
+                motor_steps_old[i] = steps[-1]
+
+    def check_limits_batch(self, report, rownums, motor_steps, is_converged, err, times, last_steps):
+        """Controlla i limiti di posizione e velocita' di un blocco della simulazione, aggiungendo a report le
+        violazioni trovate
+
+        motor_steps e' un array (N, 4) di step dei motori 120, 121, 122 e 119, times il tempo di ogni riga in ms e
+        last_steps gli step dell'ultima riga del blocco precedente (NaN se non valida). Le velocita' sono calcolate
+        sugli step prima della soppressione degli zeri, che li sposta al piu' di uno step.
+        """
+
+        report.add('ik', None, rownums[~is_converged], np.max(np.abs(err[~is_converged]), axis=1) / Kinematic.M_TO_RAD,
+                   0.0001)
+        is_time_valid = times > 0
+        report.add('time', None, rownums[~is_time_valid], times[~is_time_valid], 0)
+
+        # Le righe senza soluzione non partecipano ai controlli, neppure come riga precedente
+        steps = motor_steps.astype(float)
+        steps[~is_converged] = np.nan
+        steps_old = np.vstack((last_steps, steps[:-1]))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.abs(steps - steps_old) / (times / 1000.0)[:, np.newaxis]
+
+        for i, motor in enumerate(('120', '121', '122', '119')):
+            if motor != '119':
+                is_over = is_converged & (np.abs(motor_steps[:, i]) > 319999)
+                report.add('position', motor, rownums[is_over], motor_steps[is_over, i], 319999)
+                limit = self.max_lin_step_per_s
+            else:
+                limit = self.max_rot_step_per_s
+            is_over = is_time_valid & (speed[:, i] > limit)
+            report.add('speed', motor, rownums[is_over], speed[is_over, i], limit)
+
     def sim_parser(self):
         """Legge il file della simulazione, e per ogni riga Roll, Pitch e Yaw salva una riga nei file motore.
 
@@ -860,204 +1855,90 @@ class Kinematic():
         filename = self.sim_file.rstrip()[4:]
         logging.info("Analizzo il file {}".format(filename))
 
-        # Puo' essere l'md5sum od il nome di file direttamente
-        found_something = False
-
-        for file_found in os.listdir(self.tripod.config.SIM_PATH):
+        # Puo' essere l'md5sum od il nome di file direttamente, cercati nell'indice delle simulazioni
+        sim_entry = self.sim_library.find(filename)
+        found_something = sim_entry is not None
 
-            filename_complete = self.tripod.config.SIM_PATH + file_found
-
-            if file_found == filename:
-                logging.warn("Found file {}!".format(file))
-                shutil.copyfile(filename_complete, "{}simulazione_{}.csv".format(self.tripod.config.LOG_PATH, filename))
-                found_something = True
-                break
+        if found_something:
+            filename = sim_entry['name']
+            filename_complete = sim_entry['path']
+            logging.warn("Found file {}!".format(filename))
+            shutil.copyfile(filename_complete, "{}simulazione_{}.csv".format(self.tripod.config.LOG_PATH, filename))
 
         try:
 
-            if found_something:
+            if found_something and self.tripod.config.SIM_STREAMING:
 
-                rownum = 0
-                motor_file = dict()
-                motor_steps = [0L, 0L, 0L, 0L]
-                motor_steps_old = [0L, 0L, 0L, 0L]
-                zero_suppression = [1, 1, 1, 1]
-                old_progress = -1
-
-                f = open(filename_complete, 'rb')
-                reader = csv.reader(f, delimiter=';')
-                lines = sum(1 for col in reader)
-                f.seek(0)
-
-                for col in reader:
-
-                    if rownum == 0:
-
-                        # La prima riga e' un'intestazione
-                        # Intanto apro i files di output
-                        for motor in self.tripod.motor_address_list:
-                            file_name = '{}{}{}'.format(self.tripod.config.MOT_DATA, motor, self.tripod.config.MOT_EXT)
-                            logging.warn("File {} opened".format(file_name))
-                            motor_file[motor] = open(file_name, "w+")
-                            os.chmod(file_name, 0666)
-                        log_conversione = open("{}conversione_angoli_step_{}.csv".format(self.tripod.config.LOG_PATH, filename), "w+")
-                        log_conversione.write("Line;Time;Roll;Pitch;Yaw;Step_119_IK;Step_120_IK;Step_121_IK;Step_122_IK\n")
-                        time_log = 0.0
-
-                    else:
-
-                        # Calcolo la posizione dei motori tramite la cinematica diretta
-                        sim_roll = float(col[0].replace(',', '.'))
-                        sim_pitch = float(col[1].replace(',', '.'))
-                        sim_yaw = float(col[2].replace(',', '.'))
-
-                        # Questa e' la terna avionica, quindi devo prima convertirla
-                        # NON FUNZIONA LA CONVERSIONE IN CYTHON
-                        # angles1 = kinematic_cy.angles_to_internals(sim_roll, sim_pitch, sim_yaw)
-                        ####################### angles2 = self.angles_to_internals(sim_roll, sim_pitch, sim_yaw)
-                        # logging.debug("({}, {}, {}) -> ({}, {}, {}) ({}, {}, {})".format(
-                        #    sim_roll,
-                        #    sim_pitch,
-                        #    sim_yaw,
-                        #    angles1[0],
-                        #    angles1[1],
-                        #    angles1[2],
-                        #    angles2[0],
-                        #    angles2[1],
-                        #    angles2[2]
-                        # ))
-
-                        if not self.calc_ik(sim_roll, sim_pitch, sim_yaw):
-                        #######################if not self.calc_ik(angles2[0], angles2[1], angles2[2]):
-                            # TODO: devo stampare l'errore
-                            return False
-
-                        # Converto gli angoli in step motore
-                        motor_steps[0] = int(self.last_conversion_positions[0] * self.mt_to_step)
-                        motor_steps[1] = int(self.last_conversion_positions[1] * self.mt_to_step)
-                        motor_steps[2] = int(self.last_conversion_positions[2] * self.mt_to_step)
-                        motor_steps[3] = int(self.last_conversion_positions[3] * self.radians_to_step)
+                # La conversione avverra' durante la simulazione, al CT4, qui controllo solo che il file sia leggibile
+                if sim_entry['status'] != 'ok':
+                    if self.tcp_protocol is not None:
+                        self.tcp_protocol.sendLine("CERR CT3 1: CSV parser error, file %s, %s" % (
+                            filename, sim_entry['error']))
+                    logging.error("CSV parser error, file %s, %s" % (filename, sim_entry['error']))
+                    self.update_import_end("")
+                    return False
+                self.stream_file = filename_complete
+                print "Data ready for streaming, {} lines".format(sim_entry['rows'])
+                if self.tcp_protocol is not None:
+                    self.tcp_protocol.sendLine('OK CT3')
+                self.update_import_end(filename)
+                return True
 
-                        # Controllo che la posizione assoluta non ecceda i limiti fisici
-                        if motor_steps[0] < -319999:
-                            self.format_pos_limit_err("inferiore", "120", rownum, col, motor_steps)
-                            return False
-                        if motor_steps[0] > 319999:
-                            self.format_pos_limit_err("superiore", "120", rownum, col, motor_steps)
-                            return False
-                        if motor_steps[1] < -319999:
-                            self.format_pos_limit_err("inferiore", "121", rownum, col, motor_steps)
-                            return False
-                        if motor_steps[1] > 319999:
-                            self.format_pos_limit_err("superiore", "121", rownum, col, motor_steps)
-                            return False
-                        if motor_steps[2] < -319999:
-                            self.format_pos_limit_err("inferiore", "122", rownum, col, motor_steps)
-                            return False
-                        if motor_steps[2] > 319999:
-                            self.format_pos_limit_err("superiore", "122", rownum, col, motor_steps)
-                            return False
+            if found_something:
 
-                        # Controllo che la velocita' raggiunta dagli attuatori non ecceda i limiti
-                        if (abs(motor_steps[0] - motor_steps_old[0]) / (int(col[3]) / 1000.0)) > self.max_lin_step_per_s:
-                            self.format_speed_limit_err("120", rownum, col, motor_steps, motor_steps_old)
-                            return False
-                        if (abs(motor_steps[1] - motor_steps_old[1]) / (int(col[3]) / 1000.0)) > self.max_lin_step_per_s:
-                            self.format_speed_limit_err("121", rownum, col, motor_steps, motor_steps_old)
-                            return False
-                        if (abs(motor_steps[2] - motor_steps_old[2]) / (int(col[3]) / 1000.0)) > self.max_lin_step_per_s:
-                            self.format_speed_limit_err("122", rownum, col, motor_steps, motor_steps_old)
-                            return False
-                        if (abs(motor_steps[3] - motor_steps_old[3]) / (int(col[3]) / 1000.0)) > self.max_rot_step_per_s:
-                            self.format_speed_limit_err("119", rownum, col, motor_steps, motor_steps_old)
-                            return False
+                # File prodotti dalla conversione, con il loro nome nella cache delle conversioni
+                is_binary = self.tripod.config.MOT_BINARY
+                output_files = self.conversion_files(
+                    self.tripod.config.MOT_DATA,
+                    "{}conversione_angoli_step_{}.csv".format(self.tripod.config.LOG_PATH, filename),
+                    is_binary
+                )
+
+                # Punto di ripresa di questa importazione, valido solo per la stessa simulazione e gli stessi file
+                checkpoint = ImportCheckpoint(self.tripod.config.CACHE_PATH + 'import_checkpoint.json', {
+                    'md5': sim_entry['md5'],
+                    'params': self.conversion_md5,
+                    'is_binary': is_binary,
+                    'files': output_files
+                })
+
+                # Se la stessa simulazione e' gia' stata convertita con gli stessi parametri, uso i file salvati
+                cache_key = None
+                if self.conversion_cache.is_enabled():
+                    cache_key = ConversionCache.key_from_md5(sim_entry['md5'], self.conversion_md5)
+                    try:
+                        is_cached = self.conversion_cache.install(cache_key, output_files)
+                    except (IOError, OSError) as e:
+                        logging.error("Impossibile usare la conversione nella cache: {}".format(e))
+                        checkpoint.remove()
+                        is_cached = False
+                    if is_cached:
+                        # I file di output sono stati sostituiti, l'eventuale punto di ripresa non vale piu'
+                        checkpoint.remove()
+                        print "Data loaded from cache"
+                        if self.tcp_protocol is not None:
+                            self.tcp_protocol.sendLine('OK CT3')
+                        self.update_import_end(filename)
+                        return True
+
+                report, lines = self.convert_simulation(filename_complete, output_files, is_binary,
+                                                        self.update_import_progress, checkpoint=checkpoint)
+                checkpoint.remove()
+
+                if not report.is_empty():
+                    self.format_limits_err(report)
+                    return False
 
-                        #motor_steps_before = list(motor_steps)
-
-                        # Se due campioni sono uguali, la prima volta aggiunge 1 step, la seconda lo toglie
-                        if motor_steps[0] == motor_steps_old[0]:
-                            motor_steps[0] += zero_suppression[0]
-                            zero_suppression[0] = -zero_suppression[0]
-                        if motor_steps[1] == motor_steps_old[1]:
-                            motor_steps[1] += zero_suppression[1]
-                            zero_suppression[1] = -zero_suppression[1]
-                        if motor_steps[2] == motor_steps_old[2]:
-                            motor_steps[2] += zero_suppression[2]
-                            zero_suppression[2] = -zero_suppression[2]
-                        if motor_steps[3] == motor_steps_old[3]:
-                            motor_steps[3] += zero_suppression[3]
-                            zero_suppression[3] = -zero_suppression[3]
-
-                        # logging.warn("{:06d},{:02d}: RPY[{:6.3f}, {:6.3f}, {:6.3f}] STEP[{:+07d}({:+07d}), {:+07d}({:+07d}), {:+07d}({:+07d}), {:+07d}({:+07d})] - SPEED[{:6.0f}, {:6.0f}, {:6.0f}, {:6.0f}]".format(
-                        #    rownum,
-                        #    int(col[3]),
-                        #    float(col[0].replace(',', '.')),
-                        #    float(col[1].replace(',', '.')),
-                        #    float(col[2].replace(',', '.')),
-                        #    motor_steps[0],
-                        #    motor_steps_before[0],
-                        #    motor_steps[1],
-                        #    motor_steps_before[1],
-                        #    motor_steps[2],
-                        #    motor_steps_before[2],
-                        #    motor_steps[3],
-                        #    motor_steps_before[3],
-                        #    abs((motor_steps[0] - motor_steps_old[0]) * 1000.0) / int(col[3]),
-                        #    abs((motor_steps[1] - motor_steps_old[1]) * 1000.0) / int(col[3]),
-                        #    abs((motor_steps[2] - motor_steps_old[2]) * 1000.0) / int(col[3]),
-                        #    abs((motor_steps[3] - motor_steps_old[3]) * 1000.0) / int(col[3]))
-                        # )
-
-                        # Salvo i vecchi valori
-                        motor_steps_old = list(motor_steps)
-
-                        # --------------------------------------------------------------------------------------------
-                        # Stampare la percentuale
-                        # --------------------------------------------------------------------------------------------
-                        motor_file['119'].write("CT1 M119 S{:.0f} T{}\n".format(-motor_steps[3], col[3]))
-                        motor_file['120'].write("CT1 M120 S{:.0f} T{}\n".format(-motor_steps[0], col[3]))
-                        motor_file['121'].write("CT1 M121 S{:.0f} T{}\n".format(-motor_steps[1], col[3]))
-                        motor_file['122'].write("CT1 M122 S{:.0f} T{}\n".format(-motor_steps[2], col[3]))
-                        time_log += float(col[3]) / 1000.0
-                        log_conversione.write("{};{};{};{};{};{};{};{};{}\n".format(
-                            rownum,
-                            time_log,
-                            sim_roll,
-                            sim_pitch,
-                            sim_yaw,
-                            motor_steps[3],
-                            motor_steps[0],
-                            motor_steps[1],
-                            motor_steps[2]))
-                    rownum += 1
-                    progress = int(rownum * 100.0 / lines)
-                    if old_progress != progress:
-                        if reactor:
-                            reactor.callFromThread(self.tripod.update_import_progress, progress, rownum)
-                        else:
-                            #print "{:04d} with {:4d} cycles, [{:7.3f}, {:7.3f}, {:7.3f}] -> [{:7.0f}, {:7.0f}, {:7.0f}, {:7.0f}]".format(
-                            #    rownum,
-                            #    self.cycles,
-                            #    roll_sim,
-                            #    pitch_sim,
-                            #    yaw_sim,
-                            #    motor_step[0],
-                            #    motor_step[1],
-                            #    motor_step[2],
-                            #    motor_step[3])
-                            pass
-                        old_progress = progress
-
-                for motor in self.tripod.motor_address_list:
-                    logging.warn("File {} closed".format(motor))
-                    motor_file[motor].close()
-                log_conversione.close()
+                if cache_key is not None:
+                    try:
+                        self.conversion_cache.store(cache_key, output_files)
+                    except (IOError, OSError) as e:
+                        logging.error("Impossibile salvare la conversione nella cache: {}".format(e))
 
                 print "Data loaded, {} lines".format(lines)
                 if self.tcp_protocol is not None:
                     self.tcp_protocol.sendLine('OK CT3')
-                if reactor:
-                    reactor.callFromThread(self.tripod.update_import_end, filename)
+                self.update_import_end(filename)
                 return True
 
             else:
@@ -1065,40 +1946,340 @@ class Kinematic():
                 if self.tcp_protocol is not None:
                     self.tcp_protocol.sendLine('CERR CT3 0: File not found')
 
-            if reactor:
-                reactor.callFromThread(self.tripod.update_import_end, "")
+            self.update_import_end("")
+            return False
+
+        except ImportAborted:
+
+            # Rimuovo i file parziali, l'importazione non potra' essere ripresa
+            logging.warn("Importazione di {} interrotta alla riga {}".format(filename, self.conversion_rownum))
+            checkpoint.remove()
+            for file_name in output_files.values():
+                for partial_file in (file_name, file_name + '.times.tmp'):
+                    if os.path.exists(partial_file):
+                        os.remove(partial_file)
+            if self.tcp_protocol is not None:
+                self.tcp_protocol.sendLine("CERR CT3 3: Import aborted")
+            self.update_import_end("")
             return False
 
-        except csv.Error as e:
+        except SimFormatError as e:
 
             if self.tcp_protocol is not None:
-                self.tcp_protocol.sendLine("CERR CT3 1: CSV parser error, file %s, line %d, content '%s': %s" % (filename, rownum, str(col), e))
-            logging.error("CSV parser error, file %s, line %d: %s" % (filename, reader.line_num, e))
-            if reactor:
-                reactor.callFromThread(self.tripod.update_import_end, "")
+                self.tcp_protocol.sendLine("CERR CT3 1: CSV parser error, file %s, line %d, content '%s': %s" % (filename, e.line_num, e.content, e.message))
+            logging.error("CSV parser error, file %s, line %d: %s" % (filename, e.line_num, e.message))
+            self.update_import_end("")
             return False
 
         except Exception, e:
             logging.error("Error on parsing file! ")
             if self.tcp_protocol is not None:
-                self.tcp_protocol.sendLine("CERR CT3 1: CSV parser error, file %s, line %d, content '%s': %s" % (filename, reader.line_num, str(col), e))
-            if reactor:
-                reactor.callFromThread(self.tripod.update_import_end, "")
+                self.tcp_protocol.sendLine("CERR CT3 1: CSV parser error, file %s, line %d: %s" % (
+                    filename, self.conversion_rownum, e))
+            self.update_import_end("")
             return False
 
-    def format_pos_limit_err(self, direction, motor, rownum, col, motor_step):
+    def conversion_files(self, motor_path, log_filename, is_binary):
+        """File prodotti dalla conversione, dal loro nome nella cache delle conversioni al percorso su disco"""
 
-        if self.tcp_protocol is not None:
-            self.tcp_protocol.sendLine('ERR CT3 0: Limite {} raggiunto nel giunto {} alla linea {}:{}'.format(
-                direction, motor, rownum, col))
-        if direction == "inferiore":
-            edir = "lower"
+        if is_binary:
+            motor_ext = self.tripod.config.TRJ_EXT
         else:
-            edir = "upper"
-        logging.error('ERR CT3 0: Motor {} {} limit reached on line {}:{} ({}, {}, {}, {})'.format(
-            motor, edir, rownum, col, motor_step[0], motor_step[1], motor_step[2], motor_step[3]))
-        if reactor:
-            reactor.callFromThread(self.tripod.update_import_end, "")
+            motor_ext = self.tripod.config.MOT_EXT
+        output_files = dict()
+        for motor in self.tripod.motor_address_list:
+            output_files[motor + motor_ext] = '{}{}{}'.format(motor_path, motor, motor_ext)
+        output_files['conversione_angoli_step.csv'] = log_filename
+
+        return output_files
+
+    def convert_simulation(self, filename_complete, output_files, is_binary, progress=None, is_background=False,
+                           checkpoint=None):
+        """Converte il file di simulazione filename_complete nei file output_files, come descritti in sim_parser
+
+        output_files associa ad ogni nome nella cache delle conversioni il file da scrivere, e progress, se
+        specificata, viene chiamata con la percentuale e la riga ad ogni cambio di percentuale. Con is_background
+        la conversione resta in un solo processo, senza pool e con la scrittura inline.
+
+        Con checkpoint, un ImportCheckpoint, la conversione riprende dal punto salvato se appartiene alla stessa
+        importazione, e ne salva uno nuovo ogni SIM_CHECKPOINT_ROWS righe. Se viene chiamata abort_import solleva
+        ImportAborted.
+
+        Restituisce il rapporto delle violazioni dei limiti ed il numero di righe lette piu' uno. Se il file non e'
+        valido solleva SimFormatError.
+        """
+
+        if is_binary:
+            motor_ext = self.tripod.config.TRJ_EXT
+        else:
+            motor_ext = self.tripod.config.MOT_EXT
+        self.conversion_rownum = 0
+
+        # Il file viene letto una sola volta, a blocchi
+        f = open(filename_complete, 'rb')
+        loader = SimLoader(f, self.tripod.config.SIM_BLOCK_BYTES)
+
+        motor_files = dict((motor, output_files[motor + motor_ext]) for motor in self.tripod.motor_address_list)
+        log_file = output_files['conversione_angoli_step.csv']
+
+        # Riprendo dall'ultimo punto salvato se i file di output contengono ancora quanto scritto fino a li'
+        state = dict()
+        resume = None
+        if checkpoint is not None:
+            saved = checkpoint.load()
+            if saved is not None and SimWriter.can_resume(motor_files, log_file, is_binary, saved['writer']):
+                logging.warn("Riprendo l'importazione di {} dalla riga {}".format(filename_complete, saved['rownum']))
+                resume = saved.pop('writer')
+                del saved['identity']
+                state = saved
+            else:
+                checkpoint.remove()
+
+        # La formattazione e la scrittura dei file di output avvengono a blocchi, fuori da questo ciclo
+        if is_background:
+            writer_mode = 'inline'
+        else:
+            writer_mode = self.tripod.config.SIM_WRITER_MODE
+        writer = SimWriter(
+            motor_files,
+            log_file,
+            is_binary,
+            self.tripod.config.SIM_WRITE_ROWS,
+            writer_mode,
+            self.tripod.config.SIM_WRITER_QUEUE,
+            resume
+        )
+
+        # Tutte le violazioni dei limiti vengono raccolte e segnalate insieme alla fine. I punti di ripresa vengono
+        # salvati solo finche' non ci sono violazioni, altrimenti l'importazione fallira' comunque
+        report = LimitReport()
+        rownum = state.get('rownum', 1)
+        next_checkpoint = rownum + self.tripod.config.SIM_CHECKPOINT_ROWS
+
+        # In caso di errore il writer viene comunque chiuso, per non lasciare thread o processi appesi, ma senza
+        # completare i file, che restano come all'ultimo punto di ripresa
+        sim_steps_iter = self.iter_sim_steps(
+            loader, os.path.getsize(filename_complete), report, progress, not is_background, state)
+        try:
+            for sim_rownums, sim_block, sim_times, sim_steps in sim_steps_iter:
+                if not is_background and self.import_abort.is_set():
+                    raise ImportAborted()
+                writer.write_block(sim_rownums, sim_block, sim_times, sim_steps)
+                rownum = state['rownum']
+                if checkpoint is not None and self.tripod.config.SIM_CHECKPOINT_ROWS > 0 and \
+                        rownum >= next_checkpoint and report.is_empty():
+                    writer.checkpoint(checkpoint, dict(state))
+                    next_checkpoint = rownum + self.tripod.config.SIM_CHECKPOINT_ROWS
+        except Exception:
+            sim_steps_iter.close()
+            f.close()
+            try:
+                writer.abandon()
+            except IOError as e:
+                logging.error("Errore nella chiusura dei file di output: {}".format(e))
+            raise
+
+        f.close()
+        writer.close(loader.md5.digest())
+
+        return report, rownum
+
+    def iter_sim_steps(self, loader, file_size, report, progress=None, use_pool=True, state=None):
+        """Converte i blocchi letti da loader negli step dei motori, pronti per i file motore
+
+        Per ogni blocco, nell'ordine del file, restituisce i numeri delle righe, gli angoli, i tempi e gli step
+        (N, 4) dei motori 120, 121, 122 e 119 con la soppressione degli zeri. Se compact_tolerance e' impostata le
+        righe allineate vengono unite con compact_block e restano solo quelle da scrivere, con il tempo dalla
+        precedente. Le violazioni dei limiti vengono aggiunte a report, blocco per blocco e su tutte le righe, prima
+        che il blocco venga restituito. progress, se specificata, viene chiamata con la percentuale e la riga ad ogni
+        cambio di percentuale, calcolata sui byte letti del file.
+
+        state, se specificato, e' un dizionario aggiornato prima di restituire ogni blocco con lo stato necessario a
+        riprendere la conversione dal blocco successivo. Se contiene gia' uno stato la conversione riprende da li'.
+        """
+
+        self.wait_ik_table()
+
+        motor_steps_old = [0, 0, 0, 0]
+        zero_suppression = [1, 1, 1, 1]
+        old_progress = -1
+        file_size = max(file_size, 1)
+        last_steps = np.zeros(4)
+        compact_anchor = None
+        rownum = 1
+
+        if state:
+            loader.resume(state['offset'], state['rownum'])
+            motor_steps_old = list(state['motor_steps_old'])
+            zero_suppression = list(state['zero_suppression'])
+            old_progress = state['progress']
+            last_steps = np.array(state['last_steps'], dtype=float)
+            rownum = state['rownum']
+            compact_anchor = state.get('compact_anchor')
+
+        # Con piu' processi la cinematica dei blocchi viene calcolata in parallelo, ogni processo con la
+        # propria copia dei risolutori
+        pool = None
+        if self.tripod.config.SIM_WORKERS > 1 and use_pool:
+            pool = multiprocessing.Pool(self.tripod.config.SIM_WORKERS, sim_worker_init, (self,))
+
+        try:
+            # Per ogni blocco, nell'ordine del file, le righe lette, con la posizione nel file alla fine di
+            # ognuna, e gli step dei motori calcolati con la cinematica inversa
+            for block in self.convert_sim_blocks(loader, pool):
+                sim_block, sim_times, sim_rows, sim_offsets, sim_steps, sim_converged, sim_err = block
+
+                # Controllo in una volta tutti i limiti del blocco, la velocita' anche rispetto al precedente
+                sim_rownums = np.arange(rownum, rownum + len(sim_rows))
+                self.check_limits_batch(report, sim_rownums, sim_steps, sim_converged, sim_err, sim_times,
+                                        last_steps)
+                last_steps = np.where(sim_converged[-1], sim_steps[-1], np.nan)
+
+                # La compattazione lavora sugli step calcolati, prima della soppressione degli zeri
+                if self.compact_tolerance is not None:
+                    keep, merged_times = self.compact_block(sim_steps, sim_times, compact_anchor)
+                    compact_anchor = sim_steps[-1].tolist()
+                    sim_rownums = sim_rownums[keep]
+                    sim_block = sim_block[keep]
+                    sim_times = merged_times[keep]
+                    sim_steps = sim_steps[keep]
+
+                # La soppressione degli zeri prosegue da un blocco al successivo
+                Kinematic.suppress_zeros_batch(sim_steps, motor_steps_old, zero_suppression)
+
+                # ------------------------------------------------------------------------------------------------
+                # Stampare la percentuale, ad ogni cambio di valore
+                # ------------------------------------------------------------------------------------------------
+                sim_progress = (sim_offsets * 100.0 / file_size).astype(int)
+                progress_rows = np.flatnonzero(np.diff(np.concatenate(([old_progress], sim_progress))))
+                if progress is not None:
+                    for row in progress_rows.tolist():
+                        progress(int(sim_progress[row]), rownum + row + 1)
+                old_progress = sim_progress[-1]
+
+                if state is not None:
+                    state.update(
+                        rownum=rownum + len(sim_rows),
+                        offset=int(sim_offsets[-1]),
+                        motor_steps_old=[int(step) for step in motor_steps_old],
+                        zero_suppression=[int(value) for value in zero_suppression],
+                        progress=int(old_progress),
+                        last_steps=last_steps.tolist(),
+                        compact_anchor=compact_anchor
+                    )
+
+                yield sim_rownums, sim_block, sim_times, sim_steps
+                rownum += len(sim_rows)
+                self.conversion_rownum = rownum
+        except Exception:
+            if pool is not None:
+                pool.terminate()
+                pool = None
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def compact_block(self, sim_steps, sim_times, anchor):
+        """Unisce le righe di un blocco allineate nello spazio degli step, come descritto in compact_steps
+
+        anchor sono gli step dell'ultima riga tenuta, None all'inizio della simulazione, quando la prima riga viene
+        sempre tenuta perche' parte dalla posizione attuale. Restituisce la maschera delle righe da scrivere ed il
+        loro tempo dalla riga tenuta precedente.
+        """
+
+        keep = np.ones(len(sim_times), dtype=np.uint8)
+        merged_times = np.array(sim_times, dtype=np.int64)
+        first = 0
+        if anchor is None:
+            anchor = sim_steps[0]
+            first = 1
+        if len(sim_times) > first:
+            kinematic_cy.compact_steps(
+                np.ascontiguousarray(sim_steps[first:], dtype=np.int64), merged_times[first:].copy(),
+                np.array(anchor, dtype=np.int64), self.compact_tolerance, self.compact_max_time,
+                keep[first:], merged_times[first:]
+            )
+
+        return keep.view(bool), merged_times
+
+    def preconvert(self, filename_complete):
+        """Converte una simulazione direttamente nella cache delle conversioni, senza toccare i file motore
+
+        Serve a rendere immediata una successiva importazione dello stesso file. Le simulazioni non valide o con
+        violazioni dei limiti non vengono salvate. Restituisce True se alla fine la conversione e' nella cache.
+        """
+
+        if not self.conversion_cache.is_enabled():
+            return False
+
+        is_binary = self.tripod.config.MOT_BINARY
+        cache_key = ConversionCache.key(filename_complete, self.conversion_md5)
+        cache_path = self.tripod.config.CONVERSION_CACHE_PATH
+        output_files = self.conversion_files('', '', is_binary)
+        if self.conversion_cache.contains(cache_key, output_files):
+            return True
+
+        # I file vengono prodotti in una directory temporanea della cache, ignorata dalla pulizia
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path, 0777)
+        temp_path = tempfile.mkdtemp(suffix='.tmp', dir=cache_path)
+        try:
+            output_files = self.conversion_files(temp_path + '/', temp_path + '/conversione_angoli_step.csv',
+                                                 is_binary)
+            try:
+                report, lines = self.convert_simulation(filename_complete, output_files, is_binary,
+                                                        is_background=True)
+            except SimFormatError as e:
+                logging.warn("Pre-conversione di {} non riuscita: {}".format(filename_complete, e))
+                return False
+            if not report.is_empty():
+                logging.warn("Pre-conversione di {}: limiti superati, non salvata".format(filename_complete))
+                return False
+            self.conversion_cache.store(cache_key, output_files)
+            logging.info("Pre-conversione di {} completata, {} righe".format(filename_complete, lines - 1))
+            return True
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def abort_import(self):
+        """Chiede l'interruzione dell'importazione in corso, che termina alla fine del blocco in conversione"""
+
+        self.import_abort.set()
+
+    def update_import_progress(self, value, rownum):
+
+        if self.import_pipe is not None:
+            self.import_pipe.send(('progress', value, rownum))
+        elif reactor:
+            reactor.callFromThread(self.tripod.update_import_progress, value, rownum)
+
+    def update_import_end(self, md5sum):
+
+        if self.import_pipe is not None:
+            self.import_pipe.send(('end', md5sum))
+        elif reactor:
+            reactor.callFromThread(self.tripod.update_import_end, md5sum)
+
+    def trajectories_to_text(self):
+        """Genera i file motore di testo per il canopen_server dalle traiettorie binarie dell'ultima importazione"""
+
+        for motor in self.tripod.motor_address_list:
+            trajectory_name = '{}{}{}'.format(self.tripod.config.MOT_DATA, motor, self.tripod.config.TRJ_EXT)
+            if not os.path.exists(trajectory_name):
+                continue
+            file_name = '{}{}{}'.format(self.tripod.config.MOT_DATA, motor, self.tripod.config.MOT_EXT)
+            MotorTrajectory.open(trajectory_name).to_text(file_name)
+            os.chmod(file_name, 0666)
+            logging.info("File {} generato da {}".format(file_name, trajectory_name))
+
+    def format_limits_err(self, report):
+
+        if self.tcp_protocol is not None:
+            self.tcp_protocol.sendLine('CERR CT3 2: {}'.format(report.to_json()))
+        logging.error('CERR CT3 2: Limits violated: {}'.format(report.to_json()))
+        self.update_import_end("")
 
     def format_pos_limit_err_single(self, direction, motor, motor_step):
 
@@ -1112,15 +2293,21 @@ class Kinematic():
         logging.error('ERR CT1 0: Motor {} {} limit reached ({}, {}, {}, {})'.format(
             motor, edir, motor_step[0], motor_step[1], motor_step[2], motor_step[3]))
 
-    def format_speed_limit_err(self, motor, rownum, col, motor_step, motor_step_old):
-        if self.tcp_protocol is not None:
-            self.tcp_protocol.sendLine('ERR CT3 0: Velocità limite raggiunta nel giunto {} alla linea {}:{}'.format(
-                motor, rownum, col))
-        logging.error('ERR CT3 0: Motor {} speed limit reached on line {}:{} ({}, {}, {}, {})-({}, {}, {}, {})'.format(
-            motor, rownum, col, motor_step[0], motor_step[1], motor_step[2], motor_step[3], motor_step_old[0],
-            motor_step_old[1], motor_step_old[2], motor_step_old[3]))
-        if reactor:
-            reactor.callFromThread(self.tripod.update_import_end, "")
+
+# Cinematica dei processi del pool di conversione, copiata dal processo principale alla creazione del pool
+sim_worker_kinematic = None
+
+
+def sim_worker_init(kinematic):
+
+    global sim_worker_kinematic
+    sim_worker_kinematic = kinematic
+
+
+def sim_worker_convert(sim_block):
+
+    return sim_worker_kinematic.convert_sim_block(sim_block)
+
 
 def test_speed():
 
@@ -1162,6 +2349,19 @@ def test_speed_fast():
     total_time = ((time.time() - start) / iterations) * 1000000
     print "Pure cython implementation {:06.2f} us / cycle, {} cycles in {:04.2f}ms".format(total_time / cycles, cycles, total_time / 1000.0)
 
+def test_speed_batch():
+
+    iterations = 500
+    pos = np.zeros((iterations, 4))
+    pos[:, 1] = +0.0532
+    pos[:, 2] = -0.0532 + 0.5 * (np.arange(iterations) % 2)
+    pos[:, 3] = -0.5 * (np.arange(iterations) % 2)
+    start = time.time()
+    angles = k.find_solution_batch(pos)
+    total_time = ((time.time() - start) / iterations) * 1000000
+    cycles = angles[:, 3].mean()
+    print "Batch cython implementation {:06.2f} us / cycle, {} cycles in {:04.2f}ms".format(total_time / cycles, cycles, total_time / 1000.0)
+
 def test_pitch_problem():
 
     sin_step = 1000
@@ -1326,6 +2526,7 @@ if __name__ == '__main__':
     # Provo la velocita'
     test_speed()
     test_speed_fast()
+    test_speed_batch()
     k.calc_ik(29, 0, 0)
 
     # Provo la cinematica inversa e trovo la combinazione di angoli che porta alla posizione limite dell'attuatore
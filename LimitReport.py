@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import json
+import numpy as np
+
+
+class LimitReport():
+    """Raccolta delle violazioni trovate durante l'importazione di una simulazione
+
+    Le violazioni sono raggruppate per tipo e motore:
+
+        - ik: cinematica inversa senza soluzione, valore l'errore residuo in gradi
+        - time: tempo della riga nullo o negativo, valore il tempo in ms
+        - position: posizione oltre i limiti fisici, valore la posizione in step
+        - speed: velocita' oltre il limite, valore la velocita' in step/s
+
+    Per ognuna vengono contate le righe, memorizzati i primi MAX_RANGES intervalli di righe consecutive ed il
+    valore peggiore, in modo che il rapporto resti compatto anche con milioni di righe sbagliate.
+    """
+
+    MAX_RANGES = 10
+
+    def __init__(self):
+
+        self.violations = {}
+
+    def add(self, kind, motor, rownums, values, limit):
+        """Aggiunge le violazioni di un blocco, rownums deve essere ordinato"""
+
+        if rownums.size == 0:
+            return
+
+        key = (kind, motor)
+        if key not in self.violations:
+            self.violations[key] = {
+                'type': kind,
+                'motor': motor,
+                'count': 0,
+                'limit': limit,
+                'worst': None,
+                'worst_row': None,
+                'ranges': [],
+                'truncated': False
+            }
+        violation = self.violations[key]
+        violation['count'] += rownums.size
+
+        worst = np.argmax(np.abs(values))
+        if violation['worst'] is None or abs(values[worst]) > abs(violation['worst']):
+            violation['worst'] = values[worst].item()
+            violation['worst_row'] = rownums[worst].item()
+
+        # Intervalli di righe consecutive, unendo il primo all'ultimo del blocco precedente se contiguo
+        breaks = np.flatnonzero(np.diff(rownums) != 1)
+        starts = rownums[np.concatenate(([0], breaks + 1))].tolist()
+        ends = rownums[np.concatenate((breaks, [rownums.size - 1]))].tolist()
+        ranges = violation['ranges']
+        for start, end in zip(starts, ends):
+            if ranges and ranges[-1][1] + 1 == start:
+                ranges[-1][1] = end
+            elif len(ranges) < LimitReport.MAX_RANGES:
+                ranges.append([start, end])
+            else:
+                violation['truncated'] = True
+
+    def is_empty(self):
+
+        return len(self.violations) == 0
+
+    def to_json(self):
+        """Rapporto su una sola riga, per il protocollo di controllo"""
+
+        order = {'ik': 0, 'time': 1, 'position': 2, 'speed': 3}
+        violations = sorted(self.violations.values(), key=lambda v: (order[v['type']], v['motor']))
+
+        return json.dumps({'violations': violations}, separators=(',', ':'), sort_keys=True)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import sys
+import numpy as np
+
+
+class MotorTrajectory():
+    """Traiettoria di un motore in formato binario
+
+    Il file e' composto da un'intestazione di HEADER_SIZE byte, seguita dagli step di ogni riga come int32 e dai
+    tempi in ms come uint16 o uint32, a seconda del tempo massimo. L'intestazione contiene:
+
+        - il codice ALMT e la versione del formato
+        - l'indirizzo del motore
+        - la dimensione in byte dei tempi
+        - il numero di righe
+        - l'md5 del file di simulazione da cui e' stata generata
+
+    Gli step sono gia' nel segno del file di testo, CT1 M<motore> S<step> T<tempo>, che viene generato solo quando
+    serve al canopen_server con to_text.
+
+    Per scrivere si usa create, poi append per ogni blocco e close; per leggere open, che mappa i dati in memoria.
+    """
+
+    MAGIC = 'ALMT'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHHxxQ16s')
+    HEADER_SIZE = 64
+
+    # Righe convertite per volta nella copia dei tempi e nella conversione in testo
+    CHUNK_ROWS = 65536
+
+    def __init__(self, filename, motor):
+
+        self.filename = filename
+        self.motor = motor
+        self.rows = 0
+        self.source_md5 = ''
+        self.steps = None
+        self.times = None
+
+        # Solo in scrittura, i tempi vengono accumulati a parte finche' non si conosce il massimo
+        self.data_file = None
+        self.times_file = None
+        self.max_time = 0
+
+    @staticmethod
+    def create(filename, motor):
+        """Crea una traiettoria vuota da riempire con append"""
+
+        trajectory = MotorTrajectory(filename, motor)
+        trajectory.data_file = open(filename, 'w+b')
+        trajectory.data_file.write('\0' * MotorTrajectory.HEADER_SIZE)
+        trajectory.times_file = open(filename + '.times.tmp', 'w+b')
+
+        return trajectory
+
+    @staticmethod
+    def resume(filename, motor, rows, max_time):
+        """Riapre una traiettoria non ancora chiusa per proseguirla dopo le prime rows righe"""
+
+        trajectory = MotorTrajectory(filename, motor)
+        trajectory.data_file = open(filename, 'r+b')
+        trajectory.times_file = open(filename + '.times.tmp', 'r+b')
+        for data_file, size in ((trajectory.data_file, MotorTrajectory.HEADER_SIZE + rows * 4),
+                                (trajectory.times_file, rows * 4)):
+            data_file.seek(0, os.SEEK_END)
+            if data_file.tell() < size:
+                raise IOError("File {} piu' corto della posizione di ripresa".format(data_file.name))
+            data_file.truncate(size)
+            data_file.seek(size)
+        trajectory.rows = rows
+        trajectory.max_time = max_time
+
+        return trajectory
+
+    def position(self):
+        """Righe scritte e tempo massimo, per riprendere la scrittura con resume"""
+
+        self.data_file.flush()
+        self.times_file.flush()
+
+        return {'rows': self.rows, 'max_time': self.max_time}
+
+    def sync(self):
+
+        os.fsync(self.data_file.fileno())
+        os.fsync(self.times_file.fileno())
+
+    def append(self, steps, times):
+        """Aggiunge un blocco di righe, steps e times sono array della stessa lunghezza"""
+
+        steps = np.asarray(steps)
+        if steps.size and (steps.min() < -2 ** 31 or steps.max() >= 2 ** 31):
+            raise ValueError("Step del motore {} fuori dal formato a 32 bit".format(self.motor))
+
+        steps.astype('<i4').tofile(self.data_file)
+        times = np.asarray(times).astype('<u4')
+        times.tofile(self.times_file)
+        if times.size:
+            self.max_time = max(self.max_time, int(times.max()))
+        self.rows += steps.size
+
+    def close(self, source_md5=''):
+        """Completa il file con i tempi e l'intestazione, source_md5 e' il digest binario della simulazione"""
+
+        if self.max_time < 2 ** 16:
+            time_type = '<u2'
+        else:
+            time_type = '<u4'
+
+        self.times_file.seek(0)
+        while True:
+            times = np.fromfile(self.times_file, dtype='<u4', count=MotorTrajectory.CHUNK_ROWS)
+            if not times.size:
+                break
+            times.astype(time_type).tofile(self.data_file)
+        self.times_file.close()
+        os.remove(self.times_file.name)
+        self.times_file = None
+
+        self.source_md5 = source_md5
+        self.data_file.seek(0)
+        self.data_file.write(MotorTrajectory.HEADER.pack(
+            MotorTrajectory.MAGIC, MotorTrajectory.VERSION, int(self.motor), np.dtype(time_type).itemsize, self.rows,
+            source_md5.ljust(16, '\0')
+        ))
+        self.data_file.close()
+        self.data_file = None
+
+    def abandon(self):
+        """Chiude i file senza completarli, lasciando le righe scritte per una ripresa con resume"""
+
+        self.data_file.close()
+        self.times_file.close()
+        self.data_file = None
+        self.times_file = None
+
+    @staticmethod
+    def open(filename):
+        """Apre una traiettoria in lettura, steps e times sono mappati in memoria"""
+
+        with open(filename, 'rb') as trajectory_file:
+            header = trajectory_file.read(MotorTrajectory.HEADER.size)
+        if len(header) < MotorTrajectory.HEADER.size:
+            raise ValueError("File {} troppo corto".format(filename))
+
+        magic, version, motor, time_size, rows, source_md5 = MotorTrajectory.HEADER.unpack(header)
+        if magic != MotorTrajectory.MAGIC or version != MotorTrajectory.VERSION:
+            raise ValueError("File {} non e' una traiettoria ALMT versione {}".format(
+                filename, MotorTrajectory.VERSION))
+        if time_size not in (2, 4):
+            raise ValueError("File {}: dimensione dei tempi {} non valida".format(filename, time_size))
+        expected_size = MotorTrajectory.HEADER_SIZE + rows * (4 + time_size)
+        if os.path.getsize(filename) != expected_size:
+            raise ValueError("File {}: attesi {} byte per {} righe, trovati {}".format(
+                filename, expected_size, rows, os.path.getsize(filename)))
+
+        trajectory = MotorTrajectory(filename, str(motor))
+        trajectory.rows = rows
+        trajectory.source_md5 = source_md5
+        if rows:
+            steps_end = MotorTrajectory.HEADER_SIZE + rows * 4
+            trajectory.steps = np.memmap(filename, dtype='<i4', mode='r', offset=MotorTrajectory.HEADER_SIZE,
+                                         shape=(rows,))
+            trajectory.times = np.memmap(filename, dtype='<u{}'.format(time_size), mode='r', offset=steps_end,
+                                         shape=(rows,))
+        else:
+            trajectory.steps = np.zeros(0, dtype='<i4')
+            trajectory.times = np.zeros(0, dtype='<u4')
+
+        return trajectory
+
+    def to_text(self, filename):
+        """Scrive la traiettoria nel formato testo letto dal canopen_server"""
+
+        prefix = "CT1 M{} S".format(self.motor)
+        with open(filename, 'w') as text_file:
+            for start in range(0, self.rows, MotorTrajectory.CHUNK_ROWS):
+                steps = self.steps[start:start + MotorTrajectory.CHUNK_ROWS].tolist()
+                times = self.times[start:start + MotorTrajectory.CHUNK_ROWS].tolist()
+                text_file.write(''.join(
+                    "{}{} T{}\n".format(prefix, step, time_ms) for step, time_ms in zip(steps, times)
+                ))
+
+
+if __name__ == '__main__':
+
+    # Verifica delle traiettorie passate sulla linea di comando
+    for trajectory_filename in sys.argv[1:]:
+        trajectory = MotorTrajectory.open(trajectory_filename)
+        if trajectory.rows:
+            print "{}: motore {}, {} righe, {:.3f} s, step da {} a {}, simulazione {}".format(
+                trajectory_filename, trajectory.motor, trajectory.rows, trajectory.times.sum(dtype=np.int64) / 1000.0,
+                trajectory.steps.min(), trajectory.steps.max(), trajectory.source_md5.encode('hex'))
+        else:
+            print "{}: motore {}, vuota".format(trajectory_filename, trajectory.motor)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor, main
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implementer
+import errno
+import logging
+import os
+import stat
+
+
+@implementer(IReadDescriptor)
+class PipeReader(object):
+    """Lettura di una FIFO nel reattore, senza thread
+
+    La FIFO viene aperta in modo non bloccante e registrata nel reattore, che chiama doRead quando ci sono dati: le
+    letture sono da read_size byte, divise in righe nel thread del reattore, e line_received viene chiamata per ogni
+    riga completa, senza il fine linea.
+
+    Se la FIFO non esiste viene cercata ogni retry_interval secondi; quando chi scrive la chiude viene riaperta
+    subito, e la lettura riprende al successivo processo che la apre in scrittura.
+    """
+
+    def __init__(self, path, line_received, retry_interval=0.5, read_size=65536):
+
+        self.path = path
+        self.line_received = line_received
+        self.retry_interval = retry_interval
+        self.read_size = read_size
+
+        self.fd = None
+        self.buffer = ''
+        self.retry_call = None
+        self.is_running = False
+
+    def start(self):
+
+        self.is_running = True
+        self.open()
+
+    def stop(self):
+
+        self.is_running = False
+        if self.retry_call is not None and self.retry_call.active():
+            self.retry_call.cancel()
+        self.retry_call = None
+        self.close()
+
+    def open(self):
+
+        self.retry_call = None
+        if not self.is_running:
+            return
+        try:
+            if not stat.S_ISFIFO(os.stat(self.path).st_mode):
+                raise OSError(errno.ENOENT, "Not a FIFO", self.path)
+            self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            self.retry_call = reactor.callLater(self.retry_interval, self.open)
+            return
+
+        logging.info("Pipe {} aperta".format(self.path))
+        self.buffer = ''
+        reactor.addReader(self)
+
+    def close(self):
+
+        if self.fd is not None:
+            reactor.removeReader(self)
+            os.close(self.fd)
+            self.fd = None
+
+    def fileno(self):
+
+        if self.fd is None:
+            return -1
+        return self.fd
+
+    def doRead(self):
+
+        try:
+            data = os.read(self.fd, self.read_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            return main.CONNECTION_LOST
+        if not data:
+            return main.CONNECTION_DONE
+
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.line_received(line)
+
+    def connectionLost(self, reason):
+        """Chi scrive ha chiuso la FIFO, il reattore ha gia' tolto il descrittore"""
+
+        logging.info("Pipe {} chiusa".format(self.path))
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.is_running:
+            self.open()
+
+    def logPrefix(self):
+
+        return 'PipeReader'
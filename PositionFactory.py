@@ -1,17 +1,197 @@
 # -*- coding: utf-8 -*-
 
 from twisted.internet import protocol
+import logging
+import time
 import PositionProtocol
 
+
 class PositionFactory(protocol.Factory):
-    """Factory di gestione del protocollo di invio delle posizioni ALMA"""
+    """Factory di gestione del protocollo di invio delle posizioni ALMA
+
+    Le posizioni vengono inviate a tutti i client collegati: per ogni campione la cinematica diretta viene
+    calcolata una sola volta da compute_position, e la riga da encode_position solo se almeno un client la riceve;
+    gli stessi byte vengono scritti su ogni connessione.
+
+    Ogni client puo' chiedere una frequenza massima (RATE), e quelli congestionati restano sospesi fino allo
+    svuotamento del buffer, ricevendo poi solo la posizione piu' recente: vedi PositionProtocol.
+    """
 
     def __init__(self, tripod):
-        # Devo impedire il collegamento multiplo!
+
         self.tripod = tripod
         self.tripod.position_factory = self
         self.numProtocols = 0
-    
+        self.protocols = []
+
+        # Ultima posizione calcolata e riga corrispondente, codificata solo quando serve
+        self.position = None
+        self.frame = None
+
     def buildProtocol(self, addr):
-        self.tripod.almaPositionProtocol = PositionProtocol.PositionProtocol(self.tripod)
-        return self.tripod.almaPositionProtocol
+
+        position_protocol = PositionProtocol.PositionProtocol(self.tripod)
+        position_protocol.factory = self
+        return position_protocol
+
+    def add_protocol(self, position_protocol):
+
+        self.protocols.append(position_protocol)
+        self.numProtocols = len(self.protocols)
+
+    def remove_protocol(self, position_protocol):
+
+        if position_protocol in self.protocols:
+            self.protocols.remove(position_protocol)
+        self.numProtocols = len(self.protocols)
+
+    def send_position(self):
+        """Invia l'ultima posizione a tutti i client collegati"""
+
+        # Gli angoli servono ad ogni campione, per le velocita' e per il log della simulazione, anche senza client
+        self.position = self.compute_position()
+        self.frame = None
+
+        if not self.protocols:
+            return
+
+        now = time.time()
+        receivers = [
+            position_protocol for position_protocol in self.protocols if position_protocol.wants_position(now)
+        ]
+        if not receivers:
+            return
+
+        frame = self.current_frame()
+        if frame is None:
+            return
+
+        for position_protocol in receivers:
+            position_protocol.send_frame(frame, now)
+
+    def current_frame(self):
+        """Restituisce la riga dell'ultima posizione, codificandola alla prima richiesta"""
+
+        if self.frame is None and self.position is not None:
+            self.frame = self.encode_position(self.position)
+
+        return self.frame
+
+    def compute_position(self):
+        """Calcola angoli e velocita' dell'ultima posizione, e la salva nel log della simulazione"""
+
+        roll = 0.0
+        pitch = 0.0
+        yaw = 0.0
+        v_roll = 0.0
+        v_pitch = 0.0
+        v_yaw = 0.0
+        max_step = 320000    # Sono +/-0.4mt, che con 8000 step / 10 mm fanno +/- 320000
+        max_yaw_step = 2147483648
+
+        # Le posizioni sono gia' convertite in step dal PositionParser
+        motorPos = self.tripod.motorPos
+        motor_front = motorPos['120']
+        motor_rear_right = motorPos['121']
+        motor_rear_left = motorPos['122']
+        motor_yaw = motorPos['119']
+
+        if self.tripod.isImporting:
+
+            # Quando importo un file, gli angoli e le velocità sono sempre nulle
+            pass
+
+        elif (motor_front > max_step) or (motor_front < -max_step):
+
+            # Quando i giunti sono oltre i limiti, le velocità e gli angoli sono sempre nulli
+            logging.info("Limite del giunto 120 superato, {} < {} < {}".format(
+                -max_step, motor_front, max_step))
+
+        elif (motor_rear_right > max_step) or (motor_rear_right < -max_step):
+
+            logging.info("Limite del giunto 121 superato, {} < {} < {}".format(
+                -max_step, motor_rear_right, max_step))
+
+        elif (motor_rear_left > max_step) or (motor_rear_left < -max_step):
+
+            logging.info("Limite del giunto 122 superato, {} < {} < {}".format(
+                -max_step, motor_rear_left, max_step))
+
+        elif (motor_yaw > max_yaw_step) or (motor_yaw < -max_yaw_step):
+
+            logging.info("Limite del giunto 119 superato, {} < {} < {}".format(
+                -max_step, motor_yaw, max_step))
+
+        else:
+
+            # Uso la cinematica per determinare gli angoli dalle posizioni dei giunti, a tavola ferma dalla cache
+            result = self.tripod.kinematic.find_solution_cached(
+                (motor_front, motor_rear_right, motor_rear_left, motor_yaw)
+            )
+
+            # Catturo gli angoli
+            if result:
+
+                roll = self.tripod.kinematic.zyx3
+                pitch = self.tripod.kinematic.zyx2
+                yaw = self.tripod.kinematic.zyx1
+
+                # TODO: Qui dovrei convertire la terna
+                if self.tripod.posTime > 0:
+                    v_roll = (roll - self.tripod.old_roll) / self.tripod.posTime / 1000
+                    v_pitch = (pitch - self.tripod.old_pitch) / self.tripod.posTime / 1000
+                    v_yaw = (yaw - self.tripod.old_yaw) / self.tripod.posTime / 1000
+                    self.tripod.old_roll = roll
+                    self.tripod.old_pitch = pitch
+                    self.tripod.old_yaw = yaw
+
+            # Se sono in simulazione, salvo il dato nel log
+            if self.tripod.canStatus == '8':
+
+                self.tripod.last_sim_time += float(self.tripod.posTime) / 1000.0
+                self.tripod.last_sim_file.write(
+                    "{};{};{};{};{};{};{};{};{}          \n".format(
+                        int(self.tripod.mex_counter),
+                        self.tripod.last_sim_time,
+                        roll,
+                        pitch,
+                        yaw,
+                        float(motor_yaw),
+                        float(motor_front),
+                        float(motor_rear_right),
+                        float(motor_rear_left)
+                    )
+                )
+
+        return (
+            roll, pitch, yaw, v_roll, v_pitch, v_yaw, self.tripod.canStatus, self.tripod.posTime, self.tripod.OpProgress
+        )
+
+    def encode_position(self, position):
+        """Restituisce la riga da inviare per la posizione calcolata da compute_position, o None"""
+
+        roll, pitch, yaw, v_roll, v_pitch, v_yaw, canStatus, posTime, OpProgress = position
+
+        try:
+
+            # R12.321;P-2.231;Y0.000;VR12.121;VP0.000;VY0.000;AS0;T10;C0
+            frame = "R{:+07.3f};P{:+07.3f};Y{:+08.3f};RS{:+07.3f};PS{:+07.3f};YS{:+07.3f};AS{};T{:04.1f};C{:03d}\n"
+            return frame.format(
+                roll,
+                pitch,
+                yaw,
+                v_roll,
+                v_pitch,
+                v_yaw,
+                canStatus,
+                float(posTime),
+                int(OpProgress)
+            )
+
+        except:
+            logging.error("Impossibile inviare lo stato")
+            return None
+
+    def report(self):
+
+        return [position_protocol.report() for position_protocol in self.protocols]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor
+from twisted.python import threadable
+import threading
+
+
+class PositionMailbox():
+    """Passaggio delle posizioni dal lettore della pipe al reattore
+
+    Il lettore, nel suo thread o nel reattore, deposita con put lo stato ricavato dall'ultima riga: la casella
+    contiene solo l'ultimo valore, e il reattore viene svegliato con un'unica chiamata per volta, che consegna a
+    deliver il valore piu' recente. Se il reattore e' in ritardo le posizioni intermedie vengono sovrascritte e
+    contate in dropped, invece di accodare chiamate che consegnerebbero posizioni vecchie.
+
+    Con forward_all ogni posizione viene conservata e consegnata in ordine, sempre con una chiamata per volta, per
+    chi ha bisogno di tutti i campioni (il log della simulazione).
+
+    Se il lettore e' nel reattore (POS_READER 'reactor') la chiamata viene pianificata con callLater, dopo la
+    lettura in corso, senza scrivere sulla pipe di risveglio del reattore come callFromThread.
+    """
+
+    def __init__(self, deliver, forward_all=False):
+
+        self.deliver = deliver
+        self.forward_all = forward_all
+
+        self.lock = threading.Lock()
+        self.values = []
+        self.is_scheduled = False
+        self.dropped = 0
+
+    def put(self, value):
+
+        with self.lock:
+            if self.forward_all or not self.values:
+                self.values.append(value)
+            else:
+                self.values[0] = value
+                self.dropped += 1
+            if self.is_scheduled:
+                return
+            self.is_scheduled = True
+
+        if threadable.isInIOThread():
+            reactor.callLater(0, self.drain)
+        else:
+            reactor.callFromThread(self.drain)
+
+    def drain(self):
+        """Nel reattore, consegna quanto depositato dall'ultima chiamata"""
+
+        with self.lock:
+            values = self.values
+            self.values = []
+            self.is_scheduled = False
+
+        for value in values:
+            self.deliver(value)
+
+    def take_dropped(self):
+        """Restituisce e azzera il numero di posizioni scartate"""
+
+        with self.lock:
+            dropped = self.dropped
+            self.dropped = 0
+
+        return dropped
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import re
+import time
+
+
+class PositionSample(object):
+    """Posizione ricevuta dal canopen_server, con i valori gia' convertiti
+
+    motors e' la tupla degli indirizzi dei motori nell'ordine della riga, steps la lista delle posizioni in step
+    (long), status lo stato del canopen_server (stringa, come canStatus), period il periodo in ms e progress il
+    riempimento dell'interpolatore o l'avanzamento dell'operazione (int).
+    """
+
+    __slots__ = ('motors', 'steps', 'status', 'period', 'progress')
+
+    def __init__(self, motors, steps, status, period, progress):
+
+        self.motors = motors
+        self.steps = steps
+        self.status = status
+        self.period = period
+        self.progress = progress
+
+
+class PositionParser(object):
+    """Interpretazione delle righe delle posizioni: @M119 S0 @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9 C0
+
+    Il formato ha un numero fisso di motori, motor_count: la riga viene accettata se contiene la sequenza di campi
+    nello stesso punto in cui la troverebbe l'espressione regolare usata finora, che resta il riferimento per le
+    righe malformate. I campi sono convertiti una sola volta, senza copie in dizionari di stringhe.
+
+    Le righe con un valore non numerico, che l'espressione regolare accettava ma che fallivano alla conversione
+    successiva, sono considerate malformate: parse restituisce None.
+    """
+
+    def __init__(self, motor_count=5):
+
+        self.motor_count = motor_count
+        self.pattern = re.compile('@M([^ ]*) S([^ ]*) ' * motor_count + 'AS([^ ]*) T([^ ]*) C([^ ]*)')
+
+        # Posizione dei campi nei gruppi dell'espressione regolare
+        self.status_index = 2 * motor_count
+
+    def parse(self, line):
+        """Restituisce il PositionSample della riga, o None se la riga e' malformata"""
+
+        match = self.pattern.search(line)
+        if match is None:
+            return None
+
+        fields = match.groups()
+        index = self.status_index
+        try:
+            return PositionSample(
+                fields[0:index:2],
+                map(long, fields[1:index:2]),
+                fields[index],
+                float(fields[index + 1]),
+                int(fields[index + 2])
+            )
+        except ValueError:
+            return None
+
+
+def test_speed_regex(lines, iterations):
+
+    find_motor_position = re.compile(
+        '@M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) AS([^ ]*) T([^ ]*) C([^ ]*)'
+    )
+    motorPos = dict()
+    start = time.time()
+    for i in range(iterations):
+        for line in lines:
+            canopen_status = find_motor_position.search(line)
+            if canopen_status:
+                motorPos[canopen_status.group(1)] = canopen_status.group(2)
+                motorPos[canopen_status.group(3)] = canopen_status.group(4)
+                motorPos[canopen_status.group(5)] = canopen_status.group(6)
+                motorPos[canopen_status.group(7)] = canopen_status.group(8)
+                motorPos[canopen_status.group(9)] = canopen_status.group(10)
+                canStatus = canopen_status.group(11)
+                posTime = float(canopen_status.group(12))
+                OpProgress = canopen_status.group(13)
+
+                # Le conversioni fatte poi da PositionProtocol.send_position
+                for motor in ('120', '121', '122', '119'):
+                    long(motorPos[motor])
+                for motor in ('120', '121', '122', '119'):
+                    long(motorPos[motor])
+                float(posTime)
+                int(OpProgress)
+    total_time = ((time.time() - start) / iterations / len(lines)) * 1000000
+    print "Regex e dizionario {:06.2f} us / riga".format(total_time)
+
+
+def test_speed_parser(lines, iterations):
+
+    parser = PositionParser()
+    motorPos = dict()
+    start = time.time()
+    for i in range(iterations):
+        for line in lines:
+            sample = parser.parse(line)
+            if sample is not None:
+                for motor, steps in zip(sample.motors, sample.steps):
+                    motorPos[motor] = steps
+    total_time = ((time.time() - start) / iterations / len(lines)) * 1000000
+    print "PositionParser {:06.2f} us / riga".format(total_time)
+
+
+def test_malformed():
+
+    find_motor_position = re.compile(
+        '@M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) AS([^ ]*) T([^ ]*) C([^ ]*)'
+    )
+    parser = PositionParser()
+    lines = [
+        "@M119 S0 @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9 C0",
+        "xx @M119 S-1 @M120 S2 @M121 S3 @M122 S4 @M123 S5 AS8 T9.5 C12 yy",
+        "@M119 S0 @M120 S0 @M119 S0 @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9 C0",
+        "@M119 S0 @M120 S0 @M121 S0 @M122 S0 AS4 T9 C0",
+        "@M119 S0  @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9 C0",
+        "@M119 S0 @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9",
+        "@M119 S0 @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9 C0\r",
+        "",
+    ]
+    for line in lines:
+        canopen_status = find_motor_position.search(line)
+        sample = parser.parse(line)
+        if canopen_status is None:
+            assert sample is None, line
+        else:
+            assert sample is not None, line
+            assert list(sample.motors) == list(canopen_status.groups()[0:10:2]), line
+            assert sample.steps == [long(steps) for steps in canopen_status.groups()[1:10:2]], line
+            assert sample.status == canopen_status.group(11), line
+            assert sample.period == float(canopen_status.group(12)), line
+            assert sample.progress == int(canopen_status.group(13)), line
+
+    # Valori non numerici: l'espressione regolare li accetta, il parser no
+    assert parser.parse("@M119 S @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9 C0") is None
+    assert parser.parse("@M119 S0 @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9,5 C0") is None
+    print "Righe malformate: stesso risultato dell'espressione regolare"
+
+
+if __name__ == '__main__':
+
+    test_lines = [
+        "@M119 S{} @M120 S{} @M121 S{} @M122 S{} @M123 S0 AS8 T10.0 C{}".format(
+            -i * 7, 230000 - i, i * 3 - 1200, 4500 + i, i % 25)
+        for i in range(1000)
+    ]
+
+    test_malformed()
+    test_speed_regex(test_lines, 100)
+    test_speed_parser(test_lines, 100)
@@ -1,122 +1,146 @@
 # -*- coding: utf-8 -*-
 from twisted.protocols.basic import protocol
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 import logging
+import re
+import time
 
 
+@implementer(IPushProducer)
 class PositionProtocol(protocol.Protocol):
-    """Protocollo per l'invio delle posizioni ALMA"""
+    """Protocollo per l'invio delle posizioni ALMA
+
+    Ogni connessione riceve le righe calcolate da PositionFactory.send_position, e conta righe, byte ed errori di
+    invio per le statistiche.
+
+    Il client puo' inviare "RATE n" per ricevere al massimo n posizioni al secondo (0 per riceverle tutte), e riceve
+    "OK RATE n" o "CERR RATE 0". La connessione e' un produttore per il trasporto: quando nel buffer ci sono piu' di
+    POS_SEND_BUFFER byte non ancora inviati l'invio viene sospeso, e alla ripresa il client riceve solo la posizione
+    piu' recente invece di tutte quelle accumulate.
+    """
+
+    # Lunghezza massima dei comandi del client
+    MAX_LINE = 256
 
     def __init__(self, tripod):
         self.tripod = tripod
+        self.find_rate = re.compile('^RATE ([0-9]+(?:\.[0-9]*)?)$')
+        self.buffer = ''
+        self.peer = None
+        self.connection_time = None
+
+        # Frequenza massima richiesta dal client, 0 per tutte le posizioni
+        self.rate = 0.0
+        self.interval = 0.0
+        self.next_time = 0.0
+
+        # Sospensione chiesta dal trasporto e posizione in attesa della ripresa
+        self.is_paused = False
+        self.is_pending = False
+
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0
+        self.decimated = 0
+        self.dropped = 0
 
     def connectionMade(self):
-        self.tripod.position_factory.numProtocols += 1
+        self.peer = self.transport.getPeer()
+        self.connection_time = time.time()
+        self.transport.bufferSize = self.tripod.config.POS_SEND_BUFFER
+        self.transport.registerProducer(self, True)
+        self.tripod.position_factory.add_protocol(self)
         logging.info("Welcome! There are currently {} open connections".format(
             self.tripod.position_factory.numProtocols
         ))
 
     def connectionLost(self, reason=None):
-        self.tripod.position_factory.numProtocols -= 1
-
-    def send_position(self):
-
-        roll = 0.0
-        pitch = 0.0
-        yaw = 0.0
-        v_roll = 0.0
-        v_pitch = 0.0
-        v_yaw = 0.0
-        max_step = 320000    # Sono +/-0.4mt, che con 8000 step / 10 mm fanno +/- 320000
-        max_yaw_step = 2147483648
-
-        if self.tripod.isImporting:
-
-            # Quando importo un file, gli angoli e le velocità sono sempre nulle
-            pass
-
-        elif (long(self.tripod.motorPos['120']) > max_step) or (long(self.tripod.motorPos['120']) < -max_step):
-
-            # Quando i giunti sono oltre i limiti, le velocità e gli angoli sono sempre nulli
-            logging.info("Limite del giunto 120 superato, {} < {} < {}".format(
-                -max_step, self.tripod.motorPos['120'], max_step))
-
-        elif (long(self.tripod.motorPos['121']) > max_step) or (long(self.tripod.motorPos['121']) < -max_step):
-
-            logging.info("Limite del giunto 121 superato, {} < {} < {}".format(
-                -max_step, self.tripod.motorPos['121'], max_step))
-
-        elif (long(self.tripod.motorPos['122']) > max_step) or (long(self.tripod.motorPos['122']) < -max_step):
-
-            logging.info("Limite del giunto 122 superato, {} < {} < {}".format(
-                -max_step, self.tripod.motorPos['122'], max_step))
-
-        elif (long(self.tripod.motorPos['119']) > max_yaw_step) or (long(self.tripod.motorPos['119']) < -max_yaw_step):
-
-            logging.info("Limite del giunto 119 superato, {} < {} < {}".format(
-                -max_step, self.tripod.motorPos['119'], max_step))
-
-        else:
-
-            # Uso la cinematica per determinare gli angoli dalle posizioni dei giunti
-            result = self.tripod.kinematic.find_solution_fast(
-                [
-                    -float(self.tripod.motorPos['120']) / self.tripod.kinematic.mt_to_step,
-                    -float(self.tripod.motorPos['121']) / self.tripod.kinematic.mt_to_step,
-                    -float(self.tripod.motorPos['122']) / self.tripod.kinematic.mt_to_step,
-                    float(self.tripod.motorPos['119']) / self.tripod.kinematic.radians_to_step
-                ]
-            )
-
-            # Catturo gli angoli
-            if result:
-
-                roll = self.tripod.kinematic.zyx3
-                pitch = self.tripod.kinematic.zyx2
-                yaw = self.tripod.kinematic.zyx1
-
-                # TODO: Qui dovrei convertire la terna
-                if self.tripod.posTime > 0:
-                    v_roll = (roll - self.tripod.old_roll) / self.tripod.posTime / 1000
-                    v_pitch = (pitch - self.tripod.old_pitch) / self.tripod.posTime / 1000
-                    v_yaw = (yaw - self.tripod.old_yaw) / self.tripod.posTime / 1000
-                    self.tripod.old_roll = roll
-                    self.tripod.old_pitch = pitch
-                    self.tripod.old_yaw = yaw
-
-            # Se sono in simulazione, salvo il dato nel log
-            if self.tripod.canStatus == '8':
-
-                self.tripod.last_sim_time += float(self.tripod.posTime) / 1000.0
-                self.tripod.last_sim_file.write(
-                    "{};{};{};{};{};{};{};{};{}          \n".format(
-                        int(self.tripod.mex_counter),
-                        self.tripod.last_sim_time,
-                        roll,
-                        pitch,
-                        yaw,
-                        float(self.tripod.motorPos['119']),
-                        float(self.tripod.motorPos['120']),
-                        float(self.tripod.motorPos['121']),
-                        float(self.tripod.motorPos['122'])
-                    )
-                )
+        self.tripod.position_factory.remove_protocol(self)
+        logging.info("Client delle posizioni scollegato, {}".format(self.report()))
 
-        try:
+    def dataReceived(self, data):
+
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()[:self.MAX_LINE]
+        for line in lines:
+            self.command_received(line.strip())
+
+    def command_received(self, line):
+
+        rate = self.find_rate.search(line)
+        if rate:
+            self.rate = float(rate.group(1))
+            if self.rate > 0:
+                self.interval = 1.0 / self.rate
+            else:
+                self.interval = 0.0
+            self.next_time = 0.0
+            logging.info("Client delle posizioni {}: frequenza massima {} Hz".format(self.peer_name(), self.rate))
+            self.transport.write("OK RATE {}\n".format(rate.group(1)))
+        elif line:
+            self.transport.write("CERR RATE 0: Unknown command\n")
 
-            # R12.321;P-2.231;Y0.000;VR12.121;VP0.000;VY0.000;AS0;T10;C0
-            self.transport.write(
-                "R{:+07.3f};P{:+07.3f};Y{:+08.3f};RS{:+07.3f};PS{:+07.3f};YS{:+07.3f};AS{};T{:04.1f};C{:03d}\n".format(
-                    roll,
-                    pitch,
-                    yaw,
-                    v_roll,
-                    v_pitch,
-                    v_yaw,
-                    self.tripod.canStatus,
-                    float(self.tripod.posTime),
-                    int(self.tripod.OpProgress)
-                )
-            )
+    def wants_position(self, now):
+        """Indica se la posizione del campione attuale va inviata a questo client"""
+
+        if self.is_paused:
+            if self.is_pending:
+                self.dropped += 1
+            self.is_pending = True
+            return False
+
+        if now < self.next_time:
+            self.decimated += 1
+            return False
+
+        return True
+
+    def send_frame(self, frame, now):
+
+        try:
+            self.transport.write(frame)
+            self.frames += 1
+            self.bytes += len(frame)
 
         except:
-            logging.error("Impossibile inviare lo stato")
\ No newline at end of file
+            self.errors += 1
+            logging.error("Impossibile inviare lo stato")
+
+        if self.interval > 0:
+            self.next_time += self.interval
+            if self.next_time <= now:
+                self.next_time = now + self.interval
+
+    def pauseProducing(self):
+
+        self.is_paused = True
+
+    def resumeProducing(self):
+
+        self.is_paused = False
+        if self.is_pending:
+            self.is_pending = False
+            frame = self.tripod.position_factory.current_frame()
+            if frame is not None:
+                self.send_frame(frame, time.time())
+
+    def stopProducing(self):
+
+        self.is_paused = True
+        self.is_pending = False
+
+    def peer_name(self):
+
+        if self.peer is None:
+            return "-"
+
+        return "{}:{}".format(self.peer.host, self.peer.port)
+
+    def report(self):
+
+        return "client {}: {} posizioni, {} byte, {} errori, {} oltre la frequenza, {} superate in congestione, " \
+               "in {:.0f} s".format(
+                   self.peer_name(), self.frames, self.bytes, self.errors, self.decimated, self.dropped,
+                   time.time() - (self.connection_time or time.time())
+               )
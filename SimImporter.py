@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor
+import logging
+import multiprocessing
+import os
+import signal
+
+
+class PipeProtocol():
+    """Sostituisce il protocollo TCP nel processo di importazione, le risposte passano dalla pipe"""
+
+    def __init__(self, pipe):
+
+        self.pipe = pipe
+
+    def sendLine(self, line):
+
+        self.pipe.send(('line', line))
+
+
+class SimImporter():
+    """Importazione delle simulazioni (CT3) in un processo separato
+
+    Nel modo "thread" sim_parser gira in un thread dell'interprete del reattore, e per tutta l'importazione
+    contende il GIL al thread di lettura delle posizioni ed all'invio dello stream. Nel modo "process" la
+    conversione avviene in un processo figlio, copia del processo principale, con priorita' SIM_IMPORT_NICE.
+
+    Il figlio invia su una pipe le risposte per il client TCP, l'avanzamento e la fine dell'importazione; un thread
+    del reattore le riceve e le passa al tripode con callFromThread, come fa stream_reader con le posizioni.
+    L'interruzione (CT7) usa lo stesso evento del modo thread, condiviso tra i processi.
+    """
+
+    # Attributi della cinematica impostati da sim_parser, riportati nel processo principale alla fine
+    SHARED_STATE = ('stream_file', )
+
+    def __init__(self, tripod):
+
+        self.tripod = tripod
+        self.tcp_protocol = None
+        self.process = None
+        self.state = None
+        self.end_md5sum = None
+
+    def is_running(self):
+
+        return self.process is not None
+
+    def start(self, sim_file, tcp_protocol=None):
+        """Avvia l'importazione di sim_file, la riga CT3 ricevuta"""
+
+        self.tripod.isImporting = True
+        self.tcp_protocol = tcp_protocol
+        self.state = None
+        self.end_md5sum = None
+        self.tripod.kinematic.import_abort.clear()
+
+        receiver, sender = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(
+            target=SimImporter.run,
+            args=(self.tripod.kinematic, sim_file, sender, self.tripod.config.SIM_IMPORT_NICE),
+            name='SimImporter'
+        )
+        self.process.start()
+        sender.close()
+        logging.info("Importazione di {} avviata nel processo {}".format(sim_file, self.process.pid))
+
+        reactor.callInThread(self.receive, receiver, self.process)
+
+    def stop(self):
+
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+    def receive(self, receiver, process):
+        """Thread che riceve i messaggi del processo di importazione fino alla sua chiusura"""
+
+        while True:
+            try:
+                message = receiver.recv()
+            except (EOFError, IOError):
+                break
+            reactor.callFromThread(self.dispatch, message)
+        receiver.close()
+        process.join()
+        reactor.callFromThread(self.finished, process.exitcode)
+
+    def dispatch(self, message):
+
+        if message[0] == 'line':
+            if self.tcp_protocol is not None:
+                self.tcp_protocol.sendLine(message[1])
+        elif message[0] == 'progress':
+            self.tripod.update_import_progress(message[1], message[2])
+        elif message[0] == 'end':
+            self.end_md5sum = message[1]
+        elif message[0] == 'state':
+            self.state = message[1]
+
+    def finished(self, exitcode):
+        """Fine del processo, la fine dell'importazione arriva al tripode solo dopo aver ripreso lo stato"""
+
+        self.process = None
+        if self.state is not None:
+            for name, value in self.state.items():
+                setattr(self.tripod.kinematic, name, value)
+        if self.end_md5sum is not None:
+            self.tripod.update_import_end(self.end_md5sum)
+        else:
+            logging.error("Processo di importazione terminato con codice {}".format(exitcode))
+            if self.tcp_protocol is not None:
+                self.tcp_protocol.sendLine("CERR CT3 1: Import process terminated with code {}".format(exitcode))
+            self.tripod.update_import_end("")
+
+    @staticmethod
+    def run(kinematic, sim_file, pipe, niceness):
+        """Processo di importazione"""
+
+        # Il processo e' una copia di quello del reattore, ne tolgo i gestori dei segnali
+        signal.set_wakeup_fd(-1)
+        for signal_number in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signal_number, signal.SIG_DFL)
+
+        os.nice(niceness)
+        kinematic.import_pipe = pipe
+        kinematic.tcp_protocol = PipeProtocol(pipe)
+        kinematic.sim_file = sim_file
+        try:
+            kinematic.sim_parser()
+            pipe.send(('state', dict((name, getattr(kinematic, name)) for name in SimImporter.SHARED_STATE)))
+        finally:
+            pipe.close()
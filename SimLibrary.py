@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+from SimLoader import SimLoader, SimFormatError
+
+
+class SimLibrary():
+    """Indice delle simulazioni presenti in SIM_PATH
+
+    Per ogni file viene memorizzato:
+
+        - name: il nome del file
+        - path: il percorso completo
+        - size, mtime: dimensione e data di modifica, per accorgersi dei cambiamenti
+        - md5: l'impronta del contenuto, con cui il file puo' essere richiesto al posto del nome
+        - rows: il numero di righe della simulazione
+        - duration: la durata in ms, somma dei tempi delle righe
+        - status: 'ok' se il file e' leggibile, 'error' altrimenti, con il motivo in error
+
+    L'indice e' salvato in index_file e viene aggiornato in modo incrementale: refresh rilegge solo i file nuovi o
+    modificati. Le ricerche per nome o per md5 sono accessi diretti ai dizionari, con un solo stat per verificare
+    che il file non sia cambiato.
+    """
+
+    def __init__(self, sim_path, index_file, block_bytes=65536):
+
+        self.sim_path = sim_path
+        self.index_file = index_file
+        self.block_bytes = block_bytes
+
+        self.entries = dict()
+        self.by_md5 = dict()
+        self.is_dirty = False
+
+        # Protegge i dizionari, usati dal thread di importazione e dal reattore; un solo refresh alla volta
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+        self.load()
+
+    def load(self):
+
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file) as index:
+                entries = json.load(index)['simulations']
+        except (IOError, ValueError, KeyError) as e:
+            logging.error("Indice delle simulazioni {} non valido: {}".format(self.index_file, e))
+            return
+
+        with self.lock:
+            for entry in entries:
+                entry['path'] = os.path.join(self.sim_path, entry['name'])
+                self.entries[entry['name']] = entry
+                self.by_md5[entry['md5']] = entry['name']
+
+    def save(self):
+
+        # Scrivo in un file temporaneo e lo rinomino, per non lasciare un indice a meta'
+        index_path = os.path.dirname(self.index_file)
+        if index_path and not os.path.exists(index_path):
+            os.makedirs(index_path, 0777)
+        temp_file = "{}.{}.tmp".format(self.index_file, os.getpid())
+
+        with self.lock:
+            with open(temp_file, 'w') as index:
+                json.dump({'simulations': self.list_entries()}, index, sort_keys=True)
+            os.rename(temp_file, self.index_file)
+            self.is_dirty = False
+
+    def list_entries(self):
+
+        return [self.entries[name] for name in sorted(self.entries)]
+
+    def scan_file(self, name, info):
+        """Legge un file della simulazione e ne ricava la voce dell'indice"""
+
+        entry = {
+            'name': name,
+            'path': os.path.join(self.sim_path, name),
+            'size': info.st_size,
+            'mtime': info.st_mtime,
+            'md5': None,
+            'rows': 0,
+            'duration': 0,
+            'status': 'ok',
+            'error': None
+        }
+
+        with open(entry['path'], 'rb') as sim_file:
+            loader = SimLoader(sim_file, self.block_bytes)
+            try:
+                while True:
+                    block = loader.read_block()
+                    if block is None:
+                        break
+                    entry['rows'] += len(block[1])
+                    entry['duration'] += int(block[1].sum())
+            except SimFormatError as e:
+                entry['status'] = 'error'
+                entry['error'] = str(e)
+                # Completo comunque l'impronta del file
+                while True:
+                    data = sim_file.read(1 << 20)
+                    if not data:
+                        break
+                    loader.md5.update(data)
+            entry['md5'] = loader.md5.hexdigest()
+
+        return entry
+
+    def update(self, name):
+        """Aggiorna la voce di un file se e' cambiato, restituisce la voce o None se il file non c'e'"""
+
+        path = os.path.join(self.sim_path, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            info = None
+
+        with self.lock:
+            entry = self.entries.get(name)
+        if info is not None and entry is not None and entry['size'] == info.st_size and \
+                entry['mtime'] == info.st_mtime:
+            return entry
+
+        if info is None or not os.path.isfile(path):
+            new_entry = None
+        else:
+            new_entry = self.scan_file(name, info)
+
+        if entry is None and new_entry is None:
+            return None
+
+        with self.lock:
+            if entry is not None:
+                self.entries.pop(name, None)
+                if self.by_md5.get(entry['md5']) == name:
+                    del self.by_md5[entry['md5']]
+            if new_entry is not None:
+                self.entries[name] = new_entry
+                self.by_md5[new_entry['md5']] = name
+            self.is_dirty = True
+
+        return new_entry
+
+    def refresh(self):
+        """Allinea l'indice al contenuto di sim_path, leggendo solo i file nuovi o modificati
+
+        Restituisce False se era gia' in corso un altro aggiornamento.
+        """
+
+        if not self.refresh_lock.acquire(False):
+            return False
+        try:
+            try:
+                names = set(name for name in os.listdir(self.sim_path) if not name.startswith('.'))
+            except OSError:
+                names = set()
+
+            with self.lock:
+                old_entries = dict(self.entries)
+            for name in names | set(old_entries):
+                self.update(name)
+
+            if self.is_dirty:
+                self.save()
+                logging.info("Indice delle simulazioni aggiornato, {} file".format(len(self.entries)))
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def find(self, key):
+        """Cerca una simulazione per nome o per md5, restituisce la voce aggiornata o None"""
+
+        # Solo file direttamente in sim_path
+        if not key or os.path.basename(key) != key or key.startswith('.'):
+            return None
+
+        with self.lock:
+            name = self.by_md5.get(key, key)
+        entry = self.update(name)
+
+        # Un file nuovo cercato per md5 non e' ancora nell'indice
+        if entry is None and SimLibrary.is_md5(key):
+            self.refresh()
+            with self.lock:
+                name = self.by_md5.get(key)
+            if name is not None:
+                entry = self.update(name)
+
+        if self.is_dirty:
+            self.save()
+
+        return entry
+
+    @staticmethod
+    def is_md5(key):
+
+        return len(key) == 32 and all(c in '0123456789abcdef' for c in key)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import numpy as np
+
+
+class SimFormatError(Exception):
+    """Riga del file di simulazione non valida, con il numero di linea ed il contenuto"""
+
+    def __init__(self, line_num, content, message):
+        Exception.__init__(self, "line {}, content '{}': {}".format(line_num, content, message))
+        self.line_num = line_num
+        self.content = content
+        self.message = message
+
+
+class SimLoader():
+    """Lettore a blocchi del file di simulazione
+
+    Il file e' nella forma:
+
+        <roll>;<pitch>;<yaw>;<time_to_reach_in_ms>;<optional comment>
+        12.321;-2.23;0.001;200;commento opzionale
+        12,321;-2,23;0,012;3210;
+
+    La prima riga e' un'intestazione. Ogni blocco viene convertito in colonne numpy in una volta sola: se tutte le
+    righe del blocco hanno lo stesso numero di campi il testo viene diviso con un'unica split, altrimenti riga per
+    riga. Il separatore decimale puo' essere sia il punto che la virgola, il tempo deve essere intero.
+    """
+
+    def __init__(self, sim_file, block_bytes=65536):
+
+        self.sim_file = sim_file
+        self.block_bytes = block_bytes
+
+        # Byte letti e numero dell'ultima linea letta, contando l'intestazione come linea 1
+        self.bytes_read = 0
+        self.line_num = 0
+
+        # Parte di riga letta ma non ancora convertita
+        self.pending = ''
+
+        # Impronta del contenuto letto, completa alla fine del file
+        self.md5 = hashlib.md5()
+
+        header = self.sim_file.readline()
+        self.md5.update(header)
+        if header:
+            self.bytes_read += len(header)
+            self.line_num += 1
+
+    def resume(self, offset, line_num):
+        """Riprende la lettura dalla posizione offset, alla fine della linea line_num, aggiornando l'impronta"""
+
+        while self.bytes_read < offset:
+            chunk = self.sim_file.read(min(1 << 20, offset - self.bytes_read))
+            if not chunk:
+                raise IOError("File di simulazione piu' corto della posizione di ripresa {}".format(offset))
+            self.md5.update(chunk)
+            self.bytes_read += len(chunk)
+        self.line_num = line_num
+        self.pending = ''
+
+    def read_block(self):
+        """Legge e converte il blocco successivo, di circa block_bytes byte e sempre di righe intere
+
+        Restituisce None alla fine del file, altrimenti:
+
+            - un array (N, 3) con roll, pitch e yaw in gradi
+            - un array di N interi con i tempi in ms
+            - la lista delle N righe lette, senza il fine linea
+            - un array di N posizioni nel file, in byte, alla fine di ogni riga
+
+        Se una riga non e' valida solleva SimFormatError.
+        """
+
+        # Le letture terminano ai multipli di block_bytes nel file, per cui i blocchi dipendono solo dal contenuto e
+        # sono gli stessi anche riprendendo la lettura con resume
+        data = self.pending
+        while True:
+            chunk = self.sim_file.read(self.block_bytes - (self.bytes_read + len(data)) % self.block_bytes)
+            self.md5.update(chunk)
+            data += chunk
+            if not chunk:
+                end = len(data)
+                break
+            end = data.rfind('\n') + 1
+            if end > 0:
+                break
+        self.pending = data[end:]
+        data = data[:end]
+        if not data:
+            return None
+
+        # Fine di ogni riga e numero di separatori per riga, senza scorrere le righe in python
+        buf = np.frombuffer(data, dtype=np.uint8)
+        ends = np.flatnonzero(buf == 10) + 1
+        if ends.size == 0 or ends[-1] != len(data):
+            ends = np.append(ends, len(data))
+        separators = np.diff(np.concatenate(([0], np.cumsum(buf == 59)[ends - 1])))
+
+        first_line = self.line_num + 1
+        offsets = ends + self.bytes_read
+        self.bytes_read += len(data)
+        self.line_num += ends.size
+
+        rows = data.replace('\r', '').split('\n')[:ends.size]
+
+        try:
+            angles, times = SimLoader.parse_columns(rows, separators)
+        except ValueError:
+            # Cerco la riga sbagliata per poterla segnalare
+            SimLoader.check_rows(rows, first_line)
+            raise
+
+        return angles, times, rows, offsets
+
+    @staticmethod
+    def parse_columns(rows, separators):
+        """Converte le righe di un blocco nelle colonne numeriche"""
+
+        row_count = len(rows)
+        text = '\n'.join(rows).replace(',', '.')
+        if np.all(separators == 3) or np.all(separators == 4):
+            # Stesso numero di campi in ogni riga, divido tutto il blocco in una volta
+            stride = int(separators[0]) + 1
+            fields = text.replace('\n', ';').split(';')
+        else:
+            stride = 4
+            fields = []
+            for row in text.split('\n'):
+                fields.extend(row.split(';', 4)[:4])
+            if len(fields) != 4 * row_count:
+                raise ValueError("missing fields")
+
+        angles = np.empty((row_count, 3))
+        angles[:, 0] = np.array(fields[0::stride], dtype=float)
+        angles[:, 1] = np.array(fields[1::stride], dtype=float)
+        angles[:, 2] = np.array(fields[2::stride], dtype=float)
+
+        # La conversione da testo a float e' piu' veloce di quella ad intero, controllo poi che il tempo sia intero
+        times_ms = np.array(fields[3::stride], dtype=float)
+        times = times_ms.astype(np.int64)
+        if not np.all(times == times_ms):
+            raise ValueError("time is not an integer")
+
+        return angles, times
+
+    @staticmethod
+    def check_rows(rows, first_line):
+        """Controlla le righe una ad una, e solleva SimFormatError sulla prima non valida"""
+
+        for line_num, row in enumerate(rows, first_line):
+            fields = row.replace(',', '.').split(';', 4)
+            if len(fields) < 4:
+                raise SimFormatError(line_num, row, "expected at least 4 fields, found {}".format(len(fields)))
+            try:
+                float(fields[0])
+                float(fields[1])
+                float(fields[2])
+                int(fields[3])
+            except ValueError, e:
+                raise SimFormatError(line_num, row, e)
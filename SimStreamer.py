@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import task
+import errno
+import logging
+import os
+import Queue
+import threading
+from LimitReport import LimitReport
+from SimLoader import SimLoader
+
+
+class SimStreamer():
+    """Riproduzione di una simulazione convertita mentre viene eseguita
+
+    Invece di scrivere i file motore e poi avviare la simulazione, i file motore in MOT_DATA sono FIFO, come per il
+    joystick virtuale, e vengono riempiti durante la simulazione:
+
+        - un thread converte il file a blocchi, con gli stessi controlli dell'importazione, e mette le righe gia'
+          formattate in una coda di SIM_STREAM_QUEUE blocchi; se la coda e' piena aspetta
+        - ogni SIM_STREAM_INTERVAL secondi il reattore scrive nelle FIFO le righe che mancano per avere
+          SIM_STREAM_FILL righe nell'interpolatore, secondo il riempimento (OpProgress) indicato dal canopen_server
+
+    Il file completo convertito non viene mai salvato. I limiti sono controllati blocco per blocco prima che le
+    righe vengano messe in coda: se un blocco li supera la riproduzione si ferma alla fine del blocco precedente,
+    chiudendo le FIFO, e viene inviato CERR CT4 2 con il rapporto delle violazioni.
+    """
+
+    # Colonna degli step di ogni motore, le FIFO degli altri motori vengono chiuse subito
+    MOTOR_COLUMNS = {'120': 0, '121': 1, '122': 2, '119': 3}
+
+    def __init__(self, tripod):
+
+        self.tripod = tripod
+        self.tcp_protocol = None
+
+        self.queue = None
+        self.thread = None
+        self.loop = None
+        self.stop_event = threading.Event()
+
+        # Descrittori delle FIFO aperte, e testo non ancora accettato da ognuna
+        self.fifos = dict()
+        self.buffers = dict()
+
+        # Blocco in riproduzione: righe di ogni motore e prossima riga da scrivere
+        self.block = None
+        self.block_row = 0
+        self.rows_sent = 0
+        self.is_underrun = False
+
+    def is_running(self):
+
+        return self.loop is not None and self.loop.running
+
+    def fifo_name(self, motor):
+
+        return '{}{}{}'.format(self.tripod.config.MOT_DATA, motor, self.tripod.config.MOT_EXT)
+
+    def start(self, filename_complete, tcp_protocol=None):
+        """Crea le FIFO ed avvia conversione e riproduzione, va chiamata dal reattore prima di inoltrare CT4"""
+
+        self.stop()
+        self.tcp_protocol = tcp_protocol
+
+        if not os.path.exists(self.tripod.config.MOT_DATA):
+            os.umask(0)
+            os.makedirs(self.tripod.config.MOT_DATA, 0777)
+        for motor in self.tripod.motor_address_list:
+            file_name = self.fifo_name(motor)
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            os.mkfifo(file_name)
+            os.chmod(file_name, 0666)
+            logging.info("Pipe {} created".format(file_name))
+
+        self.queue = Queue.Queue(self.tripod.config.SIM_STREAM_QUEUE)
+        self.stop_event = threading.Event()
+        self.fifos = dict()
+        self.buffers = dict()
+        self.block = None
+        self.block_row = 0
+        self.rows_sent = 0
+        self.is_underrun = False
+
+        self.thread = threading.Thread(target=self.run, args=(filename_complete, self.queue, self.stop_event))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        logging.info("Riproduzione di {} avviata".format(filename_complete))
+        self.loop = task.LoopingCall(self.feed)
+        self.loop.start(self.tripod.config.SIM_STREAM_INTERVAL)
+
+    def stop(self):
+        """Ferma conversione e riproduzione, chiude e rimuove le FIFO"""
+
+        if self.thread is not None:
+            self.stop_event.set()
+            # Svuoto la coda per sbloccare il thread di conversione
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+            self.thread = None
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.close_fifos()
+
+    def close_fifos(self):
+
+        for fd in self.fifos.values():
+            if fd is not None:
+                os.close(fd)
+        self.fifos = dict()
+        self.buffers = dict()
+
+        # Chi legge ha gia' aperto le FIFO, per cui posso rimuoverle: un'importazione successiva deve trovare
+        # dei file normali
+        for motor in self.tripod.motor_address_list:
+            file_name = self.fifo_name(motor)
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def run(self, filename_complete, queue, stop_event):
+        """Thread di conversione"""
+
+        def put(message):
+            while not stop_event.is_set():
+                try:
+                    queue.put(message, timeout=0.5)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        report = LimitReport()
+        try:
+            with open(filename_complete, 'rb') as sim_file:
+                loader = SimLoader(sim_file, self.tripod.config.SIM_BLOCK_BYTES)
+                for sim_rownums, sim_block, sim_times, sim_steps in self.tripod.kinematic.iter_sim_steps(
+                        loader, os.path.getsize(filename_complete), report, use_pool=False):
+                    if not report.is_empty():
+                        put(('error', report))
+                        return
+
+                    # Le righe vengono formattate qui, al reattore resta solo da scriverle
+                    times_text = map(str, sim_times.tolist())
+                    lines = dict()
+                    for motor, column in SimStreamer.MOTOR_COLUMNS.items():
+                        prefix = "CT1 M" + motor + " S"
+                        lines[motor] = [
+                            prefix + step + " T" + time_ms + "\n"
+                            for step, time_ms in zip(map(str, (-sim_steps[:, column]).tolist()), times_text)
+                        ]
+                    if not put(('block', lines)):
+                        return
+            put(('end', None))
+        except Exception as e:
+            logging.error("Errore nella conversione di {}: {}".format(filename_complete, e))
+            put(('failed', e))
+
+    def open_fifos(self):
+        """Apre in scrittura le FIFO, restituisce True quando il canopen_server le ha aperte tutte in lettura"""
+
+        for motor in self.tripod.motor_address_list:
+            if motor in self.fifos:
+                continue
+            try:
+                fd = os.open(self.fifo_name(motor), os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Nessuno in lettura, riprovo al prossimo giro
+                    continue
+                raise
+            if motor in SimStreamer.MOTOR_COLUMNS:
+                self.fifos[motor] = fd
+                self.buffers[motor] = ''
+            else:
+                os.close(fd)
+                self.fifos[motor] = None
+
+        return len(self.fifos) == len(self.tripod.motor_address_list)
+
+    def write(self, motor, data):
+        """Scrive nella FIFO quanto possibile senza bloccare, il resto aspetta il giro successivo"""
+
+        data = self.buffers[motor] + data
+        try:
+            written = os.write(self.fifos[motor], data)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            written = 0
+        self.buffers[motor] = data[written:]
+
+    def feed(self):
+        """Chiamata dal reattore, mantiene pieno l'interpolatore"""
+
+        try:
+            if not self.open_fifos():
+                return
+
+            # Prima di aggiungere righe deve essere stato scritto tutto il blocco precedente
+            if any(self.buffers.values()):
+                for motor in self.buffers:
+                    if self.buffers[motor]:
+                        self.write(motor, '')
+                return
+
+            lines_to_send = int(self.tripod.config.SIM_STREAM_FILL - float(self.tripod.OpProgress))
+            while lines_to_send > 0:
+
+                if self.block is None or self.block_row >= len(self.block['119']):
+                    try:
+                        message, data = self.queue.get_nowait()
+                    except Queue.Empty:
+                        if not self.is_underrun:
+                            logging.warn("Riproduzione: conversione in ritardo alla riga {}".format(self.rows_sent))
+                            self.is_underrun = True
+                        return
+                    if message == 'block':
+                        self.block = data
+                        self.block_row = 0
+                    elif message == 'end':
+                        logging.info("Riproduzione completata, {} righe".format(self.rows_sent))
+                        self.finish()
+                        return
+                    elif message == 'error':
+                        logging.error("Riproduzione interrotta alla riga {}: limiti superati".format(self.rows_sent))
+                        self.send_error("CERR CT4 2: {}".format(data.to_json()))
+                        self.finish()
+                        return
+                    else:
+                        self.send_error("CERR CT4 1: Simulation conversion error: {}".format(data))
+                        self.finish()
+                        return
+
+                end = min(self.block_row + lines_to_send, len(self.block['119']))
+                for motor in self.buffers:
+                    self.write(motor, ''.join(self.block[motor][self.block_row:end]))
+                self.rows_sent += end - self.block_row
+                lines_to_send -= end - self.block_row
+                self.block_row = end
+
+        except OSError as e:
+            # La FIFO e' stata chiusa da chi legge, la simulazione e' terminata
+            logging.error("Riproduzione interrotta alla riga {}: {}".format(self.rows_sent, e))
+            self.stop()
+
+    def finish(self):
+        """Fine della riproduzione: le FIFO vengono chiuse appena svuotate, ed il canopen_server legge la fine file"""
+
+        if any(self.buffers.values()):
+            self.loop.stop()
+            self.loop = task.LoopingCall(self.drain)
+            self.loop.start(self.tripod.config.SIM_STREAM_INTERVAL)
+        else:
+            self.stop()
+
+    def drain(self):
+
+        try:
+            for motor in self.buffers:
+                if self.buffers[motor]:
+                    self.write(motor, '')
+        except OSError as e:
+            logging.error("Riproduzione interrotta: {}".format(e))
+            self.stop()
+            return
+        if not any(self.buffers.values()):
+            self.stop()
+
+    def send_error(self, message):
+
+        if self.tcp_protocol is not None:
+            self.tcp_protocol.sendLine(message)
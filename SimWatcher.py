@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import task
+import logging
+import multiprocessing
+import os
+import signal
+
+
+class SimWatcher():
+    """Pre-conversione in background delle simulazioni presenti in SIM_PATH
+
+    Ogni SIM_WATCH_INTERVAL secondi controlla data di modifica e dimensione dei file .csv in SIM_PATH. Un file nuovo
+    o modificato viene convertito nella cache delle conversioni quando risulta invariato per due controlli
+    consecutivi, in modo da non leggere un file ancora in copia. Un successivo CT3 dello stesso file prende cosi' i
+    file motore direttamente dalla cache.
+
+    La conversione avviene in un processo separato, a priorita' SIM_PRECONVERT_NICE, un file alla volta. Per non
+    disturbare il funzionamento del tripode il processo viene sospeso (SIGSTOP) durante la SIMULAZIONE e durante
+    un'importazione, e ripreso (SIGCONT) alla fine.
+    """
+
+    def __init__(self, tripod):
+
+        self.tripod = tripod
+
+        # Data di modifica e dimensione di ogni file all'ultimo controllo, e dei file gia' convertiti
+        self.files = dict()
+        self.converted = dict()
+
+        # File pronti da convertire, in ordine di arrivo
+        self.pending = []
+
+        # Conversione in corso, con data di modifica e dimensione del file alla partenza
+        self.process = None
+        self.current = None
+        self.current_signature = None
+        self.is_paused = False
+
+        self.loop = task.LoopingCall(self.poll)
+
+    def start(self):
+
+        if not self.tripod.kinematic.conversion_cache.is_enabled():
+            logging.warn("Cache delle conversioni disattivata, pre-conversione delle simulazioni non avviata")
+            return
+        logging.info("Pre-conversione delle simulazioni in {} avviata".format(self.tripod.config.SIM_PATH))
+        self.loop.start(self.tripod.config.SIM_WATCH_INTERVAL)
+
+    def stop(self):
+
+        if self.loop.running:
+            self.loop.stop()
+        if self.process is not None and self.process.is_alive():
+            if self.is_paused:
+                os.kill(self.process.pid, signal.SIGCONT)
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+
+    def is_busy(self):
+        """Il tripode sta lavorando, la pre-conversione deve aspettare"""
+
+        return self.tripod.canStatus == '8' or self.tripod.isImporting
+
+    def check_pause(self):
+        """Sospende o riprende la conversione in corso a seconda dello stato del tripode"""
+
+        if self.process is None or not self.process.is_alive():
+            return
+        if self.is_busy() and not self.is_paused:
+            os.kill(self.process.pid, signal.SIGSTOP)
+            self.is_paused = True
+            logging.info("Pre-conversione di {} sospesa".format(self.current))
+        elif not self.is_busy() and self.is_paused:
+            os.kill(self.process.pid, signal.SIGCONT)
+            self.is_paused = False
+            logging.info("Pre-conversione di {} ripresa".format(self.current))
+
+    def poll(self):
+
+        self.scan()
+
+        # Conversione terminata
+        if self.process is not None and not self.process.is_alive():
+            self.process.join()
+            if self.process.exitcode != 0:
+                logging.error("Pre-conversione di {} terminata con codice {}".format(
+                    self.current, self.process.exitcode))
+            self.converted[self.current] = self.current_signature
+            self.process = None
+            self.current = None
+            self.is_paused = False
+
+        self.check_pause()
+
+        if self.process is None and self.pending and not self.is_busy():
+            self.current = self.pending.pop(0)
+            self.current_signature = self.files[self.current]
+            logging.info("Pre-conversione di {}".format(self.current))
+            self.process = multiprocessing.Process(
+                target=SimWatcher.preconvert,
+                args=(self.tripod.kinematic, self.tripod.config.SIM_PATH + self.current,
+                      self.tripod.config.SIM_PRECONVERT_NICE),
+                name='SimWatcher'
+            )
+            self.process.daemon = True
+            self.process.start()
+
+    def scan(self):
+        """Aggiorna i file presenti, mettendo in coda quelli nuovi o modificati che non cambiano piu'"""
+
+        try:
+            names = [name for name in os.listdir(self.tripod.config.SIM_PATH) if name.lower().endswith('.csv')]
+        except OSError:
+            return
+
+        files = dict()
+        for name in names:
+            try:
+                info = os.stat(self.tripod.config.SIM_PATH + name)
+            except OSError:
+                continue
+            files[name] = (info.st_mtime, info.st_size)
+            is_stable = self.files.get(name) == files[name]
+            if is_stable and self.converted.get(name) != files[name] and name != self.current and \
+                    name not in self.pending:
+                self.pending.append(name)
+
+        # I file rimossi o modificati nel frattempo escono dalla coda
+        self.pending = [name for name in self.pending if self.files.get(name) == files.get(name)]
+        self.files = files
+
+    @staticmethod
+    def preconvert(kinematic, filename_complete, niceness):
+
+        os.nice(niceness)
+        kinematic.preconvert(filename_complete)
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import os
+import Queue
+import threading
+import numpy as np
+from MotorTrajectory import MotorTrajectory
+
+
+class SimWriter():
+    """Scrittura a blocchi dei file prodotti dalla conversione di una simulazione
+
+    Per ogni blocco di righe convertite riceve gli angoli, i tempi e gli step dei motori, nell'ordine 120, 121, 122,
+    119, gia' con la soppressione degli zeri. Le righe vengono formattate tutte insieme e scritte con un'unica
+    write per file ogni block_rows righe: i file di testo dei motori (o le traiettorie binarie) ed il log
+    conversione_angoli_step.
+
+    La formattazione e la scrittura possono avvenire:
+
+        - inline: nel thread di chi chiama write_block
+        - thread: in un thread dedicato
+        - process: in un processo dedicato, che non contende il GIL al parser
+
+    Negli ultimi due casi i blocchi passano da una coda di queue_size elementi, in modo che il parser si fermi se
+    il disco non tiene il passo invece di accumulare memoria. Gli errori del writer vengono sollevati come IOError
+    da write_block o da close.
+
+    Con checkpoint il writer salva un punto di ripresa dopo aver scritto su disco tutte le righe ricevute; con resume,
+    la posizione salvata in un punto di ripresa, prosegue i file invece di ricrearli.
+    """
+
+    MODES = ('inline', 'thread', 'process')
+
+    # Colonna degli step di ogni motore, i file degli altri motori restano vuoti
+    MOTOR_COLUMNS = {'120': 0, '121': 1, '122': 2, '119': 3}
+
+    def __init__(self, motor_files, log_file, is_binary=False, block_rows=16384, mode='inline', queue_size=4,
+                 resume=None):
+
+        if mode not in SimWriter.MODES:
+            raise ValueError("Modo di scrittura {} non valido".format(mode))
+
+        # Dizionario motore -> file, ed il file del log di conversione
+        self.motor_files = motor_files
+        self.log_file = log_file
+        self.is_binary = is_binary
+        self.block_rows = block_rows
+        self.mode = mode
+        self.resume = resume
+
+        # Stato della scrittura, usato solo da chi formatta
+        self.motor_file = dict()
+        self.log_conversione = None
+        self.time_log = 0.0
+        self.pending = []
+        self.pending_rows = 0
+
+        if mode == 'inline':
+            self.open()
+        else:
+            if mode == 'thread':
+                self.queue = Queue.Queue(queue_size)
+                self.errors = Queue.Queue()
+                self.worker = threading.Thread(target=self.run, name='SimWriter')
+            else:
+                self.queue = multiprocessing.Queue(queue_size)
+                self.errors = multiprocessing.Queue()
+                self.worker = multiprocessing.Process(target=self.run, name='SimWriter')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def open(self):
+        """Apre i file di output"""
+
+        for motor in sorted(self.motor_files):
+            file_name = self.motor_files[motor]
+            logging.warn("File {} opened".format(file_name))
+            if self.resume is not None:
+                position = self.resume['files'][motor]
+                if self.is_binary:
+                    self.motor_file[motor] = MotorTrajectory.resume(
+                        file_name, motor, position['rows'], position['max_time'])
+                else:
+                    self.motor_file[motor] = SimWriter.reopen(file_name, position)
+            elif self.is_binary:
+                self.motor_file[motor] = MotorTrajectory.create(file_name, motor)
+            else:
+                self.motor_file[motor] = open(file_name, "w+")
+            os.chmod(file_name, 0666)
+        if self.resume is not None:
+            self.log_conversione = SimWriter.reopen(self.log_file, self.resume['log'])
+            self.time_log = self.resume['time_log']
+        else:
+            self.log_conversione = open(self.log_file, "w+")
+            self.log_conversione.write("Line;Time;Roll;Pitch;Yaw;Step_119_IK;Step_120_IK;Step_121_IK;Step_122_IK\n")
+
+    @staticmethod
+    def reopen(file_name, size):
+        """Riapre un file di testo per proseguirlo dopo i primi size byte"""
+
+        output = open(file_name, "r+")
+        output.seek(0, os.SEEK_END)
+        if output.tell() < size:
+            output.close()
+            raise IOError("File {} piu' corto della posizione di ripresa".format(file_name))
+        output.truncate(size)
+        output.seek(size)
+
+        return output
+
+    @staticmethod
+    def can_resume(motor_files, log_file, is_binary, position):
+        """Controlla che i file di output contengano almeno quanto scritto fino al punto di ripresa"""
+
+        sizes = [(log_file, position['log'])]
+        for motor, file_name in motor_files.items():
+            if motor not in position['files']:
+                return False
+            if is_binary:
+                rows = position['files'][motor]['rows']
+                sizes.append((file_name, MotorTrajectory.HEADER_SIZE + rows * 4))
+                sizes.append((file_name + '.times.tmp', rows * 4))
+            else:
+                sizes.append((file_name, position['files'][motor]))
+
+        return all(os.path.isfile(file_name) and os.path.getsize(file_name) >= size for file_name, size in sizes)
+
+    def write_block(self, rownums, angles, times, steps):
+        """Accoda un blocco di righe, rownums sono i numeri delle righe nel log"""
+
+        if self.mode == 'inline':
+            self.add_block(rownums, angles, times, steps)
+        else:
+            self.check_errors()
+            self.put(('block', (rownums, angles, times, steps)))
+
+    def checkpoint(self, checkpoint, state):
+        """Salva il punto di ripresa checkpoint con lo stato state del parser, dopo le righe gia' ricevute"""
+
+        if self.mode == 'inline':
+            self.save_checkpoint(checkpoint, state)
+        else:
+            self.check_errors()
+            self.put(('checkpoint', (checkpoint, state)))
+
+    def close(self, source_md5=''):
+        """Scrive le righe rimaste e chiude i file, source_md5 finisce nell'intestazione delle traiettorie"""
+
+        if self.mode == 'inline':
+            self.finish(source_md5)
+        else:
+            self.put(('close', source_md5))
+            self.worker.join()
+            self.check_errors()
+
+    def abandon(self):
+        """Chiude i file senza completarli, dopo un errore od un'interruzione, per poter riprendere la scrittura"""
+
+        if self.mode == 'inline':
+            self.abandon_files()
+        else:
+            self.put(('abandon', None))
+            self.worker.join()
+
+    def put(self, item):
+        """Accoda al writer, accorgendosi se nel frattempo e' terminato"""
+
+        while True:
+            try:
+                self.queue.put(item, timeout=1.0)
+                return
+            except Queue.Full:
+                if not self.worker.is_alive():
+                    raise IOError("Il writer della simulazione e' terminato inaspettatamente")
+
+    def check_errors(self):
+
+        try:
+            error = self.errors.get_nowait()
+        except Queue.Empty:
+            return
+        raise IOError(error)
+
+    def run(self):
+        """Ciclo del thread o processo di scrittura"""
+
+        failed = False
+        try:
+            self.open()
+        except Exception as e:
+            self.errors.put("Errore nell'apertura dei file: {}".format(e))
+            failed = True
+
+        while True:
+            command, args = self.queue.get()
+            # Dopo un errore continuo a svuotare la coda, per non bloccare il parser fino alla chiusura
+            if failed:
+                if command in ('close', 'abandon'):
+                    break
+                continue
+            try:
+                if command == 'block':
+                    self.add_block(*args)
+                elif command == 'checkpoint':
+                    self.save_checkpoint(*args)
+                elif command == 'abandon':
+                    self.abandon_files()
+                    break
+                else:
+                    self.finish(args)
+                    break
+            except Exception as e:
+                logging.error("Errore nella scrittura della simulazione: {}".format(e))
+                self.errors.put("Errore nella scrittura della simulazione: {}".format(e))
+                failed = True
+
+    def add_block(self, rownums, angles, times, steps):
+
+        self.pending.append((rownums, angles, times, steps))
+        self.pending_rows += len(times)
+        if self.pending_rows >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        """Formatta e scrive tutte le righe in attesa"""
+
+        if not self.pending:
+            return
+
+        rownums = np.concatenate([block[0] for block in self.pending])
+        angles = np.concatenate([block[1] for block in self.pending])
+        times = np.concatenate([block[2] for block in self.pending])
+        steps = np.concatenate([block[3] for block in self.pending])
+        self.pending = []
+        self.pending_rows = 0
+
+        # I file motore hanno il segno opposto al log. Ogni colonna viene convertita in testo con una sola map, e
+        # le righe unite con join
+        motors = [motor for motor in self.motor_file if motor in SimWriter.MOTOR_COLUMNS]
+        if self.is_binary:
+            for motor in motors:
+                self.motor_file[motor].append(-steps[:, SimWriter.MOTOR_COLUMNS[motor]], times)
+        else:
+            times_text = map(str, times.tolist())
+            for motor in motors:
+                steps_text = map(str, (-steps[:, SimWriter.MOTOR_COLUMNS[motor]]).tolist())
+                prefix = "CT1 M" + motor + " S"
+                self.motor_file[motor].write(
+                    prefix + ("\n" + prefix).join(map(" T".join, zip(steps_text, times_text))) + "\n")
+
+        # Tempo progressivo in secondi, sommato riga per riga come nel log originale
+        time_log = np.cumsum(np.concatenate(([self.time_log], times / 1000.0)))[1:]
+        self.time_log = time_log[-1]
+
+        log_columns = [
+            map(str, rownums.tolist()),
+            map(str, time_log.tolist()),
+            map(str, angles[:, 0].tolist()),
+            map(str, angles[:, 1].tolist()),
+            map(str, angles[:, 2].tolist())
+        ] + [map(str, steps[:, column].tolist()) for column in (3, 0, 1, 2)]
+        self.log_conversione.write("\n".join(map(";".join, zip(*log_columns))) + "\n")
+
+    def save_checkpoint(self, checkpoint, state):
+
+        self.flush()
+
+        # Posizione raggiunta da ogni file, dopo averli scritti su disco
+        position = {'files': dict(), 'time_log': float(self.time_log)}
+        for motor in self.motor_file:
+            if self.is_binary:
+                position['files'][motor] = self.motor_file[motor].position()
+                self.motor_file[motor].sync()
+            else:
+                self.motor_file[motor].flush()
+                os.fsync(self.motor_file[motor].fileno())
+                position['files'][motor] = self.motor_file[motor].tell()
+        self.log_conversione.flush()
+        os.fsync(self.log_conversione.fileno())
+        position['log'] = self.log_conversione.tell()
+
+        state = dict(state)
+        state['writer'] = position
+        checkpoint.save(state)
+
+    def abandon_files(self):
+
+        for motor in sorted(self.motor_file):
+            if self.is_binary:
+                self.motor_file[motor].abandon()
+            else:
+                self.motor_file[motor].close()
+        self.log_conversione.close()
+
+    def finish(self, source_md5):
+
+        self.flush()
+        for motor in sorted(self.motor_file):
+            logging.warn("File {} closed".format(motor))
+            if self.is_binary:
+                self.motor_file[motor].close(source_md5)
+            else:
+                self.motor_file[motor].close()
+        self.log_conversione.close()
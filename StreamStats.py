@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+
+
+class StreamStats():
+    """Statistiche sugli intervalli tra le posizioni ricevute dal canopen_server
+
+    Per ogni posizione viene misurato l'intervallo dalla precedente, nel reattore, separatamente durante
+    un'importazione e fuori: la deviazione standard e l'intervallo massimo misurano il jitter dello stream inviato
+    ai client, e permettono di confrontare i modi di importazione.
+    """
+
+    def __init__(self):
+
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+
+        # Per ognuno dei due stati: numero, somma, somma dei quadrati e massimo degli intervalli in secondi
+        self.samples = {
+            False: [0, 0.0, 0.0, 0.0],
+            True: [0, 0.0, 0.0, 0.0]
+        }
+
+    def add(self, is_importing, now=None):
+
+        if now is None:
+            now = time.time()
+        if self.last_time is not None:
+            interval = now - self.last_time
+            samples = self.samples[is_importing]
+            samples[0] += 1
+            samples[1] += interval
+            samples[2] += interval * interval
+            samples[3] = max(samples[3], interval)
+        self.last_time = now
+
+    def summary(self, is_importing):
+        """Restituisce numero di intervalli, media, deviazione standard e massimo in ms, o None senza dati"""
+
+        count, total, total_squares, maximum = self.samples[is_importing]
+        if count == 0:
+            return None
+        mean = total / count
+        std = math.sqrt(max(total_squares / count - mean * mean, 0.0))
+
+        return count, mean * 1000.0, std * 1000.0, maximum * 1000.0
+
+    def report(self):
+
+        lines = []
+        for is_importing, label in ((False, "normale"), (True, "in importazione")):
+            summary = self.summary(is_importing)
+            if summary is not None:
+                lines.append("stream {}: {} intervalli, media {:.2f} ms, jitter {:.2f} ms, massimo {:.2f} ms".format(
+                    label, *summary))
+
+        return lines
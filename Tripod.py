@@ -4,10 +4,17 @@ from twisted.internet import reactor, task
 from Config import Config
 from Canopen import Canopen
 from Kinematic import Kinematic
+from PipeReader import PipeReader
+from PositionMailbox import PositionMailbox
+from PositionParser import PositionParser
+from SimImporter import SimImporter
+from SimStreamer import SimStreamer
+from SimWatcher import SimWatcher
+from StreamStats import StreamStats
 import os
-import re
 from time import sleep
 import stat
+import threading
 import logging
 import ConfigParser
 
@@ -40,8 +47,13 @@ class Tripod():
         self.config = Config()
         self.canopen = Canopen(self)
         self.kinematic = Kinematic(self)
+        self.sim_watcher = SimWatcher(self)
+        self.sim_streamer = SimStreamer(self)
+        self.sim_importer = SimImporter(self)
+        self.stream_stats = StreamStats()
+        self.position_mailbox = PositionMailbox(self.position_update, self.config.POS_FORWARD_ALL)
 
-        self.almaPositionProtocol = None
+        self.position_factory = None
 
         self.last_sim = ""
         self.last_sim_file = None
@@ -67,6 +79,18 @@ class Tripod():
         self.mex_counter = 0L
         self.almaControlProtocol = None
         self.isReading = False
+        self.pos_reader = None
+
+        # Ultimo stato letto dallo stream delle posizioni del canopen_server
+        self.stream_state = {
+            'motorPos': {'120': 0L, '121': 0L, '122': 0L, '119': 0L},
+            'isAsyncError': False,
+            'canStatus': '3',
+            'isCentered': False,
+            'posTime': 0.0,
+            'OpProgress': 0,
+            'mex_counter': 0L
+        }
 
         self.antenna_weight = 50
 
@@ -78,16 +102,26 @@ class Tripod():
         self.old_pitch = 0.0
         self.old_yaw = 0.0
 
-        # Compila i cercatori
-        self.find_motor_position = re.compile(
-            '@M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) AS([^ ]*) T([^ ]*) C([^ ]*)'
-        )
+        # Interprete delle righe delle posizioni
+        self.position_parser = PositionParser()
 
         self.joy_call = None
 
         # Per prima cosa aggiorno lo stato
         self.update_output()
 
+        # Allinea l'indice delle simulazioni al disco, all'avvio del reattore
+        reactor.callInThread(self.kinematic.sim_library.refresh)
+
+        # Avvia la pre-conversione delle simulazioni, se richiesta
+        if self.config.SIM_PRECONVERT:
+            self.sim_watcher.start()
+
+        # Statistiche periodiche sul jitter dello stream delle posizioni
+        if self.config.STREAM_STATS_INTERVAL > 0:
+            self.stream_stats_call = task.LoopingCall(self.log_stream_stats)
+            self.stream_stats_call.start(self.config.STREAM_STATS_INTERVAL, now=False)
+
         self.motor_file = dict()
         self.joy_value = dict()
         self.joy_direction = 1
@@ -117,14 +151,19 @@ class Tripod():
         # Invia CT6, spegnimento
         reactor.callFromThread(self.canopen.sendCommand, 'CT6')
 
-        # Chiude lo streamer
-        if 'almaPositionProtocol' in vars():
-            if self.almaPositionProtocol.posSender:
-                self.almaPositionProtocol.posSender.stop()
-
         # Chiude lo stream_reader
-        if 'receiver_thread' in vars():
-            self.receiver_thread.stop()
+        self.isReading = False
+        if self.pos_reader is not None:
+            self.pos_reader.stop()
+
+        # Ferma la pre-conversione delle simulazioni
+        self.sim_watcher.stop()
+
+        # Ferma la riproduzione in corso
+        self.sim_streamer.stop()
+
+        # Ferma l'importazione in corso, se in un processo separato
+        self.sim_importer.stop()
 
         # Chiude il processo di comunicazione con i motori se attivo
         if self.canopen:
@@ -180,6 +219,18 @@ class Tripod():
         self.isImporting = False
         self.last_sim = md5sum
 
+    def start_stream_reader(self):
+        """Avvia la lettura delle posizioni dal canopen_server, nel reattore o nel thread di stream_reader"""
+
+        if self.config.POS_READER == 'reactor':
+            self.pos_reader = PipeReader(self.config.POS_PIPE, self.position_received)
+            self.pos_reader.start()
+        else:
+            self.isReading = True
+            self.receiver_thread = threading.Thread(target=self.stream_reader)
+            self.receiver_thread.setDaemon(True)
+            self.receiver_thread.start()
+
     def stream_reader(self):
 
         # TODO: Deve ripartire automaticamente in caso di errore ed in caso di assenza di pipe!
@@ -187,44 +238,12 @@ class Tripod():
 
         isPipeOpen = False
 
-        motorPos = {'120': 0L, '121': 0L, '122': 0L, '119': 0L}
-        isAsyncError = False
-        canStatus = '3'
-        isCentered = False
-        OpProgress = 0
-        mex_counter = 0L
-        posTime = 0.0
-
         while self.isReading:
             if isPipeOpen:
                 try:
                     line = pipein.readline()[:-1]
                     # print 'Parent %d got "%s" at %s' % (os.getpid(), line, time.time( ))
-                    # line: @M119 S0 @M120 S0 @M121 S0 @M122 S0 AS4 T9 C0
-                    canopen_status = self.find_motor_position.search(line)
-                    if canopen_status:
-                        motorPos[canopen_status.group(1)] = canopen_status.group(2)
-                        motorPos[canopen_status.group(3)] = canopen_status.group(4)
-                        motorPos[canopen_status.group(5)] = canopen_status.group(6)
-                        motorPos[canopen_status.group(7)] = canopen_status.group(8)
-                        motorPos[canopen_status.group(9)] = canopen_status.group(10)
-
-                        # Se lo stato e' zero, vuol dire che c'e' una segnalazione pendente
-                        if canopen_status.group(11) == '0' and isAsyncError is False:
-                            isAsyncError = True
-                        elif canopen_status.group(11) != '0':
-                            canStatus = canopen_status.group(11)
-                            if not isCentered:
-                                if canStatus == '6':
-                                    isCentered = True
-                        posTime = float(canopen_status.group(12))
-                        OpProgress = canopen_status.group(13)
-                        mex_counter = mex_counter + 1
-
-                    reactor.callFromThread(
-                        self.update_var_from_canopen, motorPos, isAsyncError, canStatus, isCentered,
-                        posTime, OpProgress, mex_counter
-                    )
+                    self.position_received(line)
 
                 except Exception, e:
                     isFileOpen = False
@@ -243,8 +262,48 @@ class Tripod():
 
                     pass
 
+    def position_received(self, line):
+        """Interpreta una riga dello stream delle posizioni del canopen_server, nel thread di lettura
+
+        Lo stato aggiornato viene depositato nella casella delle posizioni, che lo consegna al reattore; le righe
+        malformate non lo modificano e non vengono consegnate.
+        """
+
+        # line: @M119 S0 @M120 S0 @M121 S0 @M122 S0 @M123 S0 AS4 T9 C0
+        state = self.stream_state
+        sample = self.position_parser.parse(line)
+        if sample is None:
+            return
+
+        motorPos = state['motorPos']
+        for motor, steps in zip(sample.motors, sample.steps):
+            motorPos[motor] = steps
+
+        # Se lo stato e' zero, vuol dire che c'e' una segnalazione pendente
+        if sample.status == '0' and state['isAsyncError'] is False:
+            state['isAsyncError'] = True
+        elif sample.status != '0':
+            state['canStatus'] = sample.status
+            if not state['isCentered']:
+                if state['canStatus'] == '6':
+                    state['isCentered'] = True
+        state['posTime'] = sample.period
+        state['OpProgress'] = sample.progress
+        state['mex_counter'] = state['mex_counter'] + 1
+
+        # Il reattore riceve una copia delle posizioni, il dizionario continua ad essere aggiornato dal lettore
+        self.position_mailbox.put((
+            dict(motorPos), state['isAsyncError'], state['canStatus'], state['isCentered'],
+            state['posTime'], state['OpProgress'], state['mex_counter']
+        ))
+
+    def position_update(self, position):
+
+        self.update_var_from_canopen(*position)
+
     def update_var_from_canopen(self, motorPos, isAsyncError, canStatus, isCentered, posTime, OpProgress, mex_counter):
 
+        self.stream_stats.add(self.isImporting)
         self.motorPos = motorPos
         self.isAsyncError = isAsyncError
         self.canStatus = canStatus
@@ -254,9 +313,26 @@ class Tripod():
             self.OpProgress = OpProgress
         self.update_output()
 
-        if self.almaPositionProtocol is not None:
+        # La pre-conversione si ferma subito durante la simulazione
+        self.sim_watcher.check_pause()
+
+        if self.position_factory is not None:
             self.mex_counter = mex_counter
-            self.almaPositionProtocol.send_position()
+            self.position_factory.send_position()
+
+    def log_stream_stats(self):
+
+        for line in self.stream_stats.report():
+            logging.info(line)
+        self.stream_stats.reset()
+
+        if self.position_factory is not None:
+            for line in self.position_factory.report():
+                logging.info(line)
+
+        dropped = self.position_mailbox.take_dropped()
+        if dropped > 0:
+            logging.info("stream: {} posizioni non consegnate perche' superate dalle successive".format(dropped))
 
     def goto_em2(self):
 
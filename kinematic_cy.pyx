@@ -8,21 +8,29 @@
 # gcc -shared -pthread -fPIC -fwrapv -O3 -ffast-math -Wall -fno-strict-aliasing -I/usr/include/python2.7 -o ${filename%.*}.so ${filename%.*}.c
 # cp kinematic_cy.html /home/henry/tripode/
 
-from libc.math cimport sin, cos, sqrt, asin, M_PI
+cimport cython
+from libc.math cimport sin, cos, sqrt, asin, fabs, M_PI, NAN
+
+# Metodi di ricerca degli angoli alla base
+DEF DK_SEARCH = 0
+DEF DK_NEWTON = 1
+
+# Newton-Raphson: errore sulle distanze e numero massimo di iterazioni
+DEF NEWTON_ERR_LIMIT = 1e-10
+DEF NEWTON_CYCLE_LIMIT = 20
 
 cdef struct plane3d_t:
     double x[3]
     double y[3]
     double z[3]
 
-cdef:
+cdef struct solver_t:
     plane3d_t base
     plane3d_t roof
     double real_height, base_length
     double alphas_start[3]
     double alphas_temp[3]
     double alphas_last[3]
-    double motor_positions[3]
     double nodes_height[3]
     double alphas_sin[3]
     double alphas_cos[3]
@@ -32,12 +40,16 @@ cdef:
     double s3_cos30
     double alpha_limit_r
     double step_alpha_base_r
+    int cycle_limit
+    int method
+    bint is_last_valid
     long cycles
     double ke, err_limit
     double roll, pitch, yaw
     double roll_r, pitch_r, yaw_r
 
-def init():
+cdef void solver_init(solver_t *s, double base_radius, double real_height, double alpha_limit, double ke,
+                      double err_limit, int cycle_limit, int method) nogil:
     """
     Ottimizzazioni apportate:
         - tipizzazione dei dati: 10x
@@ -49,180 +61,142 @@ def init():
     """
 
     cdef:
-        double base_radius
-        double alpha_limit
         double step_alpha_base
         double base_height
-
-    global real_height
-    global ke
-    global err_limit
-    global alpha_limit_r
-    global base_length
-    global base
-    global step_alpha_base_r
-    global alphas_temp
-    global motor_positions
-    global nodes_height
-    global alphas_start
-    global alphas_last
+        int i
 
     # COSTANTI ---------------------------------------------------------------------------------------------------
 
-    base_radius = 0.705     # Raggio dei centri dei tre pistoni
-    real_height = 1.685     # Distanza tre i centri cerniera-sfera sullo 0 ( 400mm )
-
-    alpha_limit = 10.0      # Massima escursione dei pistoni in +/- 10 gradi
-    step_alpha_base = 0.1   # Gli incrementi angolari partono da 0.1 gradi
-
-    ke = 150                # Guadagno nella ricerca dell'angolo
-    err_limit = 0.00015     # Errore sotto il quale la soluzione si considera esatta ( 0,1mm )
+    s.real_height = real_height     # Distanza tre i centri cerniera-sfera sullo 0 ( 400mm )
+    s.ke = ke                       # Guadagno nella ricerca dell'angolo
+    s.err_limit = err_limit         # Errore sotto il quale la soluzione si considera esatta ( 0,1mm )
+    s.cycle_limit = cycle_limit     # Massimo numero di cicli della ricerca
+    s.method = method               # Ricerca a passi o Newton-Raphson
+    step_alpha_base = 0.1           # Gli incrementi angolari partono da 0.1 gradi
 
     # COSTANTI CALCOLATE -----------------------------------------------------------------------------------------
 
     # Calcolo le costanti in radianti
-    alpha_limit_r = -alpha_limit / 180.0 * M_PI
+    s.alpha_limit_r = -alpha_limit / 180.0 * M_PI
 
     # Calcolo delle coordinate dei vertici della base
-    base_length = base_radius * sqrt(3)
+    s.base_length = base_radius * sqrt(3)
     base_height = 3 * base_radius / 2
-    base.x[1] = base_height
-    base.y[1] = base_length / 2
-    base.z[1] = base_length / 2
-    base.x[2] = base_height
-    base.y[2] = -base_length / 2
-    base.z[2] = -base_length / 2
+    s.base.x[0] = 0.0
+    s.base.y[0] = 0.0
+    s.base.z[0] = 0.0
+    s.base.x[1] = base_height
+    s.base.y[1] = s.base_length / 2
+    s.base.z[1] = s.base_length / 2
+    s.base.x[2] = base_height
+    s.base.y[2] = -s.base_length / 2
+    s.base.z[2] = -s.base_length / 2
 
     # Minimo incremento dell'angolo
-    step_alpha_base_r = step_alpha_base / 180.0 * M_PI
+    s.step_alpha_base_r = step_alpha_base / 180.0 * M_PI
+
+    for i in range(3):
 
-    # Valori temporanei contenenti gli angoli di base iterati
-    alphas_temp[:] = [0.0, 0.0, 0.0]
+        # Vertici del tetto
+        s.roof.x[i] = 0.0
+        s.roof.y[i] = 0.0
+        s.roof.z[i] = 0.0
 
-    # Posizione in step dei motori
-    motor_positions[:] = [0.0, 0.0, 0.0]
+        # Valori temporanei contenenti gli angoli di base iterati
+        s.alphas_temp[i] = 0.0
 
-    # Posizione dei tre pistoni in metri da terra
-    nodes_height[:] = [0.0, 0.0, 0.0]
+        # Posizione dei tre pistoni in metri da terra
+        s.nodes_height[i] = 0.0
 
-    # Angolo di partenza delle ricerche
-    alphas_start[:] = [alpha_limit_r, alpha_limit_r, alpha_limit_r]
-    alphas_last[:] = [alpha_limit_r, alpha_limit_r, alpha_limit_r]
+        # Angolo di partenza delle ricerche
+        s.alphas_start[i] = s.alpha_limit_r
+        s.alphas_last[i] = s.alpha_limit_r
 
-cdef inline double distance_12():
+    s.is_last_valid = False
+    s.cycles = 0
+    s.roll = 0.0
+    s.pitch = 0.0
+    s.yaw = 0.0
+    s.roll_r = 0.0
+    s.pitch_r = 0.0
+    s.yaw_r = 0.0
+
+cdef inline double distance_12(solver_t *s) nogil:
     """Calcolo della distanta tra i centri sfera dei pistoni 1 e 2
 
     In ingresso vengono forniti i tre angoli ipotetici, e le tre altezze dei pistoni
 
     """
 
-    global roof
-    global nodes_height
-    global alphas_cos
-    global alphas_sin
-    global s2_sin30
-    global s2_cos30
-
-    roof.z[0] = nodes_height[0] * alphas_cos[0]
-    roof.x[0] = nodes_height[0] * alphas_sin[0]
+    s.roof.z[0] = s.nodes_height[0] * s.alphas_cos[0]
+    s.roof.x[0] = s.nodes_height[0] * s.alphas_sin[0]
 
-    roof.z[1] = nodes_height[1] * alphas_cos[1]
-    roof.x[1] = base.x[1] - s2_sin30
-    roof.y[1] = base.y[1] - s2_cos30
+    s.roof.z[1] = s.nodes_height[1] * s.alphas_cos[1]
+    s.roof.x[1] = s.base.x[1] - s.s2_sin30
+    s.roof.y[1] = s.base.y[1] - s.s2_cos30
 
     return sqrt(
-        ((roof.x[1] - roof.x[0]) ** 2) +
-        (roof.y[1] ** 2) +
-        ((roof.z[1] - roof.z[0]) ** 2))
+        ((s.roof.x[1] - s.roof.x[0]) ** 2) +
+        (s.roof.y[1] ** 2) +
+        ((s.roof.z[1] - s.roof.z[0]) ** 2))
 
-cdef inline double distance_23():
+cdef inline double distance_23(solver_t *s) nogil:
     """Calcolo della distanta tra i centri sfera dei pistoni 2 e 3
 
     In ingresso vengono forniti i tre angoli ipotetici, e le tre altezze dei pistoni
 
     """
 
-    global roof
-    global nodes_height
-    global alphas_cos
-    global alphas_sin
-    global s2_sin30
-    global s2_cos30
-    global s3_sin30
-    global s3_cos30
+    #s.roof.z[1] = s.nodes_height[1] * s.alphas_cos[1]
+    #s.roof.x[1] = s.base.x[1] - s.s2_sin30
+    #s.roof.y[1] = s.base.y[1] - s.s2_cos30
 
-    #roof.z[1] = nodes_height[1] * alphas_cos[1]
-    #roof.x[1] = base.x[1] - s2_sin30
-    #roof.y[1] = base.y[1] - s2_cos30
-
-    roof.z[2] = nodes_height[2] * alphas_cos[2]
-    roof.x[2] = base.x[2] - s3_sin30
-    roof.y[2] = base.y[2] + s3_cos30
+    s.roof.z[2] = s.nodes_height[2] * s.alphas_cos[2]
+    s.roof.x[2] = s.base.x[2] - s.s3_sin30
+    s.roof.y[2] = s.base.y[2] + s.s3_cos30
 
     return sqrt(
-        ((roof.x[2] - roof.x[1]) ** 2) +
-        ((roof.y[1] - roof.y[2]) ** 2) +
-        ((roof.z[2] - roof.z[1]) ** 2))
+        ((s.roof.x[2] - s.roof.x[1]) ** 2) +
+        ((s.roof.y[1] - s.roof.y[2]) ** 2) +
+        ((s.roof.z[2] - s.roof.z[1]) ** 2))
 
-cdef inline double distance_13():
+cdef inline double distance_13(solver_t *s) nogil:
     """Calcolo della distanta tra i centri sfera dei pistoni 1 e 3
 
     In ingresso vengono forniti i tre angoli ipotetici, e le tre altezze dei pistoni
 
     """
 
-    global roof
-    global nodes_height
-    global alphas_cos
-    global alphas_sin
-    global s3_sin30
-    global s3_cos30
-
-    #roof.z[0] = nodes_height[0] * alphas_cos[0]
-    #roof.x[0] = nodes_height[0] * alphas_sin[0]
+    #s.roof.z[0] = s.nodes_height[0] * s.alphas_cos[0]
+    #s.roof.x[0] = s.nodes_height[0] * s.alphas_sin[0]
 
-    #roof.z[2] = nodes_height[2] * alphas_cos[2]
-    #roof.x[2] = base.x[2] - s3_sin30
-    #roof.y[2] = base.y[2] + s3_cos30
+    #s.roof.z[2] = s.nodes_height[2] * s.alphas_cos[2]
+    #s.roof.x[2] = s.base.x[2] - s.s3_sin30
+    #s.roof.y[2] = s.base.y[2] + s.s3_cos30
 
     return sqrt(
-        ((roof.x[2] - roof.x[0]) ** 2) +
-        (roof.y[2] ** 2) +
-        ((roof.z[2] - roof.z[0]) ** 2))
-
-cdef inline void update_alfas_precalc():
+        ((s.roof.x[2] - s.roof.x[0]) ** 2) +
+        (s.roof.y[2] ** 2) +
+        ((s.roof.z[2] - s.roof.z[0]) ** 2))
 
-    global alphas_cos
-    global alphas_sin
-    global s2_sin30
-    global s2_cos30
-    global s3_sin30
-    global s3_cos30
+cdef inline void update_alfas_precalc(solver_t *s) nogil:
 
     cdef double s2, s3
 
-    alphas_sin[0] = sin(alphas_temp[0])
-    alphas_cos[0] = cos(alphas_temp[0])
-    alphas_sin[1] = sin(alphas_temp[1])
-    alphas_cos[1] = cos(alphas_temp[1])
-    alphas_sin[2] = sin(alphas_temp[2])
-    alphas_cos[2] = cos(alphas_temp[2])
-    s2 = nodes_height[1] * alphas_sin[1]
-    s2_sin30 = s2 / 2
-    s2_cos30 = s2 / 1.154700538379252
-    s3 = nodes_height[2] * alphas_sin[2]
-    s3_sin30 = s3 / 2
-    s3_cos30 = s3 / 1.154700538379252
-
-cdef int search_base_angles(motor_positions):
-
-    global alphas_temp
-    global alphas_last
-    global base_length
-    global nodes_height
-    global real_height
-    global step_alpha_base_r
-    global cycles
+    s.alphas_sin[0] = sin(s.alphas_temp[0])
+    s.alphas_cos[0] = cos(s.alphas_temp[0])
+    s.alphas_sin[1] = sin(s.alphas_temp[1])
+    s.alphas_cos[1] = cos(s.alphas_temp[1])
+    s.alphas_sin[2] = sin(s.alphas_temp[2])
+    s.alphas_cos[2] = cos(s.alphas_temp[2])
+    s2 = s.nodes_height[1] * s.alphas_sin[1]
+    s.s2_sin30 = s2 / 2
+    s.s2_cos30 = s2 / 1.154700538379252
+    s3 = s.nodes_height[2] * s.alphas_sin[2]
+    s.s3_sin30 = s3 / 2
+    s.s3_cos30 = s3 / 1.154700538379252
+
+cdef int search_base_angles(solver_t *s, double *motor_positions) nogil:
 
     # Errore nelle soluzioni
     cdef:
@@ -231,99 +205,102 @@ cdef int search_base_angles(motor_positions):
         int n, j, i
         double step_alpha[3]
 
-    cycle_limit = 1000
+    cycle_limit = s.cycle_limit
 
     # Angolo di inizio ricerca
-    alphas_temp[0] = alphas_last[0]
-    alphas_temp[1] = alphas_last[1]
-    alphas_temp[2] = alphas_last[2]
-    update_alfas_precalc()
+    s.alphas_temp[0] = s.alphas_last[0]
+    s.alphas_temp[1] = s.alphas_last[1]
+    s.alphas_temp[2] = s.alphas_last[2]
+    update_alfas_precalc(s)
 
     # Altezze reali degli attuatori
-    nodes_height[0] = motor_positions[0] + real_height
-    nodes_height[1] = motor_positions[1] + real_height
-    nodes_height[2] = motor_positions[2] + real_height
+    s.nodes_height[0] = motor_positions[0] + s.real_height
+    s.nodes_height[1] = motor_positions[1] + s.real_height
+    s.nodes_height[2] = motor_positions[2] + s.real_height
 
     # Incrementi degli angoli di base da 1/10 di grado
-    step_alpha[:] = [step_alpha_base_r, step_alpha_base_r, step_alpha_base_r]
+    step_alpha[0] = s.step_alpha_base_r
+    step_alpha[1] = s.step_alpha_base_r
+    step_alpha[2] = s.step_alpha_base_r
 
     # Numero di cicli eseguiti
-    cycles = 0
+    s.cycles = 0
 
     # Calcolo la condizione iniziale
-    err[0] = distance_12() - base_length
-    step_alpha[1] = err[0] * ke * step_alpha_base_r
-    err[1] = distance_23() - base_length
-    step_alpha[2] = err[1] * ke * step_alpha_base_r
-    err[2] = distance_13() - base_length
-    step_alpha[0] = err[2] * ke * step_alpha_base_r
+    err[0] = distance_12(s) - s.base_length
+    step_alpha[1] = err[0] * s.ke * s.step_alpha_base_r
+    err[1] = distance_23(s) - s.base_length
+    step_alpha[2] = err[1] * s.ke * s.step_alpha_base_r
+    err[2] = distance_13(s) - s.base_length
+    step_alpha[0] = err[2] * s.ke * s.step_alpha_base_r
 
     # Ciclo per la variazione di alfa1
     for i in range(cycle_limit):
 
         # Incremento alfa1 ed azzero alfa2
-        alphas_temp[0] += step_alpha[0]
-        alphas_temp[1] = alphas_start[1]
-        update_alfas_precalc()
+        s.alphas_temp[0] += step_alpha[0]
+        s.alphas_temp[1] = s.alphas_start[1]
+        update_alfas_precalc(s)
 
         for j in range(cycle_limit):
 
             #next_iteration(alpha, step_alpha, i, j, n, err)
-            cycles += 1
+            s.cycles += 1
 
-            if cycles > cycle_limit:
+            if s.cycles > cycle_limit:
                 # error_description = "Maximum number of cycles executed, no solution found!"
                 return -2
 
             # Incremento alfa1 ed azzero alfa2
-            alphas_temp[1] += step_alpha[1]
-            update_alfas_precalc()
+            s.alphas_temp[1] += step_alpha[1]
+            update_alfas_precalc(s)
 
             # Se supero l'angolo limite
             # Partendo da -10 ( -0.17 ), non devo superare 10 ( 0.17 )
-            if alphas_temp[1] > -alpha_limit_r:
+            if s.alphas_temp[1] > -s.alpha_limit_r:
 
                 # Angolo non trovato
-                step_alpha[1] = step_alpha_base_r
-                step_alpha[0] = err[0] * ke * step_alpha_base_r
-                alphas_start[1] = -alpha_limit_r - 2 * step_alpha[1]
+                step_alpha[1] = s.step_alpha_base_r
+                step_alpha[0] = err[0] * s.ke * s.step_alpha_base_r
+                s.alphas_start[1] = -s.alpha_limit_r - 2 * step_alpha[1]
                 break
 
-            err[0] = distance_12() - base_length
-            step_alpha[1] = err[0] * ke * step_alpha_base_r
+            err[0] = distance_12(s) - s.base_length
+            step_alpha[1] = err[0] * s.ke * s.step_alpha_base_r
 
-            if abs(err[0]) < err_limit:
+            if fabs(err[0]) < s.err_limit:
 
                 # Trovato il minimo
-                alphas_start[1] = alphas_temp[1]
-                step_alpha[1] = step_alpha_base_r
+                s.alphas_start[1] = s.alphas_temp[1]
+                step_alpha[1] = s.step_alpha_base_r
 
                 for n in range(cycle_limit):
 
                     #next_iteration(alpha, step_alpha, i, j, n, err)
-                    cycles += 1
+                    s.cycles += 1
 
-                    if cycles > cycle_limit:
+                    if s.cycles > cycle_limit:
                         # error_description = "Maximum number of cycles executed, no solution found!"
                         return -2
 
-                    alphas_temp[2] += step_alpha[2]
-                    update_alfas_precalc()
-                    err[1] = distance_23() - base_length
-                    step_alpha[2] = err[1] * ke * step_alpha_base_r
+                    s.alphas_temp[2] += step_alpha[2]
+                    update_alfas_precalc(s)
+                    err[1] = distance_23(s) - s.base_length
+                    step_alpha[2] = err[1] * s.ke * s.step_alpha_base_r
 
-                    if abs(err[1]) < err_limit:
+                    if fabs(err[1]) < s.err_limit:
 
-                        step_alpha[2] = step_alpha_base_r
-                        err[2] = distance_13() - base_length
-                        step_alpha[0] = err[2] * ke * step_alpha_base_r
+                        step_alpha[2] = s.step_alpha_base_r
+                        err[2] = distance_13(s) - s.base_length
+                        step_alpha[0] = err[2] * s.ke * s.step_alpha_base_r
 
-                        if abs(err[2]) < err_limit:
+                        if fabs(err[2]) < s.err_limit:
 
                             # Trovatas la soluzione
-                            alphas_last[0] = alphas_temp[0]
-                            alphas_last[1] = alphas_temp[1]
-                            alphas_last[2] = alphas_temp[2]
+                            s.is_last_valid = True
+                            s.alphas_last[0] = s.alphas_temp[0]
+                            s.alphas_last[1] = s.alphas_temp[1]
+                            s.alphas_last[2] = s.alphas_temp[2]
                             return 0
 
                         # Next n!!!
@@ -332,46 +309,143 @@ cdef int search_base_angles(motor_positions):
                 # Next i!!!
                 break
 
+    # error_description = "Maximum number of cycles executed, no solution found!"
+    return -2
+
+cdef int newton_base_angles(solver_t *s, double *motor_positions) nogil:
+    """Ricerca degli angoli alla base con il metodo di Newton-Raphson
+
+    Risolve direttamente le tre equazioni distance_12/23/13 = base_length, usando lo jacobiano analitico dei
+    quadrati delle distanze. Partendo dalla soluzione precedente bastano in genere due o tre iterazioni.
+
+    """
+
+    cdef:
+        int i
+        double err, base_length_2
+        double e12, e23, e13
+        double dx0, dz0, dx1, dy1, dz1, dx2, dy2, dz2
+        double a, b, c, d, e, f, det
+
+    base_length_2 = s.base_length * s.base_length
+
+    # Angolo di inizio ricerca, il piano orizzontale se non ho una soluzione precedente
+    if s.is_last_valid:
+        s.alphas_temp[0] = s.alphas_last[0]
+        s.alphas_temp[1] = s.alphas_last[1]
+        s.alphas_temp[2] = s.alphas_last[2]
+    else:
+        s.alphas_temp[0] = 0.0
+        s.alphas_temp[1] = 0.0
+        s.alphas_temp[2] = 0.0
+
+    # Altezze reali degli attuatori
+    s.nodes_height[0] = motor_positions[0] + s.real_height
+    s.nodes_height[1] = motor_positions[1] + s.real_height
+    s.nodes_height[2] = motor_positions[2] + s.real_height
+
+    s.cycles = 0
+
+    while True:
+
+        # Le funzioni delle distanze aggiornano anche i vertici del tetto
+        update_alfas_precalc(s)
+        e12 = distance_12(s) ** 2 - base_length_2
+        e23 = distance_23(s) ** 2 - base_length_2
+        e13 = distance_13(s) ** 2 - base_length_2
+
+        err = fabs(e12)
+        if fabs(e23) > err:
+            err = fabs(e23)
+        if fabs(e13) > err:
+            err = fabs(e13)
+        err = err / (2 * s.base_length)
+
+        if err < NEWTON_ERR_LIMIT or s.cycles == NEWTON_CYCLE_LIMIT:
+            break
+
+        s.cycles += 1
+
+        # Derivate dei vertici rispetto al proprio angolo
+        dx0 = s.nodes_height[0] * s.alphas_cos[0]
+        dz0 = -s.nodes_height[0] * s.alphas_sin[0]
+        dx1 = -s.nodes_height[1] * s.alphas_cos[1] * 0.5
+        dy1 = -s.nodes_height[1] * s.alphas_cos[1] * 0.8660254037844386
+        dz1 = -s.nodes_height[1] * s.alphas_sin[1]
+        dx2 = -s.nodes_height[2] * s.alphas_cos[2] * 0.5
+        dy2 = s.nodes_height[2] * s.alphas_cos[2] * 0.8660254037844386
+        dz2 = -s.nodes_height[2] * s.alphas_sin[2]
+
+        # Lo jacobiano ha sempre la forma
+        #   | a  b  0 |
+        #   | 0  c  d |
+        #   | e  0  f |
+        a = 2 * ((s.roof.x[0] - s.roof.x[1]) * dx0 + (s.roof.z[0] - s.roof.z[1]) * dz0)
+        b = 2 * ((s.roof.x[1] - s.roof.x[0]) * dx1 + s.roof.y[1] * dy1 + (s.roof.z[1] - s.roof.z[0]) * dz1)
+        c = 2 * ((s.roof.x[1] - s.roof.x[2]) * dx1 + (s.roof.y[1] - s.roof.y[2]) * dy1 +
+                 (s.roof.z[1] - s.roof.z[2]) * dz1)
+        d = 2 * ((s.roof.x[2] - s.roof.x[1]) * dx2 + (s.roof.y[2] - s.roof.y[1]) * dy2 +
+                 (s.roof.z[2] - s.roof.z[1]) * dz2)
+        e = 2 * ((s.roof.x[0] - s.roof.x[2]) * dx0 + (s.roof.z[0] - s.roof.z[2]) * dz0)
+        f = 2 * ((s.roof.x[2] - s.roof.x[0]) * dx2 + s.roof.y[2] * dy2 + (s.roof.z[2] - s.roof.z[0]) * dz2)
+        det = a * c * f + b * d * e
+
+        if fabs(det) < 1e-300:
+            break
+
+        # Regola di Cramer per J * delta = -err
+        s.alphas_temp[0] -= (e12 * c * f - b * e23 * f + b * d * e13) / det
+        s.alphas_temp[1] -= (a * e23 * f - a * d * e13 + e12 * d * e) / det
+        s.alphas_temp[2] -= (a * c * e13 + b * e23 * e - e12 * c * e) / det
+
+    if (err >= s.err_limit or fabs(s.alphas_temp[0]) > -s.alpha_limit_r or
+            fabs(s.alphas_temp[1]) > -s.alpha_limit_r or fabs(s.alphas_temp[2]) > -s.alpha_limit_r):
+        # error_description = "Maximum number of cycles executed, no solution found!"
+        s.is_last_valid = False
+        return -2
+
+    # Trovata la soluzione
+    s.is_last_valid = True
+    s.alphas_last[0] = s.alphas_temp[0]
+    s.alphas_last[1] = s.alphas_temp[1]
+    s.alphas_last[2] = s.alphas_temp[2]
+    return 0
+
+cdef inline int solve_base_angles(solver_t *s, double *motor_positions) nogil:
+
+    if s.method == DK_NEWTON:
+        return newton_base_angles(s, motor_positions)
+    else:
+        return search_base_angles(s, motor_positions)
 
-cpdef find_plane_angles(motor_positions):
 
-    global roof
-    global roll
-    global pitch
-    global yaw
-    global roll_r
-    global pitch_r
-    global yaw_r
+cdef void find_plane_angles(solver_t *s, double roof_motor_position) nogil:
 
     cdef:
         double center_point_x
         double center_point_y
         double center_point_z
         int i, j
+        double mr
         double base_r[3][3]
         double mat_rot[3][3]
+        double k16, k17, l17, m19, m20, i23, i24, i25
 
     # Calcolo il punto mediano tra i vertici 2 e 3
-    center_point_x = (roof.x[1] + roof.x[2]) / 2
-    center_point_y = (roof.y[1] + roof.y[2]) / 2
-    center_point_z = (roof.z[1] + roof.z[2]) / 2
+    center_point_x = (s.roof.x[1] + s.roof.x[2]) / 2
+    center_point_y = (s.roof.y[1] + s.roof.y[2]) / 2
+    center_point_z = (s.roof.z[1] + s.roof.z[2]) / 2
 
     # Matrice con i tre punti del piano finora calcolati da distante_12/23/13 ed un
     # quarto punto mediano rispetto a 2 e 3
 
     # Questa e' l'inizializzazione della matrice con le posizioni
-    base_r[0][:] = [roof.x[0] - center_point_x,
-                    roof.y[0] - center_point_y,
-                    roof.z[0] - center_point_z]
-    base_r[1][:] = [roof.x[1] - center_point_x,
-                    roof.y[1] - center_point_y,
-                    roof.z[1] - center_point_z]
-    base_r[2][:] = [0.0, 0.0, 0.0]
-
-    # Questa e' la costruzione di una matrice di rotazione
-    mat_rot[0][:] = [0.0, 0.0, 0.0]
-    mat_rot[1][:] = [0.0, 0.0, 0.0]
-    mat_rot[2][:] = [0.0, 0.0, 0.0]
+    base_r[0][0] = s.roof.x[0] - center_point_x
+    base_r[0][1] = s.roof.y[0] - center_point_y
+    base_r[0][2] = s.roof.z[0] - center_point_z
+    base_r[1][0] = s.roof.x[1] - center_point_x
+    base_r[1][1] = s.roof.y[1] - center_point_y
+    base_r[1][2] = s.roof.z[1] - center_point_z
 
     # Questo è il calcolo della matrice di rotazione
     for i in range(0, 2):
@@ -394,12 +468,198 @@ cpdef find_plane_angles(motor_positions):
     i24 = k16 / i23
     i25 = l17 / i23
     m19 = asin(i24)
-    yaw_r = m19 + motor_positions[3]
-    pitch_r = asin(k17)
-    roll_r = asin(i25)
-    roll = roll_r / M_PI * 180.0
-    pitch = pitch_r / M_PI * 180.0
-    yaw = yaw_r / M_PI * 180.0
+    s.yaw_r = m19 + roof_motor_position
+    s.pitch_r = asin(k17)
+    s.roll_r = asin(i25)
+    s.roll = s.roll_r / M_PI * 180.0
+    s.pitch = s.pitch_r / M_PI * 180.0
+    s.yaw = s.yaw_r / M_PI * 180.0
+
+
+cdef class Solver:
+    """Risolutore della cinematica diretta
+
+    Ogni istanza possiede la propria geometria, gli angoli di partenza della ricerca successiva (warm start) e le
+    variabili di appoggio, per cui thread o flussi diversi possono usare ognuno il proprio risolutore senza
+    interferire tra loro. Una stessa istanza non va invece usata da due thread contemporaneamente.
+    """
+
+    cdef solver_t st
+
+    def __init__(self, double base_radius=0.705, double real_height=1.685, double alpha_limit=10.0, double ke=150,
+                 double err_limit=0.00015, int cycle_limit=1000, method='search'):
+        """method puo' essere 'search', la ricerca a passi, o 'newton', il metodo di Newton-Raphson"""
+
+        if method == 'search':
+            solver_init(&self.st, base_radius, real_height, alpha_limit, ke, err_limit, cycle_limit, DK_SEARCH)
+        elif method == 'newton':
+            solver_init(&self.st, base_radius, real_height, alpha_limit, ke, err_limit, cycle_limit, DK_NEWTON)
+        else:
+            raise ValueError("Metodo di ricerca '{}' sconosciuto".format(method))
+
+    def reset(self):
+        """Dimentica gli angoli trovati in precedenza, la prossima ricerca riparte da -alpha_limit"""
+
+        cdef int i
+
+        self.st.is_last_valid = False
+        for i in range(3):
+            self.st.alphas_start[i] = self.st.alpha_limit_r
+            self.st.alphas_last[i] = self.st.alpha_limit_r
+
+    def search_angles(self, motor_positions):
+
+        cdef:
+            int res
+            double positions[4]
+
+        positions[0] = motor_positions[0]
+        positions[1] = motor_positions[1]
+        positions[2] = motor_positions[2]
+        positions[3] = motor_positions[3]
+
+        res = solve_base_angles(&self.st, positions)
+
+        if res == 0:
+            find_plane_angles(&self.st, positions[3])
+            return [res, self.st.roll, self.st.pitch, self.st.yaw, self.st.roll_r, self.st.pitch_r, self.st.yaw_r,
+                    self.st.cycles]
+        else:
+            return [res, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, self.st.cycles]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def search_angles_batch(self, double[:, ::1] motor_positions, double[:, ::1] angles):
+        """Cinematica diretta su un intero blocco di posizioni
+
+        motor_positions e' un array contiguo di double (N, 4), con le colonne nello stesso ordine di search_angles.
+        Per ogni riga vengono scritti in angles, preallocato (N, 4), roll, pitch, yaw in gradi ed i cicli usati.
+        Le righe senza soluzione hanno gli angoli a NaN.
+
+        Il calcolo avviene senza GIL.
+
+        Restituisce il numero di righe senza soluzione.
+        """
+
+        cdef:
+            Py_ssize_t i
+            Py_ssize_t rows = motor_positions.shape[0]
+            long failed = 0
+            solver_t *s = &self.st
+
+        if motor_positions.shape[1] != 4:
+            raise ValueError("motor_positions deve avere 4 colonne")
+        if angles.shape[0] < rows or angles.shape[1] != 4:
+            raise ValueError("angles deve avere dimensione ({}, 4)".format(rows))
+
+        with nogil:
+            for i in range(rows):
+                if solve_base_angles(s, &motor_positions[i, 0]) == 0:
+                    find_plane_angles(s, motor_positions[i, 3])
+                    angles[i, 0] = s.roll
+                    angles[i, 1] = s.pitch
+                    angles[i, 2] = s.yaw
+                else:
+                    angles[i, 0] = NAN
+                    angles[i, 1] = NAN
+                    angles[i, 2] = NAN
+                    failed += 1
+                angles[i, 3] = s.cycles
+
+        return failed
+
+
+# Risolutore usato dalle funzioni di modulo
+cdef Solver default_solver = Solver()
+
+def init():
+    """Reinizializza il risolutore di modulo"""
+
+    global default_solver
+
+    default_solver = Solver()
+
+def search_angles(motor_positions):
+
+    return default_solver.search_angles(motor_positions)
+
+def search_angles_batch(double[:, ::1] motor_positions, double[:, ::1] angles):
+
+    return default_solver.search_angles_batch(motor_positions, angles)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def compact_steps(long long[:, ::1] steps, long long[::1] times, long long[::1] anchor, double tolerance,
+                  long long max_time, unsigned char[::1] keep, long long[::1] merged_times):
+    """Compattazione di un blocco (N, 4) di step in segmenti lineari nel tempo
+
+    anchor sono gli step dell'ultima riga tenuta prima del blocco. Una riga viene unita alla successiva se tutte le
+    righe unite distano al piu' tolerance step, per ogni motore, dal moto lineare tra l'ultima riga tenuta e la
+    nuova, e se il segmento dura al piu' max_time ms. Per ogni motore le pendenze ammesse dalle righe intermedie
+    formano un intervallo, ristretto ad ogni riga unita, per cui il controllo costa O(1) per riga.
+
+    keep[i] e' 1 per le righe da scrivere, merged_times[i] il loro tempo dall'ultima riga tenuta. L'ultima riga del
+    blocco viene sempre tenuta, cosi' i blocchi restano indipendenti. Restituisce il numero di righe tenute.
+    """
+
+    cdef Py_ssize_t n = steps.shape[0]
+    cdef Py_ssize_t i, m
+    cdef Py_ssize_t candidate = -1
+    cdef Py_ssize_t kept = 0
+    cdef long long elapsed = 0
+    cdef long long row_time
+    cdef double base[4]
+    cdef double lo[4]
+    cdef double hi[4]
+    cdef double new_lo[4]
+    cdef double new_hi[4]
+    cdef double slope
+    cdef bint is_merged
+
+    for m in range(4):
+        base[m] = anchor[m]
+        lo[m] = -1e300
+        hi[m] = 1e300
+
+    with nogil:
+        for i in range(n):
+            row_time = elapsed + times[i]
+            if candidate >= 0:
+                # La riga candidata diventa intermedia, la riga i deve restare nelle pendenze ammesse
+                is_merged = times[i] > 0 and elapsed > 0 and row_time <= max_time
+                if is_merged:
+                    for m in range(4):
+                        new_lo[m] = max(lo[m], (steps[candidate, m] - tolerance - base[m]) / elapsed)
+                        new_hi[m] = min(hi[m], (steps[candidate, m] + tolerance - base[m]) / elapsed)
+                        slope = (steps[i, m] - base[m]) / row_time
+                        if slope < new_lo[m] or slope > new_hi[m]:
+                            is_merged = False
+                            break
+                if is_merged:
+                    keep[candidate] = 0
+                    for m in range(4):
+                        lo[m] = new_lo[m]
+                        hi[m] = new_hi[m]
+                else:
+                    # Tengo la candidata, da cui parte un nuovo segmento
+                    keep[candidate] = 1
+                    merged_times[candidate] = elapsed
+                    kept += 1
+                    for m in range(4):
+                        base[m] = steps[candidate, m]
+                        lo[m] = -1e300
+                        hi[m] = 1e300
+                    row_time = times[i]
+            candidate = i
+            elapsed = row_time
+
+        if candidate >= 0:
+            keep[candidate] = 1
+            merged_times[candidate] = elapsed
+            kept += 1
+
+    return kept
 
 cpdef angles_to_avionics(zyx3, zyx2, zyx1):
     """Converte una terna rotazionale da interna in avionica
@@ -515,54 +775,34 @@ cpdef angles_to_internals(rx_yxz, ry_yxz, rz_yxz):
 
     return [zyx3, zyx2, zyx1, zyx3_r, zyx2_r, zyx1_r]
 
-def search_angles(motor_positions):
-
-    global alphas_last
-    global roll
-    global pitch
-    global yaw
-    global roll_r
-    global pitch_r
-    global yaw_r
-    global cycles
-
-    cdef int res
-
-    res = search_base_angles(motor_positions)
-
-    if res == 0:
-        find_plane_angles(motor_positions)
-        return [res, roll, pitch, yaw, roll_r, pitch_r, yaw_r, cycles]
-    else:
-        return [res, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, cycles]
-
 def search_angles_test(heights, rotation):
 
     cdef int i
 
     for i in range(9999):
-        search_angles(heights, rotation)
+        search_angles(list(heights) + [rotation])
 
-    return search_angles(heights, rotation)
+    return search_angles(list(heights) + [rotation])
 
 
 def search():
 
     cdef:
         int i
-        double res_12
-        double res_23
-        double res_13
+        solver_t s
 
-    nodes_height[:] = [0.01, 0.01, 0.01]
+    solver_init(&s, 0.705, 1.685, 10.0, 150, 0.00015, 1000, DK_SEARCH)
+    s.nodes_height[0] = 0.01
+    s.nodes_height[1] = 0.01
+    s.nodes_height[2] = 0.01
 
     for i in range(1000000):
-        distance_12()
-        distance_23()
-        distance_13()
-        nodes_height[1] += 0.000000001
-        nodes_height[1] -= 0.000000001
-        update_alfas_precalc()
+        distance_12(&s)
+        distance_23(&s)
+        distance_13(&s)
+        s.nodes_height[1] += 0.000000001
+        s.nodes_height[1] -= 0.000000001
+        update_alfas_precalc(&s)
 
 def test_distance():
 
@@ -570,14 +810,20 @@ def test_distance():
         double res_12
         double res_23
         double res_13
+        solver_t s
+
+    solver_init(&s, 0.705, 1.685, 10.0, 150, 0.00015, 1000, DK_SEARCH)
 
     # Provo le funzioni di calcolo delle distanze
-    alphas_temp[:] = [0.3, 0.4, 0]
-    nodes_height[:] = [real_height + 0.2, real_height + 0.1, real_height - 0.2]
-    update_alfas_precalc()
-    res_12 = distance_12()
-    res_23 = distance_23()
-    res_13 = distance_13()
+    s.alphas_temp[0] = 0.3
+    s.alphas_temp[1] = 0.4
+    s.alphas_temp[2] = 0.0
+    s.nodes_height[0] = s.real_height + 0.2
+    s.nodes_height[1] = s.real_height + 0.1
+    s.nodes_height[2] = s.real_height - 0.2
+    update_alfas_precalc(&s)
+    res_12 = distance_12(&s)
+    res_23 = distance_23(&s)
+    res_13 = distance_13(&s)
 
     print "{}, {}, {}".format(res_12, res_23, res_13)
-
@@ -4,8 +4,9 @@ __author__ = 'Luca Lucci'
 
 from twisted.internet import protocol, reactor
 from twisted.protocols.basic import LineReceiver
-import re, signal, logging
+import signal, logging
 import plot
+from PositionParser import PositionParser
 
 
 
@@ -98,8 +99,8 @@ class ALMA_Tripod():
         self.posProgress = 0
         self.isInitialize = False
 
-        # Compila i cercatori
-        self.find_motor_position = re.compile('@M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) @M([^ ]*) S([^ ]*) AS([^ ]*) T([^ ]*) C([^ ]*)')
+        # Interprete delle righe delle posizioni, con i quattro motori
+        self.position_parser = PositionParser(4)
 
     def cleanup(self):
         logger.info("De-Initializing ALMA_Tripod class")
@@ -114,29 +115,28 @@ class ALMA_Tripod():
     def stream_reader(self, line):
         try:
             #line: @M119 S0 @M120 S0 @M121 S0 @M122 S0 AS4 T9.89 C0
-            canopen_status = self.find_motor_position.search(line)
+            sample = self.position_parser.parse(line)
 
             self.time = 0.01
 
-            if canopen_status is not None:
-                self.plot.plot_update(self.time, float(canopen_status.group(2)), float(canopen_status.group(4)),
-                                      float(canopen_status.group(6)), float(canopen_status.group(8)))
-                #self.plot.plot_update(self.time, float(canopen_status.group(2)), float(canopen_status.group(4)),
-                #                      float(canopen_status.group(6)), float(canopen_status.group(8)))
-
-                if canopen_status:
-                    # Se lo stato e' zero, vuol dire che c'e' una segnalazione pendente
-                    if canopen_status.group(9) == '0' and not self.isAsyncError:
-                        self.isAsyncError = True
-                    elif canopen_status.group(9) == '8':
-                        if self.simulation is False:
-                            self.simulation = True
-                    elif canopen_status.group(9) != '0':
-                        self.simulation = False
-
-                    self.canStatus = canopen_status.group(9)
-
-                    self.posProgress = canopen_status.group(11)
+            if sample is not None:
+                self.plot.plot_update(self.time, float(sample.steps[0]), float(sample.steps[1]),
+                                      float(sample.steps[2]), float(sample.steps[3]))
+                #self.plot.plot_update(self.time, float(sample.steps[0]), float(sample.steps[1]),
+                #                      float(sample.steps[2]), float(sample.steps[3]))
+
+                # Se lo stato e' zero, vuol dire che c'e' una segnalazione pendente
+                if sample.status == '0' and not self.isAsyncError:
+                    self.isAsyncError = True
+                elif sample.status == '8':
+                    if self.simulation is False:
+                        self.simulation = True
+                elif sample.status != '0':
+                    self.simulation = False
+
+                self.canStatus = sample.status
+
+                self.posProgress = sample.progress
         except Exception, e:
             logger.info(e.message)
 
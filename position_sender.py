@@ -3,7 +3,6 @@
 
 from twisted.internet import protocol, reactor, task
 from time import sleep
-from PositionProtocol import PositionProtocol
 from PositionFactory import PositionFactory
 from ControlFactory import ControlFactory
 from Tripod import Tripod
@@ -12,36 +11,24 @@ from Tripod import Tripod
 import os, signal, logging, stat
 
 
-class ALMA_Stream_Protocol(PositionProtocol):
-    """Protocollo per l'invio delle posizioni ALMA"""
+class ALMA_Streamer_Factory(PositionFactory):
+    """Invio delle posizioni ALMA nel formato del canopen_server, a tutti i client collegati"""
 
-    def __init__(self, tripod):
-        self.tripod = tripod
-        PositionProtocol(self.tripod)
+    def compute_position(self):
 
-    def send_position(self):
+        return (dict(self.tripod.motorPos), self.tripod.canStatus, self.tripod.posTime, self.tripod.OpProgress)
+
+    def encode_position(self, position):
+        motorPos, canStatus, posTime, OpProgress = position
         line = ''
 
         for motor_number in self.tripod.motor_address_list:
-            line = line + "@M{} S{} ".format(motor_number, self.tripod.motorPos[motor_number])
-
-        line = line + "AS{} T{} C{}".format(self.tripod.canStatus, self.tripod.posTime, self.tripod.OpProgress)
+            line = line + "@M{} S{} ".format(motor_number, motorPos[motor_number])
 
-        self.transport.write("%s\n" % (line))
+        line = line + "AS{} T{} C{}".format(canStatus, posTime, OpProgress)
 
-class ALMA_Streamer_Factory(protocol.Factory):
-    """Factory di gestione del protocollo di invio delle posizioni ALMA"""
+        return "%s\n" % (line)
 
-    def __init__(self, tripod):
-        # Devo impedire il collegamento multiplo!
-        self.tripod = tripod
-        self.tripod.position_factory = self
-        self.numProtocols = 0
-    
-    def buildProtocol(self, addr):
-        self.tripod.almaPositionProtocol = ALMA_Stream_Protocol(self.tripod)
-        return self.tripod.almaPositionProtocol
-             
 if __name__ == '__main__':
 
     logger = logging.getLogger('root')